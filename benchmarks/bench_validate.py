@@ -0,0 +1,71 @@
+"""Benchmark of validating a large index
+
+Not a test (pytest only collects tests/), run it manually, from the root
+of the repository:
+
+    python3 benchmarks/bench_validate.py [number of modules]
+
+Generates an index with 10 000 modules (by default), similar to the ones in
+the build-index repository, validates it (the same as 'cfbs validate'), and
+prints how long that takes, and how many modules per second were validated.
+"""
+
+import os
+import sys
+import time
+from collections import OrderedDict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cfbs.cfbs_json import CFBSJson  # noqa: E402
+from cfbs.validate import validate_config_collect_errors  # noqa: E402
+
+
+def _module(number):
+    module = OrderedDict()
+    module["description"] = "Generated module number %d for benchmarking" % number
+    module["tags"] = ["experimental", "benchmark"]
+    module["repo"] = "https://github.com/cfengine/modules"
+    module["by"] = "https://github.com/cfengine"
+    module["version"] = "1.%d.0" % number
+    module["commit"] = "c3b7329b240cf7ad062a0a64ee8b607af2cb912a"
+    module["subdirectory"] = "generated/module-%d" % number
+    if number > 0:
+        module["dependencies"] = ["module-%d" % (number - 1)]
+    module["steps"] = [
+        "copy main.cf services/cfbs/modules/module-%d/main.cf" % number,
+        "json def.json def.json",
+        "bundles module_%d:main" % number,
+        "policy_files services/cfbs/modules/module-%d/main.cf" % number,
+    ]
+    return module
+
+
+def generate_index(count):
+    data = OrderedDict()
+    data["name"] = "index"
+    data["description"] = "Generated index for benchmarking"
+    data["type"] = "index"
+    data["index"] = OrderedDict(
+        ("module-%d" % number, _module(number)) for number in range(count)
+    )
+    return CFBSJson(path="./cfbs.json", data=data)
+
+
+def main(count=10000, rounds=3):
+    config = generate_index(count)
+    best = None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        issues = validate_config_collect_errors(config)
+        elapsed = time.perf_counter() - start
+        assert not issues, issues[0].error
+        best = elapsed if best is None else min(best, elapsed)
+    print(
+        "Validated %d modules in %.3f seconds (%d modules per second, best of %d)"
+        % (count, best, count / best, rounds)
+    )
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
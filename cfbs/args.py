@@ -2,7 +2,7 @@ import argparse
 import os
 from typing import List, Optional  # noqa: F401
 
-from cfbs import commands
+from cfbs.command_registry import get_command_names
 from cfbs.utils import cache, CFBSExitError
 
 
@@ -34,6 +34,8 @@ class ArgsTypesNamespace(argparse.Namespace):
     ignored_path_components = None  # type: Optional[List[str]]
     offline = False  # type: bool
     masterfiles = None  # type: Optional[str]
+    jobs = None  # type: Optional[int]
+    convert_rules = None  # type: Optional[str]
 
 
 def get_args():
@@ -80,7 +82,7 @@ class YesNoToBool(argparse.Action):
 
 @cache
 def get_arg_parser(whitespace_for_manual=False):
-    command_list = commands.get_command_names()
+    command_list = get_command_names()
     CFBS_DESCRIPTION = "CFEngine Build System."
     if whitespace_for_manual:
         parser = argparse.ArgumentParser(
@@ -123,7 +125,9 @@ def get_arg_parser(whitespace_for_manual=False):
         type=str,
     )
     parser.add_argument(
-        "--check", help="Check if file(s) would be reformatted", action="store_true"
+        "--check",
+        help="Check if file(s) would be reformatted ('cfbs pretty'), or which modules have updates available ('cfbs update')",
+        action="store_true",
     )
     parser.add_argument(
         "--checksum",
@@ -168,9 +172,9 @@ def get_arg_parser(whitespace_for_manual=False):
     )
     parser.add_argument(
         "--to-json",
-        help="Output 'cfbs analyze' results to a JSON file; optionally specify the JSON's filename",
+        help="Output 'cfbs analyze', 'cfbs validate' or 'cfbs update --check' results to a JSON file; optionally specify the JSON's filename (without .json)",
         nargs="?",
-        const="analysis",
+        const="",
         default=None,
     )
     parser.add_argument(
@@ -195,4 +199,14 @@ def get_arg_parser(whitespace_for_manual=False):
         "--masterfiles",
         help='Specify masterfiles version to add during "cfbs init". This can be a branch, a full version number, or `no` to not add masterfiles at all.',
     )
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        help="Number of concurrent jobs in 'cfbs pretty', 'cfbs validate', 'cfbs update --check' and 'cfbs convert' (default: based on the number of CPUs)",
+        type=int,
+    )
+    parser.add_argument(
+        "--convert-rules",
+        help="JSON file with rules for what to do with modified files (drop, keep or patch, by glob pattern) in 'cfbs convert', instead of prompting",
+    )
     return parser
@@ -15,16 +15,34 @@ import os
 import logging as log
 import shutil
 import subprocess
+import tarfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
 from cfbs.augments import generate_augment
+from cfbs.diff import file_diff_text
 from cfbs.cfbs_config import CFBSConfig
+from cfbs.index import get_default_index
+from cfbs.internal_file_management import (
+    SUPPORTED_ARCHIVES,
+    absolute_module_copy,
+    export_git_commit,
+    fetch_archive,
+    get_download_path,
+    is_partial_export,
+    local_module_copy,
+    project_path,
+)
 from cfbs.utils import (
     CFBSUserError,
+    append_file,
     cli_tool_present,
+    counted_subprocess,
     cp,
-    cp_dry_overwrites,
     deduplicate_def_json,
-    file_diff_text,
     find,
+    is_a_commit_hash,
     merge_json,
     mkdir,
     pad_right,
@@ -33,11 +51,13 @@ from cfbs.utils import (
     save_file,
     sh,
     strip_left,
+    strip_right,
     touch,
     CFBSExitError,
     write_json,
 )
 from cfbs.pretty import pretty, pretty_file
+from cfbs.provenance import BUILD_PSEUDO_MODULE, Provenance
 from cfbs.validate import (
     AVAILABLE_BUILD_STEPS,
     MAX_REPLACEMENTS,
@@ -46,12 +66,145 @@ from cfbs.validate import (
     validate_build_step,
 )
 
+_MODULES_URL = "https://archive.build.cfengine.com/modules"
+
+_run = counted_subprocess(subprocess.run)
+
+
+def _project_dir(config: CFBSConfig) -> str:
+    """Directory of the project (with the cfbs.json), relative to the
+    current working directory, "." for the current working directory."""
+    return os.path.dirname(config.path) or "."
+
+
+def init_out_folder(out_dir="out"):
+    rm(out_dir, missing_ok=True)
+    mkdir(out_dir)
+    mkdir(os.path.join(out_dir, "masterfiles"))
+    mkdir(os.path.join(out_dir, "steps"))
+
+
+def _download_module(module, counter, max_length, redownload, ignore_versions, out_dir):
+    """Download a module (if necessary) and copy it into the output
+    directory, returns the line to print"""
+    name = module["name"]
+    if "commit" not in module:
+        raise CFBSExitError("module %s must have a commit property" % name)
+    commit = module["commit"]
+    if not is_a_commit_hash(commit):
+        raise CFBSExitError("'%s' is not a commit reference" % commit)
+
+    url = module.get("url") or module["repo"]
+    url = strip_right(url, ".git")
+    commit_dir = get_download_path(module)
+    if redownload:
+        rm(commit_dir, missing_ok=True)
+    if "subdirectory" in module:
+        module_dir = os.path.join(commit_dir, module["subdirectory"])
+    else:
+        module_dir = commit_dir
+    if not os.path.exists(module_dir) or (
+        module_dir == commit_dir and is_partial_export(commit_dir)
+    ):
+        if url.endswith(SUPPORTED_ARCHIVES):
+            fetch_archive(url, commit, subdirectory=module.get("subdirectory"))
+            if not os.path.exists(module_dir):
+                raise CFBSExitError(
+                    "Subdirectory '%s' for module '%s' was not found in fetched archive '%s': "
+                    % (module["subdirectory"], name, url)
+                    + "Please check cfbs.json for possible typos."
+                )
+        # a couple of cases where there will not be an archive available:
+        # - using an alternate index (index property in module data)
+        # - added by URL instead of name (no version property in module data)
+        elif "index" in module or "url" in module or ignore_versions:
+            if "subdirectory" in module:
+                export_git_commit(url, commit, commit_dir, [module["subdirectory"]])
+            else:
+                export_git_commit(url, commit, commit_dir)
+            if not os.path.exists(module_dir):
+                raise CFBSExitError(
+                    "Subdirectory '%s' for module '%s' was not found in cloned repository '%s': "
+                    % (module["subdirectory"], name, url)
+                    + "Please check cfbs.json for possible typos."
+                )
+        else:
+            versions = get_default_index().versions
+            try:
+                checksum = versions[name][module["version"]]["archive_sha256"]
+            except KeyError:
+                raise CFBSExitError("Cannot verify checksum of the '%s' module" % name)
+            module_archive_url = os.path.join(_MODULES_URL, name, commit + ".tar.gz")
+            fetch_archive(
+                module_archive_url, checksum, directory=commit_dir, with_index=False
+            )
+    target = os.path.join(out_dir, "steps", "%03d_%s_%s/" % (counter, name, commit))
+    module["_directory"] = target
+    module["_counter"] = counter
+    subdirectory = module.get("subdirectory", None)
+    if not subdirectory:
+        cp(commit_dir, target)
+    else:
+        cp(os.path.join(commit_dir, subdirectory), target)
+    return "%03d %s @ %s (Downloaded)" % (counter, pad_right(name, max_length), commit)
+
+
+def download_dependencies(
+    config: CFBSConfig,
+    redownload=False,
+    ignore_versions=False,
+    out_dir="out",
+    jobs: Optional[int] = 1,
+):
+    """Download all modules in the build list, and copy them into the output
+    directory (out_dir/steps), ready for perform_build().
+
+    With jobs other than 1, up to jobs modules are downloaded / copied
+    concurrently (None means based on the number of CPUs). Modules from the
+    same download (repository / archive) are still handled one at a time,
+    and the output is printed in the order of the build list.
+    """
+    # TODO: This function should be split in 2:
+    #       1. Code for downloading things into ~/.cache/cfengine
+    #       2. Code for copying things into ./out
+    print("\nModules:")
+    max_length = config.longest_module_key_length("name")
+    build = config.get("build")
+    if build is None:
+        return
+    project_dir = _project_dir(config)
+
+    # Modules can share a download (e.g. different subdirectories of the
+    # same repository and commit), only one thread at a time per download:
+    download_locks = {}
+    download_locks_lock = threading.Lock()
+
+    def download_lock(module):
+        if "commit" not in module or not is_a_commit_hash(module["commit"]):
+            return threading.Lock()  # _download_module() will raise an error
+        path = get_download_path(module)
+        with download_locks_lock:
+            return download_locks.setdefault(path, threading.Lock())
+
+    def download(counter, module):
+        name = module["name"]
+        if name.startswith("./"):
+            return local_module_copy(module, counter, max_length, out_dir, project_dir)
+        if name.startswith("/"):
+            return absolute_module_copy(module, counter, max_length, out_dir)
+        with download_lock(module):
+            return _download_module(
+                module, counter, max_length, redownload, ignore_versions, out_dir
+            )
 
-def init_out_folder():
-    rm("out", missing_ok=True)
-    mkdir("out")
-    mkdir("out/masterfiles")
-    mkdir("out/steps")
+    numbered = list(enumerate(build, start=1))
+    if jobs != 1 and len(build) > 1:
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            for line in executor.map(lambda args: download(*args), numbered):
+                print(line)
+    else:
+        for counter, module in numbered:
+            print(download(counter, module))
 
 
 def _perform_replacement(n, a, b, filename):
@@ -97,14 +250,30 @@ def _perform_replacement(n, a, b, filename):
         raise CFBSExitError("Failed to write to '%s'" % (filename,))
 
 
-def _apply_masterfiles_patch(patch_path):
+def _patched_files(patch_path):
+    """Paths (relative to the directory the patch is applied in) of the
+    files changed by a unified diff .patch file"""
+    with open(patch_path, "r") as f:
+        lines = f.read().splitlines()
+    paths = []
+    for line, next_line in zip(lines, lines[1:]):
+        if not (line.startswith("--- ") and next_line.startswith("+++ ")):
+            continue
+        for header in (line, next_line):
+            path = header[4:].split("\t")[0].strip()
+            if path != "/dev/null" and path not in paths:
+                paths.append(path)
+    return paths
+
+
+def _apply_masterfiles_patch(patch_path, destination):
     if not cli_tool_present("patch"):
         raise CFBSUserError("Working with .patch files requires the 'patch' utility")
 
     if not os.path.isfile(patch_path):
         raise CFBSExitError("Patch at path '%s' not found" % patch_path)
 
-    patch_path = os.path.relpath(patch_path, "out/masterfiles")
+    patch_path = os.path.relpath(patch_path, destination)
 
     # reasoning for used flags:
     # * `-t`: do not interactively ask the user for another path if the patch fails to apply due to the path not being found
@@ -112,35 +281,31 @@ def _apply_masterfiles_patch(patch_path):
     cmd = "patch -u -t -p0 -i" + patch_path
     # the cwd needs to be the base path of the relative paths specified in the .patch files
     # currently, the output of the patch command is displayed
-    cp = subprocess.run(cmd, shell=True, cwd="out/masterfiles")
+    cp = _run(cmd, shell=True, cwd=destination)
 
     if cp.returncode != 0:
         raise CFBSExitError("Failed to apply patch '%s'" % patch_path)
 
 
-def _perform_copy_step(args, source, destination, prefix):
+def _perform_copy_step(args, source, destination, prefix, provenance, diffs=False):
+    """Copy files, warning about identical overwrites. With diffs, returns
+    the diffs of the files overwritten with different content, otherwise
+    an empty string (diffing is only done when they are written to a file,
+    with --diffs)."""
     src, dst = args
     if dst in [".", "./"]:
         dst = ""
     print("%s copy '%s' 'masterfiles/%s'" % (prefix, src, dst))
     src, dst = os.path.join(source, src), os.path.join(destination, dst)
 
-    step_diffs_data = ""
+    step_diffs = []
 
-    noop_overwrites_relpaths, modifying_overwrites_relpaths = cp_dry_overwrites(
-        src, dst
+    def diff_overwrite(src_file, dst_file, rel_path):
+        step_diffs.append(file_diff_text(src_file, dst_file))
+
+    noop_overwrites_relpaths, _ = provenance.copy(
+        src, dst, diff_overwrite if diffs else None
     )
-    for file_relpath in modifying_overwrites_relpaths:
-        if os.path.isfile(src):
-            fileA = src
-        else:
-            fileA = os.path.join(src, file_relpath)
-        if os.path.isfile(dst):
-            fileB = dst
-        else:
-            fileB = os.path.join(dst, file_relpath)
-        file_diff_data = file_diff_text(fileA, fileB)
-        step_diffs_data += file_diff_data
     if len(noop_overwrites_relpaths) > 0:
         warning_message = (
             "Identical file overwrites occured during copy.\n"
@@ -149,21 +314,31 @@ def _perform_copy_step(args, source, destination, prefix):
             + " In that case, the file is best deleted from the latter module(s).\n"
             + " Identical overwrites count: %s\n" % len(noop_overwrites_relpaths)
         )
+
+        def overwrite_line(path):
+            # The write before this copy step is the module already providing the file:
+            history = provenance.history(path)
+            if len(history) < 2:
+                return "  %s\n" % path
+            return "  %s (already provided by %s)\n" % (path, history[-2]["module"])
+
         # display affected files, without flooding the output
         if len(noop_overwrites_relpaths) < 20:
             for overwrite_noop in noop_overwrites_relpaths:
-                warning_message += "  " + overwrite_noop + "\n"
+                warning_message += overwrite_line(overwrite_noop)
         else:
             for overwrite_noop in noop_overwrites_relpaths[:9]:
-                warning_message += "  " + overwrite_noop + "\n"
+                warning_message += overwrite_line(overwrite_noop)
             warning_message += "   ...\n"
             for overwrite_noop in noop_overwrites_relpaths[-9:]:
-                warning_message += "  " + overwrite_noop + "\n"
+                warning_message += overwrite_line(overwrite_noop)
+        warning_message += (
+            " See provenance.json in the build output for where each file came from.\n"
+        )
         # display all the messages as one warning
         log.warning(warning_message)
-    cp(src, dst)
 
-    return step_diffs_data
+    return "".join(step_diffs)
 
 
 def _perform_run_step(args, source, prefix):
@@ -185,7 +360,7 @@ def _perform_delete_step(args, source, prefix):
             )
 
 
-def _perform_json_step(args, source, destination, prefix):
+def _perform_json_step(args, source, destination, prefix, provenance):
     src, dst = args
     if dst in [".", "./"]:
         dst = ""
@@ -203,9 +378,10 @@ def _perform_json_step(args, source, destination, prefix):
     else:
         merged = extras
     write_json(dst, merged)
+    provenance.record_file(dst)
 
 
-def _perform_append_step(args, source, destination, prefix):
+def _perform_append_step(args, source, destination, prefix, provenance):
     src, dst = args
     if dst in [".", "./"]:
         dst = ""
@@ -214,10 +390,11 @@ def _perform_append_step(args, source, destination, prefix):
     if not os.path.exists(dst):
         touch(dst)
     assert os.path.isfile(dst)
-    sh("cat '%s' >> '%s'" % (src, dst))
+    append_file(src, dst)
+    provenance.record_file(dst)
 
 
-def _perform_directory_step(args, source, destination, prefix):
+def _perform_directory_step(args, source, destination, prefix, provenance):
     src, dst = args
     if dst in [".", "./"]:
         dst = ""
@@ -240,22 +417,24 @@ def _perform_directory_step(args, source, destination, prefix):
                 d = os.path.join(destination, dstarg, root[len(src) :], f)
                 log.debug("Copying '%s' to '%s'" % (s, d))
                 cp(s, d)
+                provenance.record_file(d)
     write_json(defjson, merged)
+    provenance.record_file(defjson)
 
 
-def _path_if_already_shipped(path, build_modules, destination):
+def _path_if_already_shipped(path, build_modules, destination, project_dir=None):
     """If `path` is already inside a local module's directory that has its own
     "directory" build step shipping it to masterfiles, return the on-host path
     that step will produce. That step already copies the whole directory
     during this same build, so the caller doesn't need to (and shouldn't)
     copy the file itself - just point at where it will end up.
     """
-    abs_path = os.path.abspath(path)
+    abs_path = os.path.abspath(project_path(project_dir, path))
     for module in build_modules:
         module_name = module.get("name", "")
         if not (module_name.startswith("./") and module_name.endswith("/")):
             continue
-        module_root = os.path.abspath(module_name)
+        module_root = os.path.abspath(project_path(project_dir, module_name))
 
         if os.path.commonpath([abs_path, module_root]) != module_root:
             # Only a module that contains the file can be the one shipping it.
@@ -277,7 +456,9 @@ def _path_if_already_shipped(path, build_modules, destination):
     return None
 
 
-def _localize_file_inputs(name, input_data, destination, build_modules):
+def _localize_file_inputs(
+    name, input_data, destination, build_modules, project_dir=None, provenance=None
+):
     """Copy files referenced by "file" type input responses into the built
     masterfiles, so they're actually part of what gets deployed instead of
     only existing in the project directory. Rewrites the responses in place
@@ -294,10 +475,12 @@ def _localize_file_inputs(name, input_data, destination, build_modules):
     module_dir_name = os.path.basename(module_dir_name.rstrip("/"))
 
     def _localize(rel_path):
-        if not rel_path or not os.path.isfile(rel_path):
+        if not rel_path or not os.path.isfile(project_path(project_dir, rel_path)):
             return rel_path
 
-        already_shipped = _path_if_already_shipped(rel_path, build_modules, destination)
+        already_shipped = _path_if_already_shipped(
+            rel_path, build_modules, destination, project_dir
+        )
         if already_shipped is not None:
             return already_shipped
 
@@ -308,7 +491,9 @@ def _localize_file_inputs(name, input_data, destination, build_modules):
             "modules" if rel_path.startswith(module_dir_name) else "",
             rel_path,
         )
-        cp(rel_path, dest)
+        cp(project_path(project_dir, rel_path), dest)
+        if provenance is not None:
+            provenance.record_file(dest)
         return "$(sys.inputdir)/" + os.path.relpath(dest, destination)
 
     for element in input_data:
@@ -321,7 +506,9 @@ def _localize_file_inputs(name, input_data, destination, build_modules):
             element["response"] = _localize(response)
 
 
-def _perform_input_step(args, name, destination, prefix, build_modules):
+def _perform_input_step(
+    args, name, destination, prefix, build_modules, project_dir, provenance
+):
     src, dst = args
     if dst in [".", "./"]:
         dst = ""
@@ -333,7 +520,7 @@ def _perform_input_step(args, name, destination, prefix, build_modules):
         # We'll translate it to what it should be
         # TODO: Consider removing this behavior for cfbs 4?
         src = "." + src[len(name) :]
-    src = os.path.join(name, src)
+    src = project_path(project_dir, os.path.join(name, src))
     dst = os.path.join(destination, dst)
     if not os.path.isfile(os.path.join(src)):
         log.warning(
@@ -342,7 +529,9 @@ def _perform_input_step(args, name, destination, prefix, build_modules):
         )
         return
     extras, original = read_json(src), read_json(dst)
-    _localize_file_inputs(name, extras, destination, build_modules)
+    _localize_file_inputs(
+        name, extras, destination, build_modules, project_dir, provenance
+    )
     extras = generate_augment(name, extras)
     log.debug("Generated augment: %s", pretty(extras))
     if not extras:
@@ -358,9 +547,10 @@ def _perform_input_step(args, name, destination, prefix, build_modules):
         merged = extras
     log.debug("Merged def.json: %s", pretty(merged))
     write_json(dst, merged)
+    provenance.record_file(dst)
 
 
-def _perform_policy_files_step(args, destination, prefix):
+def _perform_policy_files_step(args, destination, prefix, provenance):
     files = []
     for file in args:
         if file.startswith("./"):
@@ -368,8 +558,8 @@ def _perform_policy_files_step(args, destination, prefix):
         if file.endswith(".cf"):
             files.append(file)
         elif file.endswith("/"):
-            cf_files = find("out/masterfiles/" + file, extension=".cf")
-            files += (strip_left(f, "out/masterfiles/") for f in cf_files)
+            cf_files = find(os.path.join(destination, file), extension=".cf")
+            files += (strip_left(f, destination + "/") for f in cf_files)
         else:
             raise CFBSExitError(
                 "Unsupported filetype '%s' for build step 'policy_files': " % file
@@ -388,9 +578,10 @@ def _perform_policy_files_step(args, destination, prefix):
         merged = augment
     log.debug("Merged def.json: %s", pretty(merged))
     write_json(path, merged)
+    provenance.record_file(path)
 
 
-def _perform_bundles_step(args, prefix, destination):
+def _perform_bundles_step(args, prefix, destination, provenance):
     bundles = args
     print("%s bundles '%s'" % (prefix, "' '".join(bundles) if bundles else ""))
     augment = {"vars": {"control_common_bundlesequence_end": bundles}}
@@ -405,9 +596,10 @@ def _perform_bundles_step(args, prefix, destination):
         merged = augment
     log.debug("Merged def.json: %s", pretty(merged))
     write_json(path, merged)
+    provenance.record_file(path)
 
 
-def _perform_replace_step(module, i, args, name, destination, prefix):
+def _perform_replace_step(module, i, args, name, destination, prefix, provenance):
     assert len(args) == 4
     print("%s replace '%s'" % (prefix, "' '".join(args)))
     # New build step so let's be a bit strict about validating it:
@@ -415,9 +607,12 @@ def _perform_replace_step(module, i, args, name, destination, prefix):
     n, a, b, file = args
     file = os.path.join(destination, file)
     _perform_replacement(n, a, b, file)
+    provenance.record_file(file)
 
 
-def _perform_replace_version_step(module, i, args, name, destination, prefix):
+def _perform_replace_version_step(
+    module, i, args, name, destination, prefix, provenance
+):
     assert len(args) == 3
     # New build step so let's be a bit strict about validating it:
     validate_build_step(name, module, i, "replace_version", args, strict=True)
@@ -427,9 +622,10 @@ def _perform_replace_version_step(module, i, args, name, destination, prefix):
     filename = os.path.join(destination, args[2])
     version = module["version"]
     _perform_replacement(n, to_replace, version, filename)
+    provenance.record_file(filename)
 
 
-def _perform_patch_step(module, i, args, name, source, prefix):
+def _perform_patch_step(module, i, args, name, source, destination, prefix, provenance):
     assert len(args) == 1
 
     patch_relpath = args[0]
@@ -439,10 +635,20 @@ def _perform_patch_step(module, i, args, name, source, prefix):
 
     patch_path = os.path.join(source, patch_relpath)
 
-    _apply_masterfiles_patch(patch_path)
+    _apply_masterfiles_patch(patch_path, destination)
+    for path in _patched_files(patch_path):
+        provenance.record_file(os.path.join(destination, path))
 
 
-def perform_build(config: CFBSConfig, diffs_filename=None) -> int:
+def perform_build(config: CFBSConfig, diffs_filename=None, out_dir="out") -> int:
+    """Run all the build steps, combining the modules (already copied into
+    out_dir/steps by download_dependencies()) into out_dir/masterfiles and
+    out_dir/masterfiles.tgz. Which module and build step wrote each file
+    is saved in out_dir/provenance.json (see cfbs.provenance).
+
+    Paths in the project (like local modules) are relative to the directory
+    of config.path, so the project doesn't have to be the current working
+    directory."""
     if not config.get("build"):
         raise CFBSExitError("No 'build' key found in the configuration")
 
@@ -476,6 +682,9 @@ def perform_build(config: CFBSConfig, diffs_filename=None) -> int:
                     )
 
     diffs_data = ""
+    project_dir = _project_dir(config)
+    destination = os.path.join(out_dir, "masterfiles")
+    provenance = Provenance(destination)
 
     print("\nSteps:")
     max_length = config.longest_module_key_length("name")
@@ -484,38 +693,57 @@ def perform_build(config: CFBSConfig, diffs_filename=None) -> int:
             operation, args = split_build_step(step)
             name = module["name"]
             source = module["_directory"]
-            destination = "out/masterfiles"
 
             counter = module["_counter"]
             prefix = "%03d %s :" % (counter, pad_right(name, max_length))
+            provenance.begin_step(name, step)
 
             if operation == "copy":
-                step_diffs_data = _perform_copy_step(args, source, destination, prefix)
+                step_diffs_data = _perform_copy_step(
+                    args,
+                    source,
+                    destination,
+                    prefix,
+                    provenance,
+                    diffs_filename is not None,
+                )
                 diffs_data += step_diffs_data
             elif operation == "run":
                 _perform_run_step(args, source, prefix)
             elif operation == "delete":
                 _perform_delete_step(args, source, prefix)
             elif operation == "json":
-                _perform_json_step(args, source, destination, prefix)
+                _perform_json_step(args, source, destination, prefix, provenance)
             elif operation == "append":
-                _perform_append_step(args, source, destination, prefix)
+                _perform_append_step(args, source, destination, prefix, provenance)
             elif operation == "directory":
-                _perform_directory_step(args, source, destination, prefix)
+                _perform_directory_step(args, source, destination, prefix, provenance)
             elif operation == "input":
-                _perform_input_step(args, name, destination, prefix, config["build"])
+                _perform_input_step(
+                    args,
+                    name,
+                    destination,
+                    prefix,
+                    config["build"],
+                    project_dir,
+                    provenance,
+                )
             elif operation == "policy_files":
-                _perform_policy_files_step(args, destination, prefix)
+                _perform_policy_files_step(args, destination, prefix, provenance)
             elif operation == "bundles":
-                _perform_bundles_step(args, prefix, destination)
+                _perform_bundles_step(args, prefix, destination, provenance)
             elif operation == "replace":
-                _perform_replace_step(module, i, args, name, destination, prefix)
+                _perform_replace_step(
+                    module, i, args, name, destination, prefix, provenance
+                )
             elif operation == "replace_version":
                 _perform_replace_version_step(
-                    module, i, args, name, destination, prefix
+                    module, i, args, name, destination, prefix, provenance
                 )
             elif operation == "patch":
-                _perform_patch_step(module, i, args, name, source, prefix)
+                _perform_patch_step(
+                    module, i, args, name, source, destination, prefix, provenance
+                )
 
     if diffs_filename is not None:
         try:
@@ -529,21 +757,27 @@ def perform_build(config: CFBSConfig, diffs_filename=None) -> int:
                 "An existing directory was provided as the '--diffs' file path - writing the diffs file for the build failed - continuing build..."
             )
 
-    assert os.path.isdir("./out/masterfiles/")
-    shutil.copyfile("./cfbs.json", "./out/masterfiles/cfbs.json")
-    if os.path.isfile("out/masterfiles/def.json"):
+    assert os.path.isdir(destination)
+    provenance.begin_step(BUILD_PSEUDO_MODULE, "copy cfbs.json")
+    shutil.copyfile(config.path, os.path.join(destination, "cfbs.json"))
+    provenance.record_file(os.path.join(destination, "cfbs.json"))
+    def_json = os.path.join(destination, "def.json")
+    if os.path.isfile(def_json):
+        provenance.begin_step(BUILD_PSEUDO_MODULE, "pretty def.json")
         try:
-            pretty_file("out/masterfiles/def.json")
+            pretty_file(def_json)
         except json.decoder.JSONDecodeError as e:
-            raise CFBSExitError(
-                "Error parsing JSON in 'out/masterfiles/def.json': %s" % e
-            )
+            raise CFBSExitError("Error parsing JSON in '%s': %s" % (def_json, e))
+        provenance.record_file(def_json)
+    provenance.save(os.path.join(out_dir, "provenance.json"))
     print("")
     print("Generating tarball...")
-    sh("( cd out/ && tar -czf masterfiles.tgz masterfiles )")
+    with tarfile.open(os.path.join(out_dir, "masterfiles.tgz"), "w:gz") as tar:
+        tar.add(destination, arcname="masterfiles")
     print("\nBuild complete, ready to deploy 🐿")
-    print(" -> Directory: out/masterfiles")
-    print(" -> Tarball:   out/masterfiles.tgz")
+    print(" -> Directory: %s" % destination)
+    print(" -> Tarball:   %s" % os.path.join(out_dir, "masterfiles.tgz"))
+    print(" -> Sources:   %s" % os.path.join(out_dir, "provenance.json"))
     print("")
     print("To install on this machine: sudo cfbs install")
     print("To deploy on remote hub(s): cf-remote deploy")
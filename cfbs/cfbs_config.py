@@ -18,6 +18,7 @@ import copy
 import glob
 import logging as log
 from collections import OrderedDict
+from contextlib import contextmanager
 from typing import List, Optional
 
 from cfbs.cfbs_types import CFBSCommandGitResult
@@ -25,6 +26,7 @@ from cfbs.utils import (
     CFBSExitError,
     CFBSProgrammerError,
     CFBSUserError,
+    atomic_open,
     is_a_commit_hash,
     read_file,
     write_json,
@@ -36,8 +38,9 @@ from cfbs.internal_file_management import (
     fetch_archive,
     SUPPORTED_ARCHIVES,
 )
-from cfbs.pretty import pretty, CFBS_DEFAULT_SORTING_RULES
+from cfbs.pretty import pretty, pretty_write, CFBS_DEFAULT_SORTING_RULES
 from cfbs.cfbs_json import CFBSJson
+from cfbs.dependency_graph import resolve_dependencies
 from cfbs.module import (
     Module,
     is_module_added_manually,
@@ -99,11 +102,50 @@ class CFBSConfig(CFBSJson):
         self._reload_args = (filename, index, non_interactive)
         super().__init__(path=filename, index_argument=index)
         self.non_interactive = non_interactive
+        self._transaction_depth = 0
+        self._unsaved = False  # save() was called in a transaction
 
     def save(self):
-        data = pretty(self._data, CFBS_DEFAULT_SORTING_RULES) + "\n"
-        with open(self.path, "w") as f:
-            f.write(data)
+        """Write cfbs.json (atomically), or in a transaction, when it ends."""
+        if self._transaction_depth > 0:
+            self._unsaved = True
+            return
+        self._write()
+
+    def _write(self):
+        with atomic_open(self.path) as f:
+            pretty_write(self._data, f, CFBS_DEFAULT_SORTING_RULES)
+            f.write("\n")
+        self._unsaved = False
+
+    @contextmanager
+    def transaction(self):
+        """Defer writing cfbs.json until the with block ends.
+
+        Commands making many changes one after another (like adding a patch
+        step for each modified file in cfbs convert) call save() after each
+        change, which would re-encode and rewrite the whole file every time.
+        Inside the with block save() only remembers that there are changes,
+        they are written once at the end (or at checkpoint()). Transactions
+        can be nested, only the outermost one writes.
+
+        Changes are written at the end even if an exception is raised, like
+        they would have been without the transaction, since other files
+        (patches, deleted files) were changed along with them.
+        """
+        self._transaction_depth += 1
+        try:
+            yield self
+        finally:
+            self._transaction_depth -= 1
+            if self._transaction_depth == 0 and self._unsaved:
+                self._write()
+
+    def checkpoint(self):
+        """Write changes saved so far in a transaction, now (for example
+        before committing them), and continue the transaction."""
+        if self._unsaved:
+            self._write()
 
     def longest_module_key_length(self, key) -> int:
         return (
@@ -132,20 +174,24 @@ class CFBSConfig(CFBSJson):
             if is_module_added_manually(added_by):
                 print("Skipping already added module '%s'" % name)
             return
-        if "dependencies" in module:
-            for dep in module["dependencies"]:
-                self.add_with_dependencies(dep, remote_config, name)
-        assert self._data is not None
-        if "build" not in self._data:
-            self._data["build"] = []
-        self._data["build"].append(module)
-
-        assert "added_by" in module
-        added_by = module["added_by"]
-        if not is_module_added_manually(added_by):
-            print("Added module: %s (Dependency of %s)" % (name, added_by))
-        else:
-            print("Added module: %s" % name)
+
+        def _get_dependency(dependency, dependent):
+            found = (remote_config or self).get_module_for_build(dependency, dependent)
+            if not found:
+                raise CFBSExitError("Module '%s' not found" % dependency)
+            return found
+
+        present = self._build_by_name().keys()
+        dependencies = resolve_dependencies([module], present, _get_dependency)
+        for m in dependencies + [module]:
+            self.add_to_build(m)
+
+            assert "added_by" in m
+            added_by = m["added_by"]
+            if not is_module_added_manually(added_by):
+                print("Added module: %s (Dependency of %s)" % (m["name"], added_by))
+            else:
+                print("Added module: %s" % m["name"])
 
     def _add_using_url(
         self,
@@ -234,17 +280,15 @@ class CFBSConfig(CFBSJson):
 
     def _update_added_by(self, requested, added_by):
         for req in requested:
-            for mod in self["build"]:
-                if req.name == mod["name"]:
-                    if added_by[req.name] == "cfbs add":
-                        mod["added_by"] = "cfbs add"
+            mod = self._find_in_build(req.name)
+            if mod is not None and added_by[req.name] == "cfbs add":
+                mod["added_by"] = "cfbs add"
 
     def _filter_modules_to_add(self, modules):
-        added = [m["name"] for m in self["build"]]
         filtered = []
         for module in modules:
             assert module not in filtered
-            if module.name in added:
+            if self._find_in_build(module.name) is not None:
                 print("Skipping already added module: %s" % module.name)
             else:
                 filtered.append(module)
@@ -253,26 +297,26 @@ class CFBSConfig(CFBSJson):
     def _find_dependencies(self, modules, exclude):
         assert type(modules) is list
         assert type(exclude) is list
-        exclude = modules + exclude
-        exclude_names = [m["name"] for m in exclude]
         index = self.index
-        dependencies = []
-        for module in modules:
-            for dep in module.get("dependencies", []):
-                if dep in exclude_names:
-                    continue
-                m = index.get_module_object(dep, module["name"])
-                dependencies.append(m)
-                exclude_names.append(dep)
+
+        def _get_dependency(dependency, dependent):
+            m = index.get_module_object(dependency, dependent)
+            if m is None:
+                raise CFBSExitError(
+                    "Module '%s' (dependency of '%s') not found in the index"
+                    % (dependency, dependent)
+                )
+            return m
+
+        present = (m["name"] for m in exclude)
+        dependencies = resolve_dependencies(modules, present, _get_dependency)
         assert not any(d for d in dependencies if "alias" in d)
-        if dependencies:
-            dependencies += self._find_dependencies(dependencies, exclude)
         return dependencies
 
     def _module_by_name(self, name):
-        for module in self["build"]:
-            if module["name"] == name:
-                return module
+        module = self._find_in_build(name)
+        if module is not None:
+            return module
 
         raise CFBSProgrammerError("Module of name %s not found" % name)
 
@@ -388,7 +432,7 @@ class CFBSConfig(CFBSJson):
 
         for module in modules:
             name = module["name"]
-            assert name not in (m["name"] for m in self["build"])
+            assert self._find_in_build(name) is None
             if "subdirectory" in module and module["subdirectory"] == "":
                 del module["subdirectory"]
             if self.index.custom_index is not None:
@@ -398,7 +442,7 @@ class CFBSConfig(CFBSJson):
             validate_single_module(
                 context="build", name=name, module=module, config=None, local_check=True
             )
-            self["build"].append(module)
+            self.add_to_build(module)
             self._handle_local_module(module, use_default_build_steps)
 
             assert "added_by" in module
@@ -13,9 +13,9 @@ TODOs:
 from collections import OrderedDict
 from copy import deepcopy
 import logging as log
-from typing import Optional
+from typing import Dict, Optional  # noqa: F401
 
-from cfbs.index import Index
+from cfbs.index import Index, get_default_index
 from cfbs.pretty import pretty, TOP_LEVEL_KEYS, MODULE_KEYS
 from cfbs.utils import CFBSValidationError, read_json, CFBSExitError
 
@@ -64,7 +64,16 @@ class CFBSJson:
         url=None,
         url_commit: Optional[str] = None,
         url_branch=None,
+        default_index: Optional[Index] = None,
     ):
+        """
+        :param index_argument: index URL / path / dict from the --index option,
+                               or an Index object to use as is
+        :param default_index: Index object to use when there is no
+                              index_argument nor "index" in the data, instead
+                              of a new Index of the default index (allows
+                              sharing one downloaded index between projects)
+        """
         assert path
         self.path = path
 
@@ -77,12 +86,19 @@ class CFBSJson:
         else:
             self._data = read_json(self.path)
 
-        if index_argument:
+        if isinstance(index_argument, Index):
+            self.index = index_argument
+        elif index_argument:
             self.index = Index(index_argument)
         elif self._data and "index" in self._data:
             self.index = Index(self._data["index"])
+        elif default_index is not None:
+            self.index = default_index
         else:
-            self.index = Index()
+            self.index = get_default_index()
+
+        # Name -> module lookup table for the "build" list, see _build_by_name():
+        self._build_index = None  # type: Optional[Dict[str, dict]]
 
     @property
     def raw_data(self):
@@ -90,7 +106,8 @@ class CFBSJson:
         return deepcopy(self._data)
 
     def _find_all_module_objects(self):
-        data = self.raw_data
+        # Only reads the data, so no copy (raw_data) is needed:
+        data = self._data
         assert data is not None
         modules = []
         if "index" in data and type(data["index"]) in (dict, OrderedDict):
@@ -111,7 +128,7 @@ class CFBSJson:
         For the more complete validation, see validate.py.
         """
 
-        data = self.raw_data
+        data = self._data
         if not data:
             return  # No data, no unknown keys
 
@@ -142,6 +159,43 @@ class CFBSJson:
                     log.warning(msg)
                     already_printed.append(key)
 
+    def invalidate_module_indexes(self):
+        """Drop the cached name -> module lookup table for "build".
+
+        Call this after changing the "build" list, or the names of the
+        modules in it, other than with __setitem__() and add_to_build(),
+        which keep the table up to date themselves.
+        """
+        self._build_index = None
+
+    def _build_by_name(self):
+        """Dictionary of module name -> module object for "build".
+
+        Built lazily on the first lookup after the "build" list changed, so
+        lookups are constant time instead of a linear scan. When names are
+        duplicated, the first module wins, same as a scan.
+        """
+        if self._build_index is None:
+            build = self.get("build")
+            by_name = {}
+            if type(build) is list:
+                for module in build:
+                    name = module.get("name") if isinstance(module, dict) else None
+                    if type(name) is str and name not in by_name:
+                        by_name[name] = module
+            self._build_index = by_name
+        return self._build_index
+
+    def _find_in_build(self, name):
+        return self._build_by_name().get(name)
+
+    def add_to_build(self, module):
+        """Append module to the "build" list, keeping the lookup table"""
+        assert self._data is not None
+        self._data.setdefault("build", []).append(module)
+        if self._build_index is not None:
+            self._build_index.setdefault(module["name"], module)
+
     def _get_all_module_names(self, search_in=("build", "provides", "index")):
         modules = []
 
@@ -155,13 +209,20 @@ class CFBSJson:
         return modules
 
     def can_reach_dependency(self, name, search_in=("build", "provides", "index")):
-        return name in self._get_all_module_names(search_in)
+        if "build" in search_in and "build" in self:
+            if self._find_in_build(name) is not None:
+                return True
+        if "provides" in search_in and "provides" in self and name in self["provides"]:
+            return True
+        if "index" in search_in and name in self.index:
+            return True
+        return False
 
     def find_module(self, name, search_in=("build", "provides", "index")):
         if "build" in search_in and "build" in self:
-            for module in self["build"]:
-                if module["name"] == name:
-                    return module
+            module = self._find_in_build(name)
+            if module is not None:
+                return module
         if "provides" in search_in and "provides" in self and name in self["provides"]:
             return self["provides"][name]
         if "index" in search_in and name in self.index:
@@ -177,6 +238,13 @@ class CFBSJson:
         assert self._data is not None
         return self._data[key]
 
+    def __setitem__(self, key, value):
+        assert key != "index"
+        assert self._data is not None
+        self._data[key] = value
+        if key == "build":
+            self.invalidate_module_indexes()
+
     def __contains__(self, key):
         return key in self._data
 
@@ -212,10 +280,7 @@ class CFBSJson:
         return None
 
     def _module_is_in_build(self, module):
-        return "build" in self and module["name"] in (m["name"] for m in self["build"])
+        return "build" in self and self._find_in_build(module["name"]) is not None
 
     def get_module_from_build(self, module):
-        for m in self.get("build") or []:
-            if m["name"] == module:
-                return m
-        return None
+        return self._find_in_build(module)
@@ -0,0 +1,83 @@
+"""Names of all cfbs commands, and where they are implemented
+
+main.py and args.py use this to list, check and dispatch commands without
+importing the modules implementing them. Those modules import most of cfbs
+(and the standard library) so importing them up front makes even
+`cfbs --version` and `cfbs --help` slow. Instead, only the module implementing
+the requested command is imported, after the arguments have been checked:
+- cfbs.query_commands for the commands which only read the project (status,
+  search, validate, info / show), which don't need the build, convert,
+  analyze, update, etc. code.
+- cfbs.commands for the rest.
+
+The functions in these modules are registered with the `@cfbs_command`
+decorator (below), when adding a command, also add it here, in the same
+order (tests check that they match).
+"""
+
+import importlib
+from collections import OrderedDict
+from typing import Callable
+
+from cfbs.cfbs_types import CFBSCommandExitCode
+
+_COMMANDS_MODULE = "cfbs.commands"
+_QUERY_COMMANDS_MODULE = "cfbs.query_commands"
+
+# Command name -> module with the @cfbs_command function for it:
+_COMMAND_MODULES = OrderedDict()  # type: OrderedDict[str, str]
+for _name in (
+    "pretty",
+    "init",
+    "status",
+    "search",
+    "add",
+    "remove",
+    "clean",
+    "update",
+    "validate",
+    "download",
+    "build",
+    "install",
+    "help",
+    "info",
+    "show",
+    "analyse",
+    "analyze",
+    "convert",
+    "input",
+    "set-input",
+    "get-input",
+    "render-input",
+    "serve",
+):
+    _COMMAND_MODULES[_name] = _COMMANDS_MODULE
+for _name in ("status", "search", "validate", "info", "show"):
+    _COMMAND_MODULES[_name] = _QUERY_COMMANDS_MODULE
+
+# Command name -> function, for the commands in the modules imported so far:
+_commands = OrderedDict()
+
+
+def cfbs_command(name: str):
+    """
+    Decorator to specify that a function is a command (verb in the CLI).
+    Adds the name + function pair to the global dict of commands.
+    Does not modify/wrap the function it decorates.
+    Ensures cfbs command functions return a `CFBSCommandExitCode`.
+    """
+
+    def inner(function: Callable[..., CFBSCommandExitCode]):
+        _commands[name] = function
+        return function  # Unmodified, we've just added it to the dict
+
+    return inner
+
+
+def get_command_names():
+    return _COMMAND_MODULES.keys()
+
+
+def import_command_module(name: str):
+    """Import and return the module implementing a command."""
+    return importlib.import_module(_COMMAND_MODULES[name])
@@ -2,6 +2,8 @@
 commands.py - Entry points for each cfbs command.
 
 Each cfbs command has a corresponding function named <command>_command.
+The commands which only read the project (status, search, validate,
+info / show) are in query_commands.py instead, see command_registry.py.
 Functions ending in "_command" are dynamically included in the list of commands
 in main.py for -h/--help/help.
 
@@ -52,7 +54,7 @@ import logging as log
 import json
 import shutil
 import tempfile
-from typing import Callable, List, Optional, Union
+from typing import List, Optional, Union
 from collections import OrderedDict
 from cfbs.analyze import analyze_policyset
 from cfbs.analyze import AnalyzedFiles  # noqa: F401 (used in type comments)
@@ -60,18 +62,26 @@ from cfbs.args import get_args
 from typing import Iterable
 
 from cfbs.cfbs_json import CFBSJson
-from cfbs.cfbs_types import CFBSCommandExitCode, CFBSCommandGitResult
+from cfbs.cfbs_types import CFBSCommandGitResult
+from cfbs.command_registry import cfbs_command
+from cfbs.convert_batch import (
+    DROP as CONVERT_DROP,
+    KEEP as CONVERT_KEEP,
+    PATCH as CONVERT_PATCH,
+    ConvertRules,
+    diff_files,
+)
+from cfbs.dependency_graph import DependencyGraph
+from cfbs.diff import file_diff_text
 from cfbs.download import download_single_version
-from cfbs.updates import ModuleUpdates, update_module
+from cfbs.updates import ModuleUpdates, check_updates, update_module, version_numbers
 from cfbs.utils import (
-    CFBSNetworkError,
     CFBSUserError,
     CFBSValidationError,
     cfbs_dir,
     cfbs_filename,
     cp_dry_overwrites,
     display_diff,
-    file_diff_text,
     is_cfbs_repo,
     mkdir,
     most_relevant_version,
@@ -79,25 +89,28 @@ from cfbs.utils import (
     CFBSExitError,
     remove_empty_folders,
     save_file,
-    strip_right,
+    subprocess_count,
     pad_right,
     CFBSProgrammerError,
-    get_json,
     write_json,
     rm,
     cp,
-    sh,
-    is_a_commit_hash,
 )
 
 from cfbs.pretty import (
     pretty,
-    pretty_check_file,
-    pretty_file,
     CFBS_DEFAULT_SORTING_RULES,
 )
+from cfbs.pretty_files import (
+    ERROR as PRETTY_ERROR,
+    WOULD_REFORMAT,
+    PrettyCache,
+    expand_json_paths,
+    pretty_files,
+)
 from cfbs.augments import generate_augment
 from cfbs.build import (
+    download_dependencies,
     init_out_folder,
     perform_build,
 )
@@ -110,15 +123,12 @@ from cfbs.validate import (
     validate_single_module,
 )
 from cfbs.internal_file_management import (
-    absolute_module_copy,
     clone_url_repo,
+    clone_url_repos,
+    forget_remote_refs,
     SUPPORTED_URI_SCHEMES,
-    fetch_archive,
-    get_download_path,
-    local_module_copy,
-    SUPPORTED_ARCHIVES,
 )
-from cfbs.index import _VERSION_INDEX, Index
+from cfbs.index import Index
 from cfbs.git import (
     git_configure_and_initialize,
     git_get_config,
@@ -129,61 +139,39 @@ from cfbs.git import (
 
 from cfbs.git_magic import commit_after_command, git_commit_maybe_prompt
 from cfbs.prompts import prompt_user, prompt_user_yesno
+from cfbs.serve import serve
 from cfbs.module import Module, is_module_absolute, is_module_added_manually
 
-_MODULES_URL = "https://archive.build.cfengine.com/modules"
-
 PLURAL_S = lambda args, _: "s" if len(args[0]) > 1 else ""
 FIRST_ARG = lambda args, _: "'%s'" % args[0]
 FIRST_ARG_SLIST = lambda args, _: ", ".join("'%s'" % module for module in args[0])
 
-_commands = OrderedDict()
-
-
-def cfbs_command(name: str):
-    """
-    Decorator to specify that a function is a command (verb in the CLI).
-    Adds the name + function pair to the global dict of commands.
-    Does not modify/wrap the function it decorates.
-    Ensures cfbs command functions return a `CFBSCommandExitCode`.
-    """
-
-    def inner(function: Callable[..., CFBSCommandExitCode]):
-        _commands[name] = function
-        return function  # Unmodified, we've just added it to the dict
-
-    return inner
-
-
-def get_command_names():
-    names = _commands.keys()
-    return names
-
 
 @cfbs_command("pretty")
-def pretty_command(filenames: List[str], check: bool, keep_order: bool):
+def pretty_command(
+    filenames: List[str], check: bool, keep_order: bool, jobs: Optional[int] = None
+):
+    """Format (or with check, look for unformatted) JSON files.
+
+    filenames can also be directories and glob patterns, see
+    expand_json_paths(). Files known to be formatted from earlier runs are
+    skipped, and with many files, they are processed in parallel by up to
+    jobs processes. Output is in the order of filenames."""
     if not filenames:
         raise CFBSExitError("Filenames missing for cfbs pretty command")
 
-    sorting_rules = CFBS_DEFAULT_SORTING_RULES if keep_order else None
+    paths = expand_json_paths(filenames)
+    cache = PrettyCache(sorting=keep_order)
+    results = pretty_files(paths, check, keep_order, jobs, cache)
+    cache.save()
+
     num_files = 0
-    for f in filenames:
-        if not f or not f.endswith(".json"):
-            raise CFBSExitError(
-                "cfbs pretty command can only be used with .json files, not '%s'"
-                % os.path.basename(f)
-            )
-        try:
-            if check:
-                if not pretty_check_file(f, sorting_rules):
-                    num_files += 1
-                    print("Would reformat %s" % f)
-            else:
-                pretty_file(f, sorting_rules)
-        except FileNotFoundError:
-            raise CFBSExitError("File '%s' not found" % f)
-        except json.decoder.JSONDecodeError as ex:
-            raise CFBSExitError("Error parsing JSON in '%s': %s" % (f, ex))
+    for path, result, error in results:
+        if result == PRETTY_ERROR:
+            raise CFBSExitError(error)
+        if result == WOULD_REFORMAT:
+            num_files += 1
+            print("Would reformat %s" % path)
     if check:
         print("Would reformat %d file(s)" % num_files)
         return 1 if num_files > 0 else 0
@@ -306,96 +294,6 @@ def init_command(
     return 0
 
 
-@cfbs_command("status")
-def status_command():
-    config = CFBSConfig.get_instance()
-    validate_config_raise_exceptions(config, empty_build_list_ok=True)
-    print("Name:        %s" % config["name"])
-    print("Description: %s" % config["description"])
-    print("File:        %s" % cfbs_filename())
-    if "index" in config:
-        assert config.raw_data is not None
-        index = config.raw_data["index"]
-
-        if type(index) is str:
-            print("Index:       %s" % index)
-        else:
-            print("Index:       %s" % "inline index in cfbs.json")
-
-    modules = config.get("build")
-    if not modules:
-        return 0
-    print("\nModules:")
-    max_name_length = config.longest_module_key_length("name")
-    max_version_length = config.longest_module_key_length("version")
-    counter = 1
-    for m in modules:
-        if m["name"].startswith("./"):
-            status = "Copied"
-            version = "local"
-            commit = pad_right("", 40)
-        else:
-            path = get_download_path(m)
-            status = "Downloaded" if os.path.exists(path) else "Not downloaded"
-            version = m.get("version", "")
-            commit = m["commit"]
-        name = pad_right(m["name"], max_name_length)
-        version = pad_right(version, max_version_length)
-        version_with_commit = version + " "
-        if m["name"].startswith("./"):
-            version_with_commit += " "
-        else:
-            version_with_commit += "/"
-        version_with_commit += " " + commit
-        print("%03d %s @ %s (%s)" % (counter, name, version_with_commit, status))
-        counter += 1
-
-    return 0
-
-
-@cfbs_command("search")
-def search_command(terms: List[str]):
-    index = CFBSConfig.get_instance().index
-    results = {}
-
-    # in order to gather all aliases, we must iterate over everything first
-    for name, data in index.items():
-        if "alias" in data:
-            realname = data["alias"]
-            if realname not in results:
-                results[realname] = {}
-            if "aliases" in results[realname]:
-                results[realname]["aliases"].append(name)
-            else:
-                results[realname]["aliases"] = [name]
-            continue
-        if name in results:
-            results[name]["description"] = data["description"]
-        else:
-            results[name] = {"description": data["description"], "aliases": []}
-
-    filtered = {}
-    if terms:
-        for name in (
-            name
-            for name, data in results.items()
-            if any((t for t in terms if t in name))
-            or any((t for t in terms if any((s for s in data["aliases"] if t in s))))
-        ):
-            filtered[name] = results[name]
-    else:
-        filtered = results
-
-    results = filtered
-    for k, v in results.items():
-        print("{}".format(k), end="")
-        if any(v["aliases"]):
-            print(" ({})".format(", ".join(v["aliases"])), end="")
-        print(" - {}".format(v["description"]))
-
-    return 0 if any(results) else 1
-
-
 @cfbs_command("add")
 @commit_after_command("Added module%s %s", [PLURAL_S, FIRST_ARG_SLIST])
 def add_command(
@@ -406,6 +304,7 @@ def add_command(
 ):
     config = CFBSConfig.get_instance()
     validate_config_raise_exceptions(config, empty_build_list_ok=True)
+    forget_remote_refs()
     r = config.add_command(to_add, added_by, checksum, explicit_build_steps)
     config.save()
     return r
@@ -421,37 +320,12 @@ def remove_command(to_remove: List[str]):
             'Cannot remove any modules because the "build" key is missing from cfbs.json'
         )
     modules = config["build"]
-
-    def _get_dependents(dependency) -> list:
-        """Get all modules that depend on the given module"""
-        if len(modules) < 2:
-            return []
-        dependents = []
-        for module in modules:
-            if dependency in module.get("dependencies", []):
-                dependents.append(module["name"])
-        return dependents
-
-    def _get_all_dependents_recursive(module_name, visited=None) -> set:
-        """Recursively get all modules that depend on this module"""
-        if visited is None:
-            visited = set()
-        if module_name in visited:
-            return visited
-        visited.add(module_name)
-
-        direct_dependents = _get_dependents(module_name)
-        for dependent in direct_dependents:
-            _get_all_dependents_recursive(dependent, visited)
-        return visited
+    graph = DependencyGraph(modules)
 
     def _get_module_by_name(name) -> Union[dict, None]:
         if not name.startswith("./") and name.endswith(".cf") and os.path.exists(name):
             name = "./" + name
-        for module in modules:
-            if module["name"] == name:
-                return module
-        return None
+        return config.get_module_from_build(name)
 
     def _get_modules_by_url(name) -> list:
         r = []
@@ -485,8 +359,7 @@ def remove_command(to_remove: List[str]):
             if not matches:
                 raise CFBSExitError("Could not find module with URL '%s'" % name)
             for module in matches:
-                all_affected = _get_all_dependents_recursive(module["name"])
-                all_affected.discard(module["name"])
+                all_affected = graph.all_dependents(module["name"])
                 prompt_msg = removal_msg(module, all_affected)
 
                 if prompt_user_yesno(
@@ -503,8 +376,7 @@ def remove_command(to_remove: List[str]):
                 print("Module '%s' not found" % name)
                 continue
 
-            all_affected = _get_all_dependents_recursive(module["name"])
-            all_affected.discard(module["name"])
+            all_affected = graph.all_dependents(module["name"])
             prompt_msg = removal_msg(module, all_affected)
 
             if prompt_user_yesno(
@@ -526,6 +398,7 @@ def remove_command(to_remove: List[str]):
             if module:
                 print("Removing module '%s'" % module_name)
                 modules.remove(module)
+                config.invalidate_module_indexes()
                 removed_modules.append(module)
                 msg += "\n - Removed module '%s'" % module_name
             modules_to_remove.remove(module_name)
@@ -560,6 +433,7 @@ def remove_command(to_remove: List[str]):
             for dep in sorted(deps, key=lambda x: x["name"]):
                 msg += "\n - Removed module '%s'" % dep["name"]
                 modules.remove(dep)
+                config.invalidate_module_indexes()
                 removed_modules.append(dep)
 
     num_removed = len(removed_modules)
@@ -578,23 +452,16 @@ def remove_command(to_remove: List[str]):
 
 
 def get_unused_dependancies(config):
-    modules = config.get("build", [])
-
-    def _someone_needs_me(this) -> bool:
-        if ("added_by" not in this) or is_module_added_manually(this["added_by"]):
-            return True
-        for other in modules:
-            if "dependencies" not in other:
-                continue
-            if this["name"] in other["dependencies"]:
-                return _someone_needs_me(other)
-        return False
+    """Modules which were added as dependencies, but are no longer needed.
 
-    to_remove = list()
-    for module in modules:
-        if not _someone_needs_me(module):
-            to_remove.append(module)
-    return to_remove
+    A module is needed if it was added by the user (or has no "added_by"),
+    or if a needed module (transitively) depends on it.
+    """
+    modules = config.get("build", [])
+    graph = DependencyGraph(modules)
+    return graph.unused(
+        lambda m: ("added_by" not in m) or is_module_added_manually(m["added_by"])
+    )
 
 
 @cfbs_command("clean")
@@ -633,6 +500,7 @@ def _clean_unused_modules(config=None):
     ):
         for module in to_remove:
             modules.remove(module)
+        config.invalidate_module_indexes()
         config.save()
 
     return 0
@@ -640,8 +508,18 @@ def _clean_unused_modules(config=None):
 
 @cfbs_command("update")
 @commit_after_command("Updated module%s", [PLURAL_S])
-def update_command(to_update):
+def update_command(to_update, check=False, json_filename=None, jobs=None):
+    """Update modules (all modules in the build list if to_update is empty).
+
+    With check, only show which modules have updates available, without
+    updating them, and return 1 if there are any (or if the latest version
+    of a module couldn't be found), see _update_check()."""
     config = CFBSConfig.get_instance()
+    forget_remote_refs()
+    if check:
+        return CFBSCommandGitResult(
+            _update_check(config, to_update, json_filename, jobs), False
+        )
     r = validate_config(config, empty_build_list_ok=True)
     valid_before = r == 0
     if not valid_before:
@@ -660,6 +538,14 @@ def update_command(to_update):
         else [Module(m["name"]) for m in build]
     )
 
+    # Download the latest cfbs.json of modules added by URL, grouped by
+    # remote, with the remotes at the same time, the loop below then finds
+    # them already downloaded:
+    names = set(update.name for update in to_update)
+    clone_url_repos(
+        (m["url"], m.get("branch")) for m in build if "url" in m and m["name"] in names
+    )
+
     updated = []
     module_updates = ModuleUpdates(config)
     index = None
@@ -739,14 +625,8 @@ def update_command(to_update):
                 )
                 continue
 
-            local_ver = [
-                int(version_number)
-                for version_number in re.split(r"[-\.]", old_module["version"])
-            ]
-            index_ver = [
-                int(version_number)
-                for version_number in re.split(r"[-\.]", index_info["version"])
-            ]
+            local_ver = version_numbers(old_module["version"])
+            index_ver = version_numbers(index_info["version"])
             if local_ver == index_ver:
                 print("Module '%s' already up to date" % old_module["name"])
                 continue
@@ -780,6 +660,7 @@ def update_command(to_update):
     for old_module, new_module, update in zip(old_modules, new_modules, update_objects):
         update_module(old_module, new_module, module_updates, update)
         updated.append(update)
+    config.invalidate_module_indexes()
 
     if module_updates.new_deps:
         assert index is not None
@@ -822,146 +703,42 @@ def update_command(to_update):
     )
 
 
-@cfbs_command("validate")
-def validate_command(paths=None, index_arg=None):
-    if paths:
-        ret_value = 0
-
-        for path in paths:
-            # Exit out early if we find anything wrong like missing files:
-            if not os.path.exists(path):
-                raise CFBSUserError("Specified path '{}' does not exist".format(path))
-            if path.endswith(".json") and not os.path.isfile(path):
-                raise CFBSUserError(
-                    "'{}' is not a file - Please specify a path to a cfbs project file, ending in .json, or a folder containing a cfbs.json".format(
-                        path
-                    )
-                )
-            if not path.endswith(".json") and not os.path.isfile(
-                os.path.join(path, "cfbs.json")
-            ):
-                raise CFBSUserError(
-                    "No CFBS project file found at '{}'".format(
-                        os.path.join(path, "cfbs.json")
-                    )
-                )
-
-            # Convert folder to folder/cfbs.json if appropriate:
-            if not path.endswith(".json"):
-                assert os.path.isdir(path)
-                path = os.path.join(path, "cfbs.json")
-            assert os.path.isfile(path)
-
-            # Actually open the file and perform validation:
-            config = CFBSJson(path=path, index_argument=index_arg)
-
-            r = validate_config(config)
-            if r != 0:
-                log.warning("Validation of project at path %s failed" % path)
-                ret_value = 1
-            else:
-                print("Successfully validated the project at path", path)
-
-        return ret_value
-
-    if not is_cfbs_repo():
-        # TODO change CFBSExitError to CFBSUserError here
-        raise CFBSExitError(
-            "Cannot validate: this is not a CFBS project. "
-            + "Use `cfbs init` to start a new project in this directory, or provide a path to a CFBS project to validate."
-        )
+def _update_check(config, to_update, json_filename=None, jobs=None) -> int:
+    results = check_updates(config, to_update, jobs)
+    if json_filename is not None:
+        json_dict = OrderedDict()
+        json_dict["updates_available"] = any(r["update_available"] for r in results)
+        json_dict["modules"] = results
+        write_json(json_filename + ".json", json_dict)
 
-    config = CFBSConfig.get_instance()
-    return validate_config(config)
-
-
-def _download_dependencies(config: CFBSConfig, redownload=False, ignore_versions=False):
-    # TODO: This function should be split in 2:
-    #       1. Code for downloading things into ~/.cache/cfengine
-    #       2. Code for copying things into ./out
-    print("\nModules:")
-    counter = 1
-    max_length = config.longest_module_key_length("name")
-    build = config.get("build")
-    if build is None:
-        return
-    for module in build:
-        name = module["name"]
-        if name.startswith("./"):
-            local_module_copy(module, counter, max_length)
-            counter += 1
-            continue
-        if name.startswith("/"):
-            absolute_module_copy(module, counter, max_length)
-            counter += 1
+    width = max([len(r["name"]) for r in results] + [0])
+    updates = 0
+    for result in results:
+        if "error" in result:
+            log.warning("Cannot check for updates: %s" % result["error"])
             continue
-        if "commit" not in module:
-            raise CFBSExitError("module %s must have a commit property" % name)
-        commit = module["commit"]
-        if not is_a_commit_hash(commit):
-            raise CFBSExitError("'%s' is not a commit reference" % commit)
-
-        url = module.get("url") or module["repo"]
-        url = strip_right(url, ".git")
-        commit_dir = get_download_path(module)
-        if redownload:
-            rm(commit_dir, missing_ok=True)
-        if "subdirectory" in module:
-            module_dir = os.path.join(commit_dir, module["subdirectory"])
-        else:
-            module_dir = commit_dir
-        if not os.path.exists(module_dir):
-            if url.endswith(SUPPORTED_ARCHIVES):
-                if os.path.exists(commit_dir) and "subdirectory" in module:
-                    raise CFBSExitError(
-                        "Subdirectory '%s' for module '%s' was not found in fetched archive '%s': "
-                        % (module["subdirectory"], name, url)
-                        + "Please check cfbs.json for possible typos."
-                    )
-                fetch_archive(url, commit)
-            # a couple of cases where there will not be an archive available:
-            # - using an alternate index (index property in module data)
-            # - added by URL instead of name (no version property in module data)
-            elif "index" in module or "url" in module or ignore_versions:
-                if os.path.exists(commit_dir) and "subdirectory" in module:
-                    raise CFBSExitError(
-                        "Subdirectory '%s' for module '%s' was not found in cloned repository '%s': "
-                        % (module["subdirectory"], name, url)
-                        + "Please check cfbs.json for possible typos."
-                    )
-                sh("git clone %s %s" % (url, commit_dir))
-                sh("(cd %s && git checkout %s)" % (commit_dir, commit))
-            else:
-                try:
-                    versions = get_json(_VERSION_INDEX)
-                except CFBSNetworkError:
-                    raise CFBSExitError(
-                        "Downloading CFEngine Build Module Index failed - check your Wi-Fi / network settings."
-                    )
-                try:
-                    checksum = versions[name][module["version"]]["archive_sha256"]
-                except KeyError:
-                    raise CFBSExitError(
-                        "Cannot verify checksum of the '%s' module" % name
-                    )
-                module_archive_url = os.path.join(
-                    _MODULES_URL, name, commit + ".tar.gz"
-                )
-                fetch_archive(
-                    module_archive_url, checksum, directory=commit_dir, with_index=False
+        if result["update_available"]:
+            updates += 1
+            print(
+                "%s %s -> %s"
+                % (
+                    pad_right(result["name"], width),
+                    result["current"],
+                    result["available"],
                 )
-        target = "out/steps/%03d_%s_%s/" % (counter, module["name"], commit)
-        module["_directory"] = target
-        module["_counter"] = counter
-        subdirectory = module.get("subdirectory", None)
-        if not subdirectory:
-            cp(commit_dir, target)
+            )
         else:
-            cp(os.path.join(commit_dir, subdirectory), target)
-        print(
-            "%03d %s @ %s (Downloaded)" % (counter, pad_right(name, max_length), commit)
-        )
-        counter += 1
+            print(
+                "%s %s (up to date)"
+                % (pad_right(result["name"], width), result["current"])
+            )
+    if updates:
+        print("%d module(s) can be updated, run 'cfbs update' to update them" % updates)
+    else:
+        print("Modules are already up to date")
+    if updates or any("error" in result for result in results):
+        return 1
+    return 0
 
 
 @cfbs_command("download")
@@ -974,7 +751,7 @@ def download_command(force, ignore_versions=False):
             + "\nPlease see the error messages above and apply fixes accordingly."
             + "\nIf not fixed, these errors will cause your project to not build in future cfbs versions."
         )
-    _download_dependencies(config, redownload=force, ignore_versions=ignore_versions)
+    download_dependencies(config, redownload=force, ignore_versions=ignore_versions)
     return 0
 
 
@@ -990,9 +767,11 @@ def build_command(ignore_versions=False, diffs_filename=None):
         )
         # We want the cfbs build command to be as backwards compatible as possible,
         # so we try building anyway and don't return error(s)
+    started = subprocess_count()
     init_out_folder()
-    _download_dependencies(config, ignore_versions=ignore_versions)
+    download_dependencies(config, ignore_versions=ignore_versions)
     r = perform_build(config, diffs_filename)
+    log.info("Subprocesses started by the build: %d" % (subprocess_count() - started))
     return r
 
 
@@ -1028,116 +807,6 @@ def help_command():
     raise CFBSProgrammerError("help_command should not be called, as we use argparse")
 
 
-def _print_module_info(data):
-    def human_readable(key: str):
-        if key == "repo":
-            return "Repository"
-        if key == "url":
-            return "URL"
-        return key.title().replace("_", " ")
-
-    ordered_keys = [
-        "module",
-        "description",
-        "tags",
-        "dependencies",
-        "index",
-        "subdirectory",
-        "url",
-        "repo",
-        "version",
-        "branch",
-        "commit",
-        "by",
-        "status",
-    ]
-    for key in ordered_keys:
-        if key in data:
-            if key in ["tags", "dependencies"]:
-                value = ", ".join(data[key])
-            else:
-                value = data[key]
-            print("{}: {}".format(human_readable(key), value))
-
-
-@cfbs_command("show")
-@cfbs_command("info")
-def info_command(modules: List[str]):
-    if not modules:
-        raise CFBSExitError(
-            "info/show command requires one or more module names as arguments"
-        )
-    config = CFBSConfig.get_instance()
-    config.warn_about_unknown_keys()
-    index = config.index
-
-    build = config.get("build", [])
-    assert isinstance(build, list)
-
-    alias = None
-
-    for module in modules:
-        print()  # whitespace for readability
-        in_build = any(m for m in build if m["name"] == module)
-        if not index.exists(module) and not in_build:
-            print("Module '{}' does not exist".format(module))
-            continue
-        if in_build:
-            # prefer information from the local source
-            data = next(m for m in build if m["name"] == module)
-            status_text = "Added"
-        elif module in index:
-            data = index[module]
-            if "alias" in data:
-                alias = module
-                module = data["alias"]
-                data = index[module]
-            status_text = "Added" if in_build else "Not added"
-        else:
-            if not module.startswith("./"):
-                module = "./" + module
-            data = next((m for m in build if m["name"] == module), None)
-            if data is None:
-                print("Path {} exists but is not yet added as a module.".format(module))
-                continue
-            status_text = "Added"
-
-        if status_text == "Added":
-            if "added_by" in data:
-                if data["added_by"] == "cfbs convert":
-                    status_text = "Added during 'cfbs convert'"
-                elif data["added_by"] == "cfbs init":
-                    if "url" in data:
-                        status_text = "Added from URL (not from default index)"
-                    else:
-                        status_text = "Added from name"
-                    status_text += " during 'cfbs init'"
-                elif data["added_by"].startswith("cfbs "):
-                    # normally "cfbs add" - written more generally as a safer fallback
-                    if "url" in data:
-                        status_text = (
-                            "Added by 'cfbs add <url>', not from default index"
-                        )
-                    else:
-                        status_text = "Added by 'cfbs add <module-name>'"
-                else:
-                    status_text = "Added by %s as a dependency" % data["added_by"]
-
-            if "input" in data:
-                input_path = os.path.join(data["name"], "input.json")
-                if not input_path.startswith("./"):
-                    input_path = "./" + input_path
-                if os.path.isfile(input_path):
-                    status_text += ", has input in %s" % input_path
-                else:
-                    status_text += ", supports input (but has no input yet)"
-        data["status"] = status_text
-        data["module"] = (module + "({})".format(alias)) if alias else module
-        _print_module_info(data)
-    print()  # extra line for ease of reading
-    return 0
-
-
 @cfbs_command("analyze")
 @cfbs_command("analyse")
 def analyze_command(
@@ -1217,11 +886,16 @@ class _ConvertState:
     at each call-site.
     """
 
-    def __init__(self, dir_name, path_string, non_interactive, offline):
+    def __init__(
+        self, dir_name, path_string, non_interactive, offline, rules=None, jobs=None
+    ):
         self.dir_name = dir_name
         self.path_string = path_string  # path to the to-be-converted dir
         self.non_interactive = non_interactive
         self.offline = offline
+        # what to do with modified files, instead of asking (--convert-rules)
+        self.rules = rules  # type: Optional[ConvertRules]
+        self.jobs = jobs  # number of processes computing diffs with rules
         self.backup_dir = (
             None
         )  # type: Optional[str]  # temp copy taken before messing with the project
@@ -1232,6 +906,9 @@ class _ConvertState:
         self.analyzed_files = None  # type: Optional[AnalyzedFiles]
         self.masterfiles_version = None  # type: Optional[str]
 
+        # messages of changes not committed yet, see _cfbs_convert_commit_batch()
+        self.uncommitted = []  # type: List[str]
+
     def cleanup(self):
         if self.is_functional:
             return
@@ -1277,7 +954,28 @@ def _cfbs_convert_git_commit(
         raise CFBSExitError("Failed to create git commit, aborting conversion.")
 
 
-def _cfbs_convert_check_directory(non_interactive, offline):
+# Number of modified files handled by cfbs convert between writing cfbs.json
+# and committing:
+_CONVERT_CHECKPOINT_FILES = 50
+
+
+def _cfbs_convert_commit_batch(state: _ConvertState):
+    """Write cfbs.json and commit the changes in state.uncommitted, as one
+    commit, instead of one commit for each of them."""
+    CFBSConfig.get_instance().checkpoint()
+    if not state.uncommitted:
+        return
+    if len(state.uncommitted) == 1:
+        message = state.uncommitted[0]
+    else:
+        message = "Handled %d files with custom modifications\n" % len(
+            state.uncommitted
+        ) + "".join("\n - " + change for change in state.uncommitted)
+    state.uncommitted = []
+    _cfbs_convert_git_commit(state, message)
+
+
+def _cfbs_convert_check_directory(non_interactive, offline, rules=None, jobs=None):
     """Ensure we're in a directory holding exactly one `masterfiles-*` subdir.
 
     Returns a fresh `_ConvertState` for the rest of the command to use.
@@ -1289,7 +987,7 @@ def _cfbs_convert_check_directory(non_interactive, offline):
         )
     dir_name = dir_content[0]
     path_string = "./" + dir_name + "/"
-    return _ConvertState(dir_name, path_string, non_interactive, offline)
+    return _ConvertState(dir_name, path_string, non_interactive, offline, rules, jobs)
 
 
 def _cfbs_convert_handle_git(state: _ConvertState):
@@ -1598,18 +1296,24 @@ def _cfbs_convert_convert_to_patch(
     modified_file,
     modified_file_path,
     first_patch_conversion,
+    file_diff_data=None,
 ):
     """Convert one modified file into a `.patch` under the patches module.
 
-    Returns the (possibly updated) `first_patch_conversion` flag.
+    file_diff_data is the diff, if it has already been computed.
+
+    Returns whether the file was converted (if saving the patch fails, the
+    modified file is kept as is), and the (possibly updated)
+    `first_patch_conversion` flag.
     """
     print("Converting './%s' into a patch file..." % modified_file)
     patches_dir = "custom-masterfiles-patches"
     patches_module = "./" + patches_dir + "/"
 
-    file_diff_data = file_diff_text(
-        mpf_filepath, modified_file_path, modified_file, modified_file
-    )
+    if file_diff_data is None:
+        file_diff_data = file_diff_text(
+            mpf_filepath, modified_file_path, modified_file, modified_file
+        )
 
     patch_filename = modified_file.replace("/", "_") + ".patch"
     patch_path = os.path.join(patches_dir, patch_filename)
@@ -1627,7 +1331,7 @@ def _cfbs_convert_convert_to_patch(
         log.warning(
             "Saving the patch file failed - keeping the modified file as is instead and continuing..."
         )
-        return first_patch_conversion  # unchanged: this file is effectively skipped
+        return False, first_patch_conversion
 
     # make the patches local module on first use
     if first_patch_conversion:
@@ -1649,21 +1353,23 @@ def _cfbs_convert_convert_to_patch(
     rm(modified_file_path)
 
     if first_patch_conversion:
-        _cfbs_convert_git_commit(
-            state,
+        state.uncommitted.append(
             "Added patches local module, converted './%s' into a .patch file"
-            % modified_file,
+            % modified_file
         )
     else:
-        _cfbs_convert_git_commit(
-            state, "Converted './%s' into a .patch file" % modified_file
-        )
+        state.uncommitted.append("Converted './%s' into a .patch file" % modified_file)
+
+    return True, False
 
-    return False
 
+def _cfbs_convert_handle_modified_files(
+    state: _ConvertState, checkpoint_files=_CONVERT_CHECKPOINT_FILES
+):
+    """Walk each custom-modified file and let the user drop / keep / patch it.
 
-def _cfbs_convert_handle_modified_files(state: _ConvertState):
-    """Walk each custom-modified file and let the user drop / keep / patch it."""
+    cfbs.json is written, and the changes committed, after every
+    checkpoint_files files (and at the end), not after each file."""
     assert state.analyzed_files is not None and state.masterfiles_version is not None
     dir_name = state.dir_name
     non_interactive = state.non_interactive
@@ -1679,61 +1385,159 @@ def _cfbs_convert_handle_modified_files(state: _ConvertState):
     for modified_file in modified_files:
         print("-", modified_file)
 
-    first_patch_conversion = True
-    for i, modified_file in enumerate(modified_files, start=1):
-        print("\nFile", i, "diff -", modified_file + ":")
-        mpf_dir_path = os.path.join(cfbs_dir(), "masterfiles")
-        mpf_version_dir_path = os.path.join(
-            mpf_dir_path, masterfiles_version, "tarball", "masterfiles"
-        )
-        mpf_filepath = os.path.join(mpf_version_dir_path, modified_file)
-        modified_file_path = os.path.join(dir_name, modified_file)
-
-        display_diffs = _cfbs_convert_show_diff(
-            state,
-            mpf_dir_path,
-            mpf_version_dir_path,
-            mpf_filepath,
-            modified_file_path,
-        )
+    if state.rules is not None:
+        _cfbs_convert_apply_rules(state, modified_files)
+        return
 
-        if i == 1:
-            if display_diffs:
-                print(
-                    "Above you can see the differences between your file and the default file."
-                )
-            print(
-                "As much as possible, we recommend getting rid of these custom modifications."
-            )
-            print(
-                "Usually, the same thing can be achieved by adding a variable to def.json, or through adding your own policy file (inside 'services/')."
+    with CFBSConfig.get_instance().transaction():
+        first_patch_conversion = True
+        for i, modified_file in enumerate(modified_files, start=1):
+            print("\nFile", i, "diff -", modified_file + ":")
+            mpf_dir_path = os.path.join(cfbs_dir(), "masterfiles")
+            mpf_version_dir_path = os.path.join(
+                mpf_dir_path, masterfiles_version, "tarball", "masterfiles"
             )
+            mpf_filepath = os.path.join(mpf_version_dir_path, modified_file)
+            modified_file_path = os.path.join(dir_name, modified_file)
 
-        prompt_str = "\nChoose an option:\n"
-        prompt_str += "1) Drop modifications - They are not important, or can be achieved in another way.\n"
-        prompt_str += "2) Keep modified file - File is kept as is, and can be handled later. Can make future upgrades more complicated.\n"
-        prompt_str += "3) Keep patch file - File is converted into a patch file (diff) that hopefully will apply to future versions as well.\n"
-        response = prompt_user(non_interactive, prompt_str, ["1", "2", "3"], "1")
-
-        if response == "1":
-            print("Deleting './%s'..." % modified_file)
-            rm(modified_file_path)
-            _cfbs_convert_git_commit(state, "Deleted './%s'" % modified_file)
-        elif response == "2":
-            print("Keeping file as is, nothing to do.")
-        elif response == "3":
-            first_patch_conversion = _cfbs_convert_convert_to_patch(
+            display_diffs = _cfbs_convert_show_diff(
                 state,
+                mpf_dir_path,
+                mpf_version_dir_path,
                 mpf_filepath,
-                modified_file,
                 modified_file_path,
-                first_patch_conversion,
             )
 
+            if i == 1:
+                if display_diffs:
+                    print(
+                        "Above you can see the differences between your file and the default file."
+                    )
+                print(
+                    "As much as possible, we recommend getting rid of these custom modifications."
+                )
+                print(
+                    "Usually, the same thing can be achieved by adding a variable to def.json, or through adding your own policy file (inside 'services/')."
+                )
+
+            prompt_str = "\nChoose an option:\n"
+            prompt_str += "1) Drop modifications - They are not important, or can be achieved in another way.\n"
+            prompt_str += "2) Keep modified file - File is kept as is, and can be handled later. Can make future upgrades more complicated.\n"
+            prompt_str += "3) Keep patch file - File is converted into a patch file (diff) that hopefully will apply to future versions as well.\n"
+            response = prompt_user(non_interactive, prompt_str, ["1", "2", "3"], "1")
+
+            if response == "1":
+                print("Deleting './%s'..." % modified_file)
+                rm(modified_file_path)
+                state.uncommitted.append("Deleted './%s'" % modified_file)
+            elif response == "2":
+                print("Keeping file as is, nothing to do.")
+            elif response == "3":
+                _, first_patch_conversion = _cfbs_convert_convert_to_patch(
+                    state,
+                    mpf_filepath,
+                    modified_file,
+                    modified_file_path,
+                    first_patch_conversion,
+                )
+
+            if i % checkpoint_files == 0:
+                _cfbs_convert_commit_batch(state)
+        _cfbs_convert_commit_batch(state)
+
+
+def _cfbs_convert_apply_rules(state: _ConvertState, modified_files):
+    """Handle the modified files according to state.rules, without prompts:
+    compute the diffs of the files to convert into patches (in parallel),
+    then apply all the actions, and commit them as one commit."""
+    assert state.rules is not None and state.masterfiles_version is not None
+    actions = [(f, state.rules.action(f)) for f in modified_files]
+    mpf_dir_path = os.path.join(cfbs_dir(), "masterfiles")
+    mpf_version_dir_path = os.path.join(
+        mpf_dir_path, state.masterfiles_version, "tarball", "masterfiles"
+    )
+
+    to_patch = [f for f, action in actions if action == CONVERT_PATCH]
+    if to_patch and not os.path.exists(mpf_version_dir_path):
+        try:
+            download_single_version(mpf_dir_path, state.masterfiles_version)
+        except Exception as e:
+            log.warning(
+                "Downloading original masterfiles failed (%s), keeping the files to convert into patches as they are."
+                % str(e)
+            )
+            to_patch = []
+    diffs = dict(
+        zip(
+            to_patch,
+            diff_files(
+                [
+                    (
+                        os.path.join(mpf_version_dir_path, f),
+                        os.path.join(state.dir_name, f),
+                        f,
+                    )
+                    for f in to_patch
+                ],
+                state.jobs,
+            ),
+        )
+    )
+
+    counts = {CONVERT_DROP: 0, CONVERT_KEEP: 0, CONVERT_PATCH: 0}
+    with CFBSConfig.get_instance().transaction():
+        first_patch_conversion = True
+        for modified_file, action in actions:
+            modified_file_path = os.path.join(state.dir_name, modified_file)
+            if action == CONVERT_PATCH:
+                diff, error = diffs.get(modified_file, (None, None))
+                if diff is None:
+                    if error is not None:
+                        log.warning(
+                            "Diffing './%s' failed (%s), keeping the modified file as is instead..."
+                            % (modified_file, error)
+                        )
+                    action = CONVERT_KEEP
+                else:
+                    converted, first_patch_conversion = _cfbs_convert_convert_to_patch(
+                        state,
+                        os.path.join(mpf_version_dir_path, modified_file),
+                        modified_file,
+                        modified_file_path,
+                        first_patch_conversion,
+                        diff,
+                    )
+                    if not converted:
+                        action = CONVERT_KEEP
+            if action == CONVERT_DROP:
+                print("Deleting './%s'..." % modified_file)
+                rm(modified_file_path)
+                state.uncommitted.append("Deleted './%s'" % modified_file)
+            elif action == CONVERT_KEEP:
+                print("Keeping './%s' as is." % modified_file)
+            counts[action] += 1
+        _cfbs_convert_commit_batch(state)
+    print(
+        "Deleted %d, kept %d and converted %d modified file(s) into patches."
+        % (counts[CONVERT_DROP], counts[CONVERT_KEEP], counts[CONVERT_PATCH])
+    )
+
 
 @cfbs_command("convert")
-def convert_command(non_interactive=False, offline=False):
-    state = _cfbs_convert_check_directory(non_interactive, offline)
+def convert_command(
+    non_interactive=False, offline=False, rules_filename=None, jobs=None
+):
+    """Convert a policy set into a project, see the _cfbs_convert_* steps.
+
+    With rules_filename (a JSON file, see convert_batch.py), modified files
+    are handled according to the rules in it, and no questions are asked
+    (like with non_interactive). jobs is the number of processes computing
+    the diffs of files converted into patches."""
+    rules = None
+    if rules_filename is not None:
+        rules = ConvertRules.load(rules_filename)
+        non_interactive = True
+    state = _cfbs_convert_check_directory(non_interactive, offline, rules, jobs)
 
     _cfbs_convert_handle_git(state)
 
@@ -1982,3 +1786,10 @@ def render_input_command(name, infile, outfile):
         log.error("Failed to write json: %s" % e)
         return 1
     return 0
+
+
+@cfbs_command("serve")
+def serve_command():
+    """Keep cfbs.json and the index in memory and answer read-only commands
+    (cfbs status, validate, info, search) on a Unix socket, see serve.py."""
+    return serve()
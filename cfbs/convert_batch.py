@@ -0,0 +1,113 @@
+"""Functions for running 'cfbs convert' non-interactively (--convert-rules)
+
+Interactively, cfbs convert shows the diff of each file with custom
+modifications, and asks whether to drop the modifications, keep the file,
+or convert it into a patch. With a rules file, the answer for each file is
+taken from the first rule matching its path, so a heavily customized policy
+set can be converted without any prompts. The rules file is JSON:
+
+    {
+      "rules": [
+        {"files": "services/*", "action": "keep"},
+        {"files": "lib/*.cf", "action": "patch"},
+        {"files": "*.md", "action": "drop"}
+      ],
+      "default": "keep"
+    }
+
+Patterns are fnmatch-style, matched against the path relative to the
+masterfiles directory, where * also matches /. Files not matching any rule
+get the default action ("keep" if not specified).
+
+The diffs of the files to convert into patches are computed in a pool of
+worker processes when there are many of them.
+"""
+
+import os
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from fnmatch import fnmatchcase
+from typing import List, Optional, Tuple
+
+from cfbs.diff import file_diff_text
+from cfbs.utils import CFBSExitError, read_json
+
+# Actions for modified files:
+DROP = "drop"  # Delete the file, dropping the modifications
+KEEP = "keep"  # Keep the modified file as is
+PATCH = "patch"  # Convert the file into a patch for the original file
+ACTIONS = (DROP, KEEP, PATCH)
+
+# Starting worker processes has a cost, only worth it for many files:
+MIN_FILES_FOR_PROCESS_POOL = 20
+
+
+class ConvertRules:
+    """Rules deciding what to do with each modified file, see the module
+    docstring for the format of the rules file."""
+
+    def __init__(self, rules: List[Tuple[str, str]], default: str = KEEP):
+        self.rules = rules
+        self.default = default
+
+    @classmethod
+    def load(cls, path: str) -> "ConvertRules":
+        data = read_json(path)
+        if data is None:
+            raise CFBSExitError("Convert rules file '%s' not found" % path)
+
+        def error(message):
+            return CFBSExitError(
+                "Invalid convert rules file '%s': %s" % (path, message)
+            )
+
+        if not isinstance(data, OrderedDict):
+            raise error("Expected a JSON object")
+        default = data.get("default", KEEP)
+        if default not in ACTIONS:
+            raise error("Invalid default action '%s'" % default)
+        if not isinstance(data.get("rules", []), list):
+            raise error('"rules" must be a list')
+        rules = []
+        for rule in data.get("rules", []):
+            if not isinstance(rule, OrderedDict) or not isinstance(
+                rule.get("files"), str
+            ):
+                raise error('Each rule must be an object with a "files" pattern')
+            if rule.get("action") not in ACTIONS:
+                raise error(
+                    "Invalid action '%s' for '%s', expected one of: %s"
+                    % (rule.get("action"), rule["files"], ", ".join(ACTIONS))
+                )
+            rules.append((rule["files"], rule["action"]))
+        return cls(rules, default)
+
+    def action(self, path: str) -> str:
+        """Action for a file (path relative to the masterfiles directory)"""
+        if path.startswith("./"):
+            path = path[2:]
+        for pattern, action in self.rules:
+            if fnmatchcase(path, pattern.lstrip("/")):
+                return action
+        return self.default
+
+
+def _diff_one(original, modified, name) -> Tuple[Optional[str], Optional[str]]:
+    try:
+        return file_diff_text(original, modified, name, name), None
+    except (OSError, UnicodeDecodeError) as e:
+        return None, str(e)
+
+
+def diff_files(
+    files: List[Tuple[str, str, str]], jobs: Optional[int] = None
+) -> List[Tuple[Optional[str], Optional[str]]]:
+    """Unified diffs of many (original, modified, name) files, returns
+    (diff, error) for each of them, in the same order."""
+    arguments = tuple(zip(*files)) or ((), (), ())
+    if len(files) >= MIN_FILES_FOR_PROCESS_POOL and jobs != 1:
+        workers = jobs or os.cpu_count() or 1
+        chunksize = max(1, len(files) // (workers * 4))
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(_diff_one, *arguments, chunksize=chunksize))
+    return list(map(_diff_one, *arguments))
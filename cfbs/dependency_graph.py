@@ -0,0 +1,218 @@
+"""Dependency graph of modules, based on their "dependencies" fields
+
+Used by cfbs add / remove / clean and validation to answer questions like
+"which modules depend on this one?" and "which modules are still needed?"
+with one traversal of the graph, instead of repeatedly looping over the
+build list.
+
+Circular dependencies are allowed (cfbs has never rejected them), so all
+traversals keep track of visited modules, and find_cycles() can be used to
+report them.
+
+Like validate.py, this module works on plain module objects (dicts) and
+should not depend on cfbs_json.py nor cfbs_config.py.
+"""
+
+from collections import OrderedDict
+from typing import Callable, Iterable, List, Set
+
+
+class DependencyGraph:
+    """Adjacency lists of module name -> dependencies and the reverse.
+
+    Can be created from a list of module objects with "name" fields (like
+    the "build" list), or a dictionary of name -> module object (like the
+    "index" and "provides" fields). When a name appears more than once,
+    the first module object wins, same as when searching the list.
+    """
+
+    def __init__(self, modules):
+        if isinstance(modules, dict):
+            items = modules.items()
+        else:
+            items = ((m.get("name"), m) for m in modules)
+
+        self._modules = OrderedDict()
+        self._dependencies = OrderedDict()
+        self._dependents = {}
+        for name, module in items:
+            if name in self._modules:
+                continue
+            self._modules[name] = module
+            dependencies = module.get("dependencies", [])
+            if not isinstance(dependencies, list):
+                dependencies = []
+            self._dependencies[name] = dependencies
+            for dependency in dependencies:
+                self._dependents.setdefault(dependency, []).append(name)
+
+    def __contains__(self, name):
+        return name in self._modules
+
+    def __len__(self):
+        return len(self._modules)
+
+    def names(self) -> List[str]:
+        return list(self._modules)
+
+    def module(self, name):
+        return self._modules.get(name)
+
+    def dependencies(self, name) -> list:
+        """Direct dependencies of a module, including ones not in the graph."""
+        return list(self._dependencies.get(name, []))
+
+    def dependents(self, name) -> list:
+        """Modules in the graph which directly depend on the given module."""
+        return list(self._dependents.get(name, []))
+
+    def _walk(self, starts, edges) -> Set[str]:
+        visited = set()
+        stack = list(starts)
+        while stack:
+            name = stack.pop()
+            if name in visited:
+                continue
+            visited.add(name)
+            stack.extend(edges.get(name, ()))
+        return visited
+
+    def reachable(self, roots: Iterable[str]) -> Set[str]:
+        """Names of all modules the roots (transitively) depend on, and the
+        roots themselves. Dependencies missing from the graph are included."""
+        return self._walk(roots, self._dependencies)
+
+    def all_dependents(self, name) -> Set[str]:
+        """Names of all modules which (transitively) depend on the given one.
+
+        The module itself is not included, even when it is part of a cycle.
+        """
+        found = self._walk(self._dependents.get(name, ()), self._dependents)
+        found.discard(name)
+        return found
+
+    def unused(self, is_root: Callable[[dict], bool]) -> list:
+        """Module objects not reachable from any root module, in graph order.
+
+        :param is_root: returns whether a module object is needed by itself,
+                        for example because the user added it explicitly
+        """
+        roots = (name for name, module in self._modules.items() if is_root(module))
+        needed = self.reachable(roots)
+        return [m for name, m in self._modules.items() if name not in needed]
+
+    def topological_order(self, names=None) -> List[str]:
+        """Names in an order where dependencies come before their dependents.
+
+        Uses a depth first post-order traversal, starting from `names` (all
+        modules by default) in the given order and following dependencies
+        in their listed order. Dependencies outside the graph are skipped.
+        Cycles can't be ordered, their modules are output in the order the
+        traversal reaches them.
+        """
+        if names is None:
+            names = self._modules.keys()
+        order = []
+        visited = set()
+        for start in names:
+            if start in visited or start not in self._modules:
+                continue
+            visited.add(start)
+            stack = [(start, iter(self._dependencies[start]))]
+            while stack:
+                name, remaining = stack[-1]
+                for dependency in remaining:
+                    if dependency not in visited and dependency in self._modules:
+                        visited.add(dependency)
+                        stack.append((dependency, iter(self._dependencies[dependency])))
+                        break
+                else:
+                    stack.pop()
+                    order.append(name)
+        return order
+
+    def find_cycles(self) -> List[List[str]]:
+        """Lists of module names which depend on each other in a cycle.
+
+        Each strongly connected component with more than one module, or a
+        module depending on itself, is one cycle (Tarjan's algorithm).
+        """
+        index_of = {}
+        lowlink = {}
+        on_stack = set()
+        stack = []
+        cycles = []
+        counter = 0
+
+        for start in self._modules:
+            if start in index_of:
+                continue
+            work = [(start, iter(self._dependencies[start]))]
+            index_of[start] = lowlink[start] = counter
+            counter += 1
+            stack.append(start)
+            on_stack.add(start)
+            while work:
+                name, remaining = work[-1]
+                for dependency in remaining:
+                    if dependency not in self._modules:
+                        continue
+                    if dependency not in index_of:
+                        index_of[dependency] = lowlink[dependency] = counter
+                        counter += 1
+                        stack.append(dependency)
+                        on_stack.add(dependency)
+                        work.append((dependency, iter(self._dependencies[dependency])))
+                        break
+                    if dependency in on_stack:
+                        lowlink[name] = min(lowlink[name], index_of[dependency])
+                else:
+                    work.pop()
+                    if work:
+                        parent = work[-1][0]
+                        lowlink[parent] = min(lowlink[parent], lowlink[name])
+                    if lowlink[name] == index_of[name]:
+                        component = []
+                        while True:
+                            member = stack.pop()
+                            on_stack.discard(member)
+                            component.append(member)
+                            if member == name:
+                                break
+                        if len(component) > 1 or name in self._dependencies[name]:
+                            component.reverse()
+                            cycles.append(component)
+        return cycles
+
+
+def resolve_dependencies(modules: list, present: Iterable[str], get_module) -> list:
+    """Find the module objects for all missing (transitive) dependencies.
+
+    :param modules: module objects about to be added
+    :param present: names of modules which are already there (e.g. in build)
+    :param get_module: function taking a dependency name and the name of
+                       the module depending on it, returning its module object
+    :return: module objects for the missing dependencies, ordered so that
+             dependencies come before the modules which depend on them
+    """
+    known = set(present)
+    known.update(m["name"] for m in modules)
+    found = OrderedDict()
+    queue = list(modules)
+    position = 0
+    while position < len(queue):
+        module = queue[position]
+        position += 1
+        for dependency in module.get("dependencies", []):
+            if dependency in known:
+                continue
+            known.add(dependency)
+            dependency_module = get_module(dependency, module["name"])
+            found[dependency] = dependency_module
+            queue.append(dependency_module)
+
+    if not found:
+        return []
+    graph = DependencyGraph(list(modules) + list(found.values()))
+    roots = [m["name"] for m in modules]
+    return [found[name] for name in graph.topological_order(roots) if name in found]
@@ -0,0 +1,389 @@
+"""Unified diffs of text files, for 'cfbs build --diffs' and the patch files
+created by 'cfbs convert'
+
+difflib.unified_diff() is slow on large files (its matching is worst-case
+quadratic), like the thousands of lines long policy files in masterfiles.
+Instead, there are a few diff backends to choose from, with the
+CFBS_DIFF_ALGORITHM environment variable:
+
+- "histogram" (default): Splits the files at the line which occurs the
+  fewest times in both (and the longest run of matching lines around it),
+  and continues with the parts before and after it. Lines which are common,
+  like empty lines and closing braces, don't end up aligned with each other
+  across unrelated changes, so the diffs are easier to read (the same
+  algorithm as git diff --histogram). Small parts without rare lines in
+  common are diffed with Myers' algorithm.
+- "myers": Myers' O((N+M)D) algorithm, the smallest diff (D is the number
+  of lines added and removed), fast when the files are similar.
+- "git": Runs git diff --no-index --histogram, falls back to "histogram"
+  when git is not installed.
+
+All backends produce the same format as difflib.unified_diff() (with 3
+lines of context), with a "\\ No newline at end of file" marker after a
+last line without a newline, so the output can be used with patch.
+"""
+
+import logging as log
+import os
+import shutil
+import subprocess
+from collections import OrderedDict
+from typing import Callable, Iterator, List, Optional, Sequence, Tuple  # noqa: F401
+
+from cfbs.utils import CFBSExitError, counted_subprocess
+
+HISTOGRAM = "histogram"
+MYERS = "myers"
+GIT = "git"
+DEFAULT_ALGORITHM = HISTOGRAM
+
+CONTEXT_LINES = 3
+
+# Lines occurring more often than this (in the part of the first file being
+# diffed) are not used for splitting in the histogram algorithm:
+_MAX_CHAIN_LENGTH = 64
+
+# Parts of the files (lines in both) without rare lines in common, larger
+# than this, are not diffed with Myers' algorithm in the histogram algorithm:
+_MAX_MYERS_LINES = 1000
+
+_NO_NEWLINE = "\\ No newline at end of file\n"
+
+_run = counted_subprocess(subprocess.run)
+
+
+def _trim(a, b, alo, ahi, blo, bhi, matches):
+    """Match the common prefix and suffix of a region, returns the rest"""
+    while alo < ahi and blo < bhi and a[alo] == b[blo]:
+        matches.append((alo, blo))
+        alo += 1
+        blo += 1
+    while alo < ahi and blo < bhi and a[ahi - 1] == b[bhi - 1]:
+        ahi -= 1
+        bhi -= 1
+        matches.append((ahi, bhi))
+    return alo, ahi, blo, bhi
+
+
+def _myers(a, b, alo, ahi, blo, bhi, matches):
+    """Add the matching lines (index in a, index in b) of the shortest edit
+    script between a[alo:ahi] and b[blo:bhi] to matches"""
+    alo, ahi, blo, bhi = _trim(a, b, alo, ahi, blo, bhi, matches)
+    n = ahi - alo
+    m = bhi - blo
+    if n == 0 or m == 0:
+        return
+
+    # v[offset + k] is the furthest x reached on diagonal k (y = x - k),
+    # trace[d] is v (diagonals -d..d) before step d, for backtracking:
+    offset = n + m + 1
+    v = [0] * (2 * offset + 1)
+    trace = []
+    for d in range(n + m + 1):
+        trace.append(v[offset - d : offset + d + 2])
+        done = False
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and v[offset + k - 1] < v[offset + k + 1]):
+                x = v[offset + k + 1]
+            else:
+                x = v[offset + k - 1] + 1
+            y = x - k
+            while x < n and y < m and a[alo + x] == b[blo + y]:
+                x += 1
+                y += 1
+            v[offset + k] = x
+            if x >= n and y >= m:
+                done = True
+                break
+        if done:
+            break
+
+    x, y = n, m
+    for d in range(len(trace) - 1, -1, -1):
+        saved = trace[d]  # diagonal k is at index k + d
+
+        def furthest(k):
+            return saved[k + d] if -d <= k <= d + 1 else -1
+
+        k = x - y
+        if k == -d or (k != d and furthest(k - 1) < furthest(k + 1)):
+            previous_k = k + 1
+        else:
+            previous_k = k - 1
+        previous_x = furthest(previous_k) if d > 0 else 0
+        previous_y = previous_x - previous_k if d > 0 else 0
+        while x > previous_x and y > previous_y:
+            x -= 1
+            y -= 1
+            matches.append((alo + x, blo + y))
+        x, y = previous_x, previous_y
+
+
+def _histogram(a, b, alo, ahi, blo, bhi, matches):
+    """Add the matching lines (index in a, index in b) of a[alo:ahi] and
+    b[blo:bhi] to matches, using the histogram algorithm (see the module
+    docstring)"""
+    regions = [(alo, ahi, blo, bhi)]
+    while regions:
+        alo, ahi, blo, bhi = _trim(a, b, *regions.pop(), matches=matches)
+        if alo == ahi or blo == bhi:
+            continue
+
+        positions = {}  # line -> indexes in a
+        for i in range(alo, ahi):
+            positions.setdefault(a[i], []).append(i)
+
+        best = None  # (sort key, length, start in a, start in b)
+        lowest = _MAX_CHAIN_LENGTH
+        common = False
+        j = blo
+        while j < bhi:
+            next_j = j + 1
+            found = positions.get(b[j])
+            if found is not None:
+                common = True
+            if found is not None and len(found) <= lowest:
+                for i in found:
+                    # Extend the match in both directions, counting the
+                    # fewest occurrences of the lines in it:
+                    start_a, start_b, end_a, end_b = i, j, i + 1, j + 1
+                    occurrences = len(found)
+                    while (
+                        start_a > alo
+                        and start_b > blo
+                        and a[start_a - 1] == b[start_b - 1]
+                    ):
+                        start_a -= 1
+                        start_b -= 1
+                        occurrences = min(occurrences, len(positions[a[start_a]]))
+                    while end_a < ahi and end_b < bhi and a[end_a] == b[end_b]:
+                        occurrences = min(occurrences, len(positions[a[end_a]]))
+                        end_a += 1
+                        end_b += 1
+                    # The lines up to end_b are part of this match, no need
+                    # to look for other matches starting at them:
+                    next_j = max(next_j, end_b)
+                    # Rarest lines first, then longest match, then closest
+                    # to the same position in both (repeated blocks):
+                    key = (
+                        occurrences,
+                        start_a - end_a,
+                        abs((start_a - alo) - (start_b - blo)),
+                    )
+                    if best is None or key < best[0]:
+                        best = (key, end_a - start_a, start_a, start_b)
+                        lowest = occurrences
+            j = next_j
+
+        if best is None:
+            # Only lines occurring too often in common (or none at all),
+            # Myers' algorithm is slow for large, very different parts, so
+            # those are simply replaced:
+            if common and (ahi - alo) + (bhi - blo) <= _MAX_MYERS_LINES:
+                _myers(a, b, alo, ahi, blo, bhi, matches)
+            continue
+        _, length, start_a, start_b = best
+        for offset in range(length):
+            matches.append((start_a + offset, start_b + offset))
+        regions.append((alo, start_a, blo, start_b))
+        regions.append((start_a + length, ahi, start_b + length, bhi))
+
+
+_LINE_ALGORITHMS = {HISTOGRAM: _histogram, MYERS: _myers}
+
+
+def matching_blocks(
+    a: Sequence[str], b: Sequence[str], algorithm: str = DEFAULT_ALGORITHM
+) -> List[Tuple[int, int, int]]:
+    """Matching lines of a and b, as (i, j, n) triples (a[i:i+n] equals
+    b[j:j+n]), like difflib.SequenceMatcher.get_matching_blocks(), ending
+    with (len(a), len(b), 0)."""
+    matches = []  # type: List[Tuple[int, int]]
+    _LINE_ALGORITHMS[algorithm](a, b, 0, len(a), 0, len(b), matches)
+    matches.sort()
+    blocks = []
+    for i, j in matches:
+        if (
+            blocks
+            and blocks[-1][0] + blocks[-1][2] == i
+            and (blocks[-1][1] + blocks[-1][2] == j)
+        ):
+            blocks[-1][2] += 1
+        else:
+            blocks.append([i, j, 1])
+    return [(i, j, n) for i, j, n in blocks] + [(len(a), len(b), 0)]
+
+
+def _grouped_opcodes(blocks, n):
+    """Hunks of changes with n lines of context, same as
+    difflib.SequenceMatcher.get_grouped_opcodes()"""
+    codes = []
+    i = j = 0
+    for ai, bj, size in blocks:
+        if i < ai or j < bj:
+            codes.append(("change", i, ai, j, bj))
+        if size:
+            codes.append(("equal", ai, ai + size, bj, bj + size))
+        i, j = ai + size, bj + size
+    if not codes:
+        codes = [("equal", 0, 1, 0, 1)]
+    if codes[0][0] == "equal":
+        tag, i1, i2, j1, j2 = codes[0]
+        codes[0] = tag, max(i1, i2 - n), i2, max(j1, j2 - n), j2
+    if codes[-1][0] == "equal":
+        tag, i1, i2, j1, j2 = codes[-1]
+        codes[-1] = tag, i1, min(i2, i1 + n), j1, min(j2, j1 + n)
+
+    group = []
+    for tag, i1, i2, j1, j2 in codes:
+        if tag == "equal" and i2 - i1 > n + n:
+            group.append((tag, i1, min(i2, i1 + n), j1, min(j2, j1 + n)))
+            yield group
+            group = []
+            i1, j1 = max(i1, i2 - n), max(j1, j2 - n)
+        group.append((tag, i1, i2, j1, j2))
+    if group and not (len(group) == 1 and group[0][0] == "equal"):
+        yield group
+
+
+def _format_range(start, stop):
+    beginning = start + 1
+    length = stop - start
+    if length == 1:
+        return "%d" % beginning
+    if not length:
+        beginning -= 1
+    return "%d,%d" % (beginning, length)
+
+
+def _line(prefix, line):
+    if line.endswith("\n"):
+        return prefix + line
+    return prefix + line + "\n" + _NO_NEWLINE
+
+
+def unified_diff(
+    a: Sequence[str],
+    b: Sequence[str],
+    name_a: str,
+    name_b: str,
+    algorithm: str = DEFAULT_ALGORITHM,
+    n: int = CONTEXT_LINES,
+) -> Iterator[str]:
+    """Unified diff of the lines a and b (with line endings), like
+    difflib.unified_diff(), using a faster algorithm (see the module
+    docstring)."""
+    started = False
+    for group in _grouped_opcodes(matching_blocks(a, b, algorithm), n):
+        if not started:
+            started = True
+            yield "--- %s\n" % name_a
+            yield "+++ %s\n" % name_b
+        first, last = group[0], group[-1]
+        yield "@@ -%s +%s @@\n" % (
+            _format_range(first[1], last[2]),
+            _format_range(first[3], last[4]),
+        )
+        for tag, i1, i2, j1, j2 in group:
+            if tag == "equal":
+                for line in a[i1:i2]:
+                    yield _line(" ", line)
+                continue
+            for line in a[i1:i2]:
+                yield _line("-", line)
+            for line in b[j1:j2]:
+                yield _line("+", line)
+
+
+def _read_lines(path):
+    with open(path) as f:
+        return f.readlines()
+
+
+def _line_backend(algorithm):
+    def diff(path_a, path_b, name_a, name_b):
+        return "".join(
+            unified_diff(
+                _read_lines(path_a), _read_lines(path_b), name_a, name_b, algorithm
+            )
+        )
+
+    return diff
+
+
+def _git_diff(path_a, path_b, name_a, name_b):
+    if shutil.which("git") is None:
+        log.debug("git not found, using the %s diff algorithm instead" % HISTOGRAM)
+        return _line_backend(HISTOGRAM)(path_a, path_b, name_a, name_b)
+    result = _run(
+        [
+            "git",
+            "-c",
+            "core.quotePath=false",
+            "diff",
+            "--no-index",
+            "--no-color",
+            "--no-ext-diff",
+            "--no-renames",
+            "--histogram",
+            "-U%d" % CONTEXT_LINES,
+            "--",
+            path_a,
+            path_b,
+        ],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    # Exit code 1 means the files are different:
+    if result.returncode not in (0, 1):
+        raise CFBSExitError(
+            "Failed to diff '%s' and '%s': %s"
+            % (path_a, path_b, result.stderr.decode("utf-8", "replace").strip())
+        )
+    output = result.stdout.decode("utf-8")
+    start = output.find("\n@@ ")
+    if start < 0:
+        return ""
+    # Replace git's headers (diff --git, index, and file names with a/ and
+    # b/ prefixes) with the same headers as the other backends:
+    return "--- %s\n+++ %s\n" % (name_a, name_b) + output[start + 1 :]
+
+
+# Diff backends, name -> function(path_a, path_b, name_a, name_b) returning
+# the unified diff of the files (empty string if they are the same):
+DIFF_BACKENDS = OrderedDict(
+    [
+        (HISTOGRAM, _line_backend(HISTOGRAM)),
+        (MYERS, _line_backend(MYERS)),
+        (GIT, _git_diff),
+    ]
+)  # type: OrderedDict[str, Callable[[str, str, str, str], str]]
+
+
+def diff_algorithm() -> str:
+    """The diff backend to use, from CFBS_DIFF_ALGORITHM, or the default"""
+    algorithm = os.environ.get("CFBS_DIFF_ALGORITHM") or DEFAULT_ALGORITHM
+    if algorithm not in DIFF_BACKENDS:
+        raise CFBSExitError(
+            "Unknown diff algorithm '%s' in CFBS_DIFF_ALGORITHM, expected one of: %s"
+            % (algorithm, ", ".join(DIFF_BACKENDS))
+        )
+    return algorithm
+
+
+def file_diff_text(
+    path_a: str,
+    path_b: str,
+    name_a: Optional[str] = None,
+    name_b: Optional[str] = None,
+    algorithm: Optional[str] = None,
+) -> str:
+    """Unified diff of two files, name_a and name_b are the file names to
+    put in the diff (default: the paths)."""
+    backend = DIFF_BACKENDS[algorithm or diff_algorithm()]
+    return backend(
+        path_a,
+        path_b,
+        path_a if name_a is None else name_a,
+        path_b if name_b is None else name_b,
+    )
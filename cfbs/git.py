@@ -11,12 +11,22 @@ See git_magic.py for more git related code.
 import os
 import itertools
 import tempfile
-import shutil
-from subprocess import check_call, check_output, run, PIPE, DEVNULL, CalledProcessError
+from collections import OrderedDict
+import subprocess
+from subprocess import PIPE, DEVNULL, CalledProcessError
 from typing import Iterable, Union
 
 from cfbs.prompts import prompt_user
-from cfbs.utils import CFBSExitError, are_paths_equal, cli_tool_present
+from cfbs.utils import (
+    CFBSExitError,
+    are_paths_equal,
+    cli_tool_present,
+    counted_subprocess,
+)
+
+check_call = counted_subprocess(subprocess.check_call)
+check_output = counted_subprocess(subprocess.check_output)
+run = counted_subprocess(subprocess.run)
 
 
 class CFBSGitError(Exception):
@@ -46,6 +56,39 @@ def ls_remote(remote, branch):
         return None
 
 
+def ls_remote_refs(remote):
+    """Returns all refs of a given remote (ref name -> object hash, in the
+    order git ls-remote lists them), listed with one git ls-remote.
+    Returns `None` in case of error (e.g. the remote does not exist).
+
+    Use match_ref() to find branches, like ls_remote() does.
+
+    :param remote: the remote to list
+    """
+    try:
+        output = check_output(["git", "ls-remote", remote]).decode()
+    except:
+        return None
+    refs = OrderedDict()
+    for line in output.splitlines():
+        if "\t" in line:
+            object_hash, ref = line.split("\t", 1)
+            refs[ref.strip()] = object_hash.strip()
+    return refs
+
+
+def match_ref(refs, pattern):
+    """Returns the hash of the first ref matching pattern (e.g. a branch
+    name), the same as ls_remote(remote, pattern) would, or `None`.
+
+    :param refs: refs returned by ls_remote_refs()
+    """
+    for ref, object_hash in refs.items():
+        if ref == pattern or ref.endswith("/" + pattern):
+            return object_hash
+    return None
+
+
 def is_git_repo(path=None):
     """Is the given path a Git repository?
 
@@ -273,12 +316,108 @@ def head_commit_hash(repo_path):
     return result.stdout.decode("utf-8").strip()
 
 
-# Ensure reproducibility when copying git repositories
-# 1. hard reset to specific commit
-# 2. remove untracked files
-# 3. remove .git directory
-def git_clean_reset(repo_path, commit):
-    run(["git", "reset", "--hard", commit], cwd=repo_path, check=True, stdout=DEVNULL)
-    run(["git", "clean", "-fxd"], cwd=repo_path, check=True, stdout=DEVNULL)
-    git_dir = os.path.join(repo_path, ".git")
-    shutil.rmtree(git_dir, ignore_errors=True)
+def git_init_bare(repo_path, url):
+    """Create a bare repository at repo_path, with url as its origin remote,
+    unless there already is one"""
+    if not os.path.exists(os.path.join(repo_path, "HEAD")):
+        os.makedirs(repo_path, exist_ok=True)
+        check_call(["git", "init", "--bare", "--quiet"], cwd=repo_path)
+    result = run(
+        ["git", "remote", "get-url", "origin"],
+        cwd=repo_path,
+        stdout=PIPE,
+        stderr=DEVNULL,
+    )
+    current = result.stdout.decode("utf-8").strip()
+    if result.returncode != 0:
+        check_call(["git", "remote", "add", "origin", url], cwd=repo_path)
+    elif current != url:
+        check_call(["git", "remote", "set-url", "origin", url], cwd=repo_path)
+
+
+# Ways to fetch a single commit, from the cheapest to the most compatible,
+# each one is tried until the commit is there:
+_FETCH_COMMIT_OPTIONS = (
+    # Shallow (no history) and partial (no files, those are fetched when
+    # needed, by git_export()), this needs the server to allow filters:
+    ["--depth=1", "--filter=blob:none"],
+    # Full history, for servers which don't allow shallow fetches:
+    [],
+)
+
+
+def git_fetch_commit(repo_path, commit) -> bool:
+    """Fetch a commit from the origin remote into a (bare) repository.
+
+    Only that commit (and its trees) is asked for, when the server allows it,
+    or that commit and its history, and as a last resort (some servers don't
+    allow fetching commits by hash) all branches and tags. A ref is kept for
+    the commit (refs/cfbs/<commit>), so git gc doesn't remove it.
+
+    Returns whether the commit was found.
+    """
+    ref = "refs/cfbs/" + commit
+    if treeish_exists(ref, repo_path):
+        return True
+    attempts = [
+        ["git", "fetch", "--quiet", "--no-tags"] + options + ["origin", commit]
+        for options in _FETCH_COMMIT_OPTIONS
+    ]
+    attempts.append(
+        [
+            "git",
+            "fetch",
+            "--quiet",
+            "origin",
+            "+refs/heads/*:refs/heads/*",
+            "+refs/tags/*:refs/tags/*",
+        ]
+    )
+    if not treeish_exists(commit + "^{commit}", repo_path):
+        for command in attempts:
+            run(command, cwd=repo_path, stdout=DEVNULL, stderr=DEVNULL)
+            if treeish_exists(commit + "^{commit}", repo_path):
+                break
+        else:
+            return False
+    check_call(["git", "update-ref", ref, commit], cwd=repo_path)
+    return True
+
+
+def git_export(repo_path, treeish, destination, paths=None):
+    """Write the files of a commit (or tree) to the destination directory,
+    the same files as a checkout, but without a .git directory.
+
+    :param paths: only export these files / directories (the ones which
+                  exist), in partial clones only their content is fetched
+
+    Works with bare repositories, using a temporary index, instead of the
+    repository's own index, so exports from the same repository can run at
+    the same time."""
+    os.makedirs(destination, exist_ok=True)
+    if paths is not None:
+        result = run(
+            ["git", "ls-tree", "--name-only", "-z", treeish, "--"] + list(paths),
+            cwd=repo_path,
+            stdout=PIPE,
+            check=True,
+        )
+        paths = [path for path in result.stdout.decode("utf-8").split("\0") if path]
+        if not paths:
+            return
+    with tempfile.TemporaryDirectory(prefix="cfbs-export-") as temporary:
+        env = dict(os.environ, GIT_INDEX_FILE=os.path.join(temporary, "index"))
+        command = [
+            "git",
+            "--work-tree=" + os.path.abspath(destination),
+            "checkout",
+            "--quiet",
+            treeish,
+            "--",
+        ]
+        try:
+            check_call(command + (paths or ["."]), cwd=repo_path, env=env)
+        except CalledProcessError as e:
+            raise CFBSGitError(
+                "Failed to export '%s' from '%s'" % (treeish, repo_path)
+            ) from e
@@ -0,0 +1,263 @@
+"""Shared HTTP(S) client for all cfbs downloads
+
+urllib.request.urlopen() opens a new connection (TCP and TLS handshakes)
+for every request, so downloading many modules from the same host spends a
+lot of time just connecting. HTTPClient keeps idle connections open per host
+(HTTP/1.1 keep-alive) and reuses them for the next request to that host.
+
+It also:
+- Limits the number of concurrent connections per host (requests wait for a
+  free connection), downloads can run in many threads at once.
+- Retries requests which fail before a response is received (connection
+  errors, timeouts), and responses with 429 / 5xx status codes, waiting a
+  bit longer between each attempt (exponential backoff).
+- Uses a timeout for connecting and for each read, so a stuck server makes
+  cfbs fail instead of hanging forever.
+- Follows redirects.
+
+Requests through a proxy (http_proxy / https_proxy / all_proxy environment
+variables) are left to urllib, which knows how to use them.
+
+Use get_http_client() for the client shared by all of cfbs, utils.py has the
+higher level functions (get_json(), fetch_url(), open_url()) using it.
+"""
+
+import http.client
+import logging as log
+import os
+import threading
+import time
+from collections import defaultdict
+from typing import Optional
+from urllib.parse import urljoin, urlsplit
+
+from cfbs.utils import CFBSNetworkError
+from cfbs.version import string as version_string
+
+DEFAULT_TIMEOUT = 60.0  # Seconds, for connecting, and for each read
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF = 0.5  # Seconds before the first retry, doubled for each retry
+DEFAULT_MAX_CONNECTIONS = 8  # Per host
+
+_RETRY_STATUSES = (429, 500, 502, 503, 504)
+_REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+_MAX_REDIRECTS = 10
+
+
+def _env_number(name, default, convert=float):
+    value = os.environ.get(name)
+    if not value:
+        return default
+    try:
+        return convert(value)
+    except ValueError:
+        log.warning("Ignoring invalid value '%s' for %s" % (value, name))
+        return default
+
+
+def _proxy_configured(scheme) -> bool:
+    return any(
+        os.environ.get(name)
+        for variable in (scheme + "_proxy", "all_proxy")
+        for name in (variable, variable.upper())
+    )
+
+
+class HTTPResponse:
+    """Response to a GET request, read the body with read(), then close() it
+    (or use it as a context manager), to give the connection back to the
+    client. Connections of responses which weren't read to the end are
+    closed, not reused."""
+
+    def __init__(self, client, key, connection, response, url):
+        self._client = client
+        self._key = key
+        self._connection = connection
+        self._response = response
+        self.url = url
+        self.status = response.status
+        self.reason = response.reason
+        self.headers = response.headers
+
+    def read(self, size=-1) -> bytes:
+        try:
+            if size is None or size < 0:
+                return self._response.read()
+            return self._response.read(size)
+        except http.client.HTTPException as e:
+            raise CFBSNetworkError("Failed to fetch '%s': %s" % (self.url, e)) from e
+
+    def close(self):
+        if self._connection is None:
+            return
+        connection = self._connection
+        self._connection = None
+        reusable = self._response.isclosed() and not self._response.will_close
+        self._response.close()
+        self._client._release(self._key, connection, reusable)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class HTTPClient:
+    """Thread-safe HTTP(S) client, keeping connections open for reuse.
+
+    :param timeout: seconds, default from CFBS_HTTP_TIMEOUT, or 60
+    :param retries: how many times to retry a failed request, default from
+                    CFBS_HTTP_RETRIES, or 3
+    :param backoff: seconds to wait before the first retry, doubled for each
+                    following retry
+    :param max_connections: maximum number of connections to each host
+    """
+
+    def __init__(
+        self,
+        timeout: Optional[float] = None,
+        retries: Optional[int] = None,
+        backoff: float = DEFAULT_BACKOFF,
+        max_connections: int = DEFAULT_MAX_CONNECTIONS,
+    ):
+        if timeout is None:
+            timeout = _env_number("CFBS_HTTP_TIMEOUT", DEFAULT_TIMEOUT)
+        if retries is None:
+            retries = _env_number("CFBS_HTTP_RETRIES", DEFAULT_RETRIES, int)
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_connections = max_connections
+        self.headers = {
+            "User-Agent": os.environ.get("CFBS_USER_AGENT")
+            or "cfbs/%s" % version_string()
+        }
+        self._lock = threading.Lock()
+        self._idle = defaultdict(list)  # (scheme, host, port) -> connections
+        self._slots = {}  # (scheme, host, port) -> BoundedSemaphore
+        self._ssl_context = None
+
+    def _slot(self, key):
+        with self._lock:
+            if key not in self._slots:
+                self._slots[key] = threading.BoundedSemaphore(self.max_connections)
+            return self._slots[key]
+
+    def _connect(self, key):
+        """An idle connection to reuse, or a new one, and whether it is reused"""
+        with self._lock:
+            if self._idle[key]:
+                return self._idle[key].pop(), True
+        scheme, host, port = key
+        if scheme == "http":
+            return http.client.HTTPConnection(host, port, timeout=self.timeout), False
+        with self._lock:
+            if self._ssl_context is None:
+                import ssl
+
+                # Loading the CA certificates is slow, only do it once:
+                self._ssl_context = ssl.create_default_context()
+            context = self._ssl_context
+        connection = http.client.HTTPSConnection(
+            host, port, timeout=self.timeout, context=context
+        )
+        return connection, False
+
+    def _release(self, key, connection, reusable):
+        if reusable:
+            with self._lock:
+                self._idle[key].append(connection)
+        else:
+            connection.close()
+        self._slot(key).release()
+
+    def _get_once(self, url, headers) -> HTTPResponse:
+        """GET url, retrying when it fails, without following redirects"""
+        parts = urlsplit(url)
+        if parts.scheme not in ("http", "https") or not parts.hostname:
+            raise CFBSNetworkError("Unsupported URL '%s'" % url)
+        key = (parts.scheme, parts.hostname, parts.port)
+        path = (parts.path or "/") + ("?" + parts.query if parts.query else "")
+        headers = dict(self.headers, **(headers or {}))
+
+        attempt = 0
+        while True:
+            slot = self._slot(key)
+            slot.acquire()
+            connection, reused = self._connect(key)
+            try:
+                connection.request("GET", path, headers=headers)
+                response = HTTPResponse(
+                    self, key, connection, connection.getresponse(), url
+                )
+            except (OSError, http.client.HTTPException) as e:
+                self._release(key, connection, False)
+                if reused:
+                    # The server closed the idle connection, not an error:
+                    continue
+                error = str(e) or type(e).__name__
+            else:
+                if response.status not in _RETRY_STATUSES or attempt >= self.retries:
+                    return response
+                response.read()
+                response.close()
+                error = "HTTP %s %s" % (response.status, response.reason)
+
+            if attempt >= self.retries:
+                raise CFBSNetworkError("Failed to fetch '%s': %s" % (url, error))
+            delay = self.backoff * 2**attempt
+            log.debug("Retrying '%s' in %.1f seconds: %s" % (url, delay, error))
+            time.sleep(delay)
+            attempt += 1
+
+    def get(self, url: str, headers=None):
+        """Send a GET request, returns the response (HTTPResponse, or the
+        urllib response when using a proxy), with any status code. Raises
+        CFBSNetworkError when there is no response (after retrying)."""
+        if _proxy_configured(urlsplit(url).scheme):
+            return self._urllib_get(url, dict(self.headers, **(headers or {})))
+        for _ in range(_MAX_REDIRECTS + 1):
+            response = self._get_once(url, headers)
+            location = response.headers.get("Location")
+            if response.status not in _REDIRECT_STATUSES or not location:
+                return response
+            response.read()
+            response.close()
+            url = urljoin(url, location)
+        raise CFBSNetworkError("Failed to fetch '%s': Too many redirects" % url)
+
+    def _urllib_get(self, url, headers):
+        # urllib.request (with email, ...) is slow to import, only import it
+        # when it is needed:
+        import urllib.request  # needed on some platforms
+        import urllib.error
+
+        request = urllib.request.Request(url, headers=headers)
+        try:
+            return urllib.request.urlopen(request, timeout=self.timeout)
+        except urllib.error.HTTPError as e:
+            return e  # Like HTTPClient responses, which can have any status
+        except urllib.error.URLError as e:
+            raise CFBSNetworkError("Failed to fetch '%s': %s" % (url, e)) from e
+
+    def close(self):
+        """Close all idle connections"""
+        with self._lock:
+            idle = [c for connections in self._idle.values() for c in connections]
+            self._idle.clear()
+        for connection in idle:
+            connection.close()
+
+
+_default_client = None  # type: Optional[HTTPClient]
+_default_client_lock = threading.Lock()
+
+
+def get_http_client() -> HTTPClient:
+    """The HTTPClient shared by all of cfbs (and all threads)"""
+    global _default_client
+    with _default_client_lock:
+        if _default_client is None:
+            _default_client = HTTPClient()
+        return _default_client
@@ -1,5 +1,6 @@
 import sys
 import os
+import threading
 from collections import OrderedDict
 from typing import List, Optional, Union
 
@@ -100,12 +101,41 @@ def _generate_absolute_module_object(module_name: str, version: Optional[str]):
     return _absolute_module_data(module_name, version)
 
 
+_default_index = None  # type: Optional[Index]
+_default_index_lock = threading.Lock()
+
+
+def get_default_index() -> "Index":
+    """The default index, shared by all projects (cfbs.json files) in this
+    process which don't specify another index.
+
+    It is downloaded once, when first needed, and then kept in memory, which
+    for a long running process (cfbs serve) means until reset_default_index().
+    """
+    global _default_index
+    with _default_index_lock:
+        if _default_index is None:
+            _default_index = Index()
+        return _default_index
+
+
+def reset_default_index():
+    """Make the next get_default_index() download the index again."""
+    global _default_index
+    with _default_index_lock:
+        _default_index = None
+
+
 class Index:
     """Class representing the cfbs.json containing the index of available modules"""
 
     def __init__(self, index=_DEFAULT_INDEX):
         self._unexpanded = index
         self._data = None
+        self._versions = None
+        # The same index can be shared by threads (e.g. validating many
+        # projects at once), make sure it's only downloaded / read once:
+        self._lock = threading.Lock()
 
     def __contains__(self, key):
         return key in self.data["index"]
@@ -146,10 +176,28 @@ class Index:
     @property
     def data(self) -> dict:
         if not self._data:
-            self._expand_index()
+            with self._lock:
+                if not self._data:
+                    self._expand_index()
         assert self._data, "_expand_index() should have set _data"
         return self._data
 
+    @property
+    def versions(self) -> dict:
+        """The version index (all versions of all modules), downloaded the
+        first time it is needed, and then kept for the lifetime of this
+        Index (see get_default_index())."""
+        if self._versions is None:
+            with self._lock:
+                if self._versions is None:
+                    try:
+                        self._versions = get_json(_VERSION_INDEX)
+                    except CFBSNetworkError:
+                        raise CFBSExitError(
+                            "Downloading CFEngine Build Module Index failed - check your Wi-Fi / network settings."
+                        )
+        return self._versions
+
     @property
     def custom_index(self) -> Union[str, None]:
         # Index can be initialized with a dict or OrderedDict instead of a url string
@@ -171,13 +219,7 @@ class Index:
             return True
         if not version:
             return name in self
-        try:
-            versions = get_json(_VERSION_INDEX)
-        except CFBSNetworkError:
-            raise CFBSExitError(
-                "Downloading CFEngine Build Module Index failed - check your Wi-Fi / network settings."
-            )
-
+        versions = self.versions
         return name in versions and version in versions[name]
 
     def check_existence(self, modules: list):
@@ -251,12 +293,9 @@ class Index:
                 return default
             object = self[name]
             if version:
-                try:
-                    versions = get_json(_VERSION_INDEX)
-                except CFBSNetworkError:
-                    raise CFBSExitError(
-                        "Downloading CFEngine Build Module Index failed - check your Wi-Fi / network settings."
-                    )
+                versions = self.versions
+                # Don't modify the index, it can be used again (and shared):
+                object = OrderedDict(object)
                 if name not in versions or version not in versions[name]:
                     return default
                 new_values = versions[name][version]
@@ -1,39 +1,53 @@
 """Business logic related to downloading, copying, extracting files
 
-The functions here use git clone, rsync, tar, etc. to make the necessary
+The functions here use git fetch, tarfile, zipfile, etc. to make the necessary
 file system changes for cfbs add / cfbs download / cfbs build to work.
 
 The functions here are quite "contained", they don't rely on the
 global config (read and writen to cfbs.json), just their parameters
-and what is on the file system (in ~/.cache/cfengine and ./out).
+and what is on the file system (in ~/.cache/cfengine and the output
+directory, ./out by default).
 """
 
 import os
 import re
 import shutil
+import tarfile
+import tempfile
+import threading
+import zipfile
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional
 
-from cfbs.git import ls_remote, treeish_exists
+from cfbs.git import (
+    git_export,
+    git_fetch_commit,
+    git_init_bare,
+    ls_remote_refs,
+    match_ref,
+)
 from cfbs.utils import (
     cfbs_dir,
+    checksum_hash,
     cp,
-    fetch_url,
+    open_url,
     CFBSNetworkError,
     is_a_commit_hash,
     mkdir,
     pad_right,
     rm,
-    sh,
     strip_right,
+    touch,
     CFBSExitError,
 )
 
-from cfbs.git import git_clean_reset
-
 _SUPPORTED_TAR_TYPES = (".tar.gz", ".tgz")
 SUPPORTED_ARCHIVES = (".zip",) + _SUPPORTED_TAR_TYPES
 SUPPORTED_URI_SCHEMES = ("https://", "ssh://", "git://")
 
+_CHUNK_SIZE = 512 * 1024  # 512 KiB
+
 
 def local_module_name(module_path: str):
     assert os.path.exists(module_path)
@@ -116,44 +130,61 @@ def _prettify_name(name):
     return name
 
 
-def local_module_copy(module, counter, max_length):
+def project_path(project_dir: Optional[str], path: str) -> str:
+    """Path of something in a project (like a local module, "./name"), as
+    seen from the current working directory.
+
+    project_dir None (or ".") means the project is the current working
+    directory, and the path is returned unchanged."""
+    if project_dir in (None, "", "."):
+        return path
+    return os.path.join(project_dir, path)
+
+
+def local_module_copy(module, counter, max_length, out_dir="out", project_dir=None):
+    """Copy a local module into the output directory, returns the line to print"""
     name = module["name"]
     if not name.startswith("./"):
         raise CFBSExitError("module %s must start with ./" % name)
-    if not os.path.isfile(name) and not os.path.isdir(name):
+    path = project_path(project_dir, name)
+    if not os.path.isfile(path) and not os.path.isdir(path):
         raise CFBSExitError("module %s does not exist" % name)
     pretty_name = _prettify_name(name)
-    target = "out/steps/%03d_%s_local/" % (counter, pretty_name)
+    target = os.path.join(out_dir, "steps", "%03d_%s_local/" % (counter, pretty_name))
     module["_directory"] = target
     module["_counter"] = counter
     if name.endswith(("/", "/.")):
         # If this is a local folder, the target should be a copy of the folder
         # (Don't create an extra unnecessary subfolder)
-        cp(name, target)
+        cp(path, target)
     else:
         # If this is not a folder it is a file
         # create a copy of that file in the target folder
-        cp(name, target + name)
-    print(
-        "%03d %s @ local                                    (Copied)"
-        % (counter, pad_right(name, max_length))
+        cp(path, target + name)
+    return "%03d %s @ local                                    (Copied)" % (
+        counter,
+        pad_right(name, max_length),
     )
 
 
-def absolute_module_copy(module, counter, max_length):
+def absolute_module_copy(module, counter, max_length, out_dir="out"):
+    """Copy an absolute module into the output directory, returns the line
+    to print"""
     assert "commit" in module
     name = module["name"]
     pretty_name = _prettify_name(name)
-    target = "out/steps/%03d_%s_local/" % (counter, pretty_name)
+    target = os.path.join(out_dir, "steps", "%03d_%s_local/" % (counter, pretty_name))
     module["_directory"] = target
     module["_counter"] = counter
 
-    cp(name, target)
-    git_clean_reset(target, module["commit"])
+    # Only the files of the commit, straight from the git objects, without
+    # copying the repository (.git) or the uncommitted changes in it:
+    git_export(name, module["commit"], target)
 
-    print(
-        "%03d %s @ %s                                  (Copied)"
-        % (counter, pad_right(name, max_length), module["commit"][:7])
+    return "%03d %s @ %s                                  (Copied)" % (
+        counter,
+        pad_right(name, max_length),
+        module["commit"][:7],
     )
 
 
@@ -177,21 +208,114 @@ def _get_path_from_url(url):
     return path
 
 
-def _clone_and_checkout(url, path, treeish):
-    # NOTE: If any of these shell (git) commands fail, we will exit
-    if not os.path.exists(os.path.join(path, ".git")):
-        sh("git clone --no-checkout %s %s" % (url, path))
-    if not treeish_exists(treeish, path):
-        raise CFBSExitError("%s not found in %s" % (treeish, url))
+# Locks for things only one thread at a time should do, like fetching into
+# a bare repository, or listing the refs of a remote (key -> lock):
+_locks = {}
+_locks_lock = threading.Lock()
+
+# Refs of remotes, listed once per command (remote URL -> refs), commands
+# resolving branches call forget_remote_refs() first, since the process can
+# run many commands (cfbs serve, the Project API, tests):
+_remote_refs = {}
+
 
-    sh("git checkout " + treeish, directory=path)
+def _lock(key) -> threading.Lock:
+    with _locks_lock:
+        return _locks.setdefault(key, threading.Lock())
+
+
+def _mirror_path(url) -> str:
+    if url.startswith("file://"):
+        path = url[len("file://") :]
+    else:
+        path = _get_path_from_url(url)
+    path = strip_right(path, ".git").lstrip("/")
+    return os.path.join(cfbs_dir(), "mirrors", path + ".git")
+
+
+def _sparse_marker(path) -> str:
+    return os.path.join(os.path.dirname(path), "." + os.path.basename(path) + ".sparse")
+
+
+def is_partial_export(path) -> bool:
+    """Whether path only has some of the files of a commit or archive,
+    exported by export_git_commit() with paths, or extracted by
+    fetch_archive() with a subdirectory"""
+    return os.path.exists(_sparse_marker(path))
+
+
+def export_git_commit(url, commit, path, paths=None):
+    """Put the files of a commit from the git repository at url in path (in
+    the download cache), unless they are there already.
+
+    Instead of cloning the repository for each commit, there is one bare
+    repository (mirror) per remote, in the mirrors folder of the cfbs
+    directory. Only the missing commits are fetched into it, shallow and
+    partial (without file contents) when the server allows it, falling back
+    to fetching the full history. Files are exported from it (without .git),
+    into a temporary directory, which is renamed to path when complete.
+
+    :param paths: only export these files / directories (for modules in a
+                  subdirectory), and cfbs.json, for a partial mirror only
+                  their content is downloaded. Files of later exports of the
+                  same commit are added next to them.
+    """
+    marker = _sparse_marker(path)
+    if paths is None:
+        if os.path.isdir(path) and os.listdir(path) and not is_partial_export(path):
+            return
+    else:
+        paths = [p.strip("/") for p in paths] + ["cfbs.json"]
+        if os.path.isdir(path) and all(
+            os.path.exists(os.path.join(path, p)) for p in paths
+        ):
+            return
+    mirror = _mirror_path(url)
+    with _lock(mirror):
+        git_init_bare(mirror, url)
+        if not git_fetch_commit(mirror, commit):
+            raise CFBSExitError("%s not found in %s" % (commit, url))
+        parent = os.path.dirname(path)
+        mkdir(parent)
+        temporary = tempfile.mkdtemp(prefix=".cfbs-export-", dir=parent)
+        try:
+            git_export(mirror, commit, temporary, paths)
+            if paths is not None and not os.path.exists(path):
+                touch(marker)  # Before the (incomplete) files are in place
+            _move_new(temporary, path)
+            if paths is None:
+                rm(marker, missing_ok=True)
+        finally:
+            rm(temporary, missing_ok=True)
+
+
+def resolve_remote_reference(url, reference) -> Optional[str]:
+    """The commit a branch (or other ref) of a remote points to, or None.
+
+    All refs of a remote are listed with one git ls-remote, the first time
+    one of them is needed, and reused until forget_remote_refs(), so modules
+    from the same remote don't each run git ls-remote."""
+    with _lock(("refs", url)):
+        if url not in _remote_refs:
+            _remote_refs[url] = ls_remote_refs(url)
+        refs = _remote_refs[url]
+    if refs is None:
+        return None
+    return match_ref(refs, reference)
+
+
+def forget_remote_refs():
+    """Make resolve_remote_reference() list the refs of remotes again, call
+    this at the start of each command resolving branches, so they are not
+    resolved to the commits they pointed to in an earlier command."""
+    _remote_refs.clear()
 
 
 def clone_url_repo(repo_url: str, reference: Optional[str] = None):
-    """Clones a Git repository at `repo_url` URL, optionally checking out the `reference` commit or branch.
-    If `reference` is `None`, the repository's default branch will be used for the checkout.
+    """Downloads a Git repository at `repo_url` URL, optionally the `reference` commit or branch.
+    If `reference` is `None`, the repository's default branch will be used.
 
-    Returns path to the `cfbs.json` located in the cloned Git repository, and the Git commit hash.
+    Returns path to the `cfbs.json` located in the downloaded files, and the Git commit hash.
     """
     assert repo_url.startswith(SUPPORTED_URI_SCHEMES)
     assert "@" not in repo_url or (repo_url.rindex("@") < repo_url.rindex("."))
@@ -211,14 +335,16 @@ def clone_url_repo(repo_url: str, reference: Optional[str] = None):
         commit = reference
     else:
         # `reference` is a branch
-        commit = ls_remote(repo_url, reference)
+        commit = resolve_remote_reference(repo_url, reference)
         if commit is None:
             raise CFBSExitError(
                 "Failed to find branch %s at %s" % (reference, repo_url)
             )
 
     commit_path = os.path.join(repo_dir, commit)
-    _clone_and_checkout(repo_url, commit_path, commit)
+    # Only cfbs.json is needed to add modules, the rest is downloaded when
+    # building:
+    export_git_commit(repo_url, commit, commit_path, paths=[])
 
     json_path = os.path.join(commit_path, "cfbs.json")
     if os.path.exists(json_path):
@@ -229,93 +355,278 @@ def clone_url_repo(repo_url: str, reference: Optional[str] = None):
         )
 
 
+def clone_url_repos(references, jobs: Optional[int] = None) -> dict:
+    """clone_url_repo() for many (URL, reference) pairs at once, returns a
+    dict of (URL, reference) -> what clone_url_repo() returns.
+
+    The pairs are grouped by remote, the refs of each remote are listed once,
+    and the remotes are handled at the same time (in up to jobs threads).
+    """
+    groups = OrderedDict()  # type: OrderedDict[str, list]
+    for url, reference in references:
+        group = groups.setdefault(url, [])
+        if reference not in group:
+            group.append(reference)
+
+    def clone_group(url):
+        return [
+            ((url, reference), clone_url_repo(url, reference))
+            for reference in groups[url]
+        ]
+
+    if jobs == 1 or len(groups) <= 1:
+        results = [clone_group(url) for url in groups]
+    else:
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            results = list(executor.map(clone_group, groups))
+    return dict(pair for group in results for pair in group)
+
+
+class _HashingReader:
+    """File-like wrapper around a download (HTTP response), hashing all the
+    data read from it"""
+
+    def __init__(self, f, sha):
+        self.f = f
+        self.sha = sha
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.sha.update(data)
+        return data
+
+    def drain(self):
+        """Read (and hash) the rest, archive readers can stop before the end"""
+        while self.read(_CHUNK_SIZE):
+            pass
+
+
+def _member_parts(archive, name: str) -> list:
+    """Split the path of an archive member into its parts, rejecting paths
+    which would end up outside of the extraction directory."""
+    path = name.replace("\\", "/")
+    parts = [part for part in path.split("/") if part not in ("", ".")]
+    if path.startswith("/") or ".." in parts or re.match(r"^[A-Za-z]:", path):
+        raise CFBSExitError(
+            "Refusing to extract '%s' from '%s', it is outside of the archive"
+            % (name, archive)
+        )
+    return parts
+
+
+class _MemberFilter:
+    """Decides which members of an archive to extract, everything, or only a
+    subdirectory (and cfbs.json) of the module(s) in the archive.
+
+    The subdirectory is relative to the root of the archive, or to its
+    top-level directory, when it has one (like archives from GitHub).
+    """
+
+    def __init__(self, archive, subdirectory=None):
+        self.archive = archive
+        self.subdirectory = None
+        if subdirectory:
+            self.subdirectory = _member_parts(archive, subdirectory)
+        self.top = None  # First directory in the archive
+
+    def wanted(self, name: str) -> bool:
+        parts = _member_parts(self.archive, name)
+        if not parts:
+            return False
+        if self.top is None:
+            self.top = parts[0]
+        if self.subdirectory is None:
+            return True
+        candidates = [parts]
+        if parts[0] == self.top:
+            candidates.append(parts[1:])
+        length = len(self.subdirectory)
+        return any(
+            c[0:length] == self.subdirectory or c == ["cfbs.json"] for c in candidates
+        )
+
+
+def _tar_members(tar, member_filter: _MemberFilter):
+    for member in tar:
+        if not member_filter.wanted(member.name):
+            continue
+        if member.issym():
+            target = os.path.normpath(
+                os.path.join(os.path.dirname(member.name), member.linkname)
+            )
+            if os.path.isabs(member.linkname) or target.split(os.sep)[0] == "..":
+                raise CFBSExitError(
+                    "Refusing to extract '%s' from '%s', it links outside of the archive"
+                    % (member.name, member_filter.archive)
+                )
+        elif member.islnk():
+            _member_parts(member_filter.archive, member.linkname)
+        elif not (member.isfile() or member.isdir()):
+            continue  # Devices, FIFOs, etc. have no place in a policy set
+        yield member
+
+
+def _extract_tar(reader, destination, member_filter: _MemberFilter):
+    """Extract a (compressed) tar archive while it is being read from reader,
+    in one pass, without seeking (stream mode)."""
+    with tarfile.open(fileobj=reader, mode="r|*") as tar:
+        members = _tar_members(tar, member_filter)
+        if hasattr(tarfile, "tar_filter"):
+            # The paths are checked already, the filter is the same as the
+            # tar command line tool, avoiding a warning in newer Pythons:
+            tar.extractall(destination, members, filter="tar")
+        else:
+            tar.extractall(destination, members)
+    reader.drain()
+
+
+def _extract_zip(reader, destination, member_filter: _MemberFilter):
+    """Extract a zip archive from reader, zip files can't be read in one pass
+    (the list of files is at the end), so it is saved to a file first."""
+    archive_path = destination + ".zip"
+    with open(archive_path, "wb") as f:
+        shutil.copyfileobj(reader, f, _CHUNK_SIZE)
+    with zipfile.ZipFile(archive_path) as archive:
+        for info in archive.infolist():
+            if not member_filter.wanted(info.filename):
+                continue
+            path = archive.extract(info, destination)
+            # zipfile doesn't restore permissions (unlike unzip), the Unix
+            # mode is in the upper bits of external_attr, when present:
+            mode = (info.external_attr >> 16) & 0o7777
+            if mode and not info.is_dir():
+                os.chmod(path, mode)
+    os.unlink(archive_path)
+
+
+def _strip_top_level_directory(directory) -> str:
+    """The directory with the content of an archive with a cfbs.json, which
+    is the top-level directory in the archive, if it has only one of those."""
+    items = os.listdir(directory)
+    if len(items) == 1:
+        top = os.path.join(directory, items[0])
+        if os.path.isdir(top) and os.path.exists(os.path.join(top, "cfbs.json")):
+            return top
+    return directory
+
+
+def _move_new(src, dst):
+    """Move the directory src to dst, using renames only, if dst already
+    exists, only what it doesn't have yet is moved into it.
+
+    This is used to put extracted archives and git exports in place, src and
+    dst are on the same file system, and the content is the same (same
+    checksum / commit) when both have something, so it doesn't matter which
+    one is kept."""
+    if not os.path.exists(dst):
+        os.rename(src, dst)
+        return
+    if not os.path.isdir(dst) or not os.path.isdir(src):
+        return
+    for name in os.listdir(src):
+        _move_new(os.path.join(src, name), os.path.join(dst, name))
+
+
 def fetch_archive(
-    url: str, checksum=None, directory=None, with_index=True, extract_to_directory=False
+    url: str,
+    checksum=None,
+    directory=None,
+    with_index=True,
+    extract_to_directory=False,
+    subdirectory=None,
 ):
+    """Download and extract a .tar.gz / .tgz / .zip archive, returns the path
+    of its content (or of the cfbs.json in it) and its checksum.
+
+    Tarballs are extracted while they are downloaded and hashed, in one pass.
+    The content is extracted into a temporary directory, and only moved into
+    place (by renaming) after the checksum has been verified, so the download
+    cache never has partial, or unverified content.
+
+    :param checksum: SHA-1 / SHA-256 of the archive, if known
+    :param directory: put the content here instead of in the download cache,
+                      only when with_index is False or extract_to_directory
+    :param with_index: the archive has a cfbs.json, in the root or in a single
+                       top-level directory (which is then left out), and the
+                       path of the cfbs.json is returned
+    :param extract_to_directory: directory can already exist, the content is
+                                 added to it
+    :param subdirectory: only extract this subdirectory (and cfbs.json), the
+                         content is then marked as partial (see
+                         is_partial_export()) until the whole archive is
+                         extracted
+    """
     assert url.endswith(SUPPORTED_ARCHIVES)
 
     url_path = url[url.index("://") + 3 :]
     archive_dirname = os.path.dirname(url_path)
     archive_filename = os.path.basename(url_path)
 
-    for ext in SUPPORTED_ARCHIVES:
-        if archive_filename.endswith(ext):
-            archive_type = ext
-            break
-    else:
-        raise CFBSExitError("Unsupported archive type: '%s'" % url)
-
     downloads = os.path.join(cfbs_dir(), "downloads")
-
     archive_dir = os.path.join(downloads, archive_dirname)
-    if not extract_to_directory or not os.path.exists(archive_dir):
-        mkdir(archive_dir)
 
-    archive_path = os.path.join(downloads, archive_dir, archive_filename)
-    try:
-        archive_checksum = fetch_url(url, archive_path, checksum)
-    except CFBSNetworkError as e:
-        raise CFBSExitError(str(e))
-
-    content_dir = os.path.join(downloads, archive_dir, archive_checksum)
-    if extract_to_directory:
-        assert directory is not None
-        content_dir = directory
-    index_path = os.path.join(content_dir, "cfbs.json")
-    if with_index and os.path.exists(index_path):
-        # available already
-        return (index_path, archive_checksum)
-    else:
-        if not extract_to_directory or not os.path.exists(content_dir):
-            mkdir(content_dir)
-
-    # TODO: use Python modules instead of CLI tools?
-    if archive_type.startswith(_SUPPORTED_TAR_TYPES):
-        if shutil.which("tar"):
-            sh("cd %s; tar -xzf %s" % (content_dir, archive_path))
+    if with_index and checksum is not None:
+        content_dir = os.path.join(archive_dir, checksum)
+        index_path = os.path.join(content_dir, "cfbs.json")
+        if subdirectory:
+            complete = os.path.isdir(os.path.join(content_dir, subdirectory))
         else:
-            raise CFBSExitError("Working with .tar archives requires the 'tar' utility")
-    elif archive_type == (".zip"):
-        if shutil.which("unzip"):
-            sh("cd %s; unzip %s" % (content_dir, archive_path))
-        else:
-            raise CFBSExitError(
-                "Working with .zip archives requires the 'unzip' utility"
-            )
+            complete = not is_partial_export(content_dir)
+        if os.path.exists(index_path) and complete:
+            # available already
+            return (index_path, checksum)
+
+    if directory is not None and (extract_to_directory or not with_index):
+        directory = directory.rstrip("/")
+        parent = os.path.dirname(directory)
     else:
-        raise RuntimeError(
-            "Unhandled archive type: '%s'. Please report this at %s."
-            % (url, "https://github.com/cfengine/cfbs/issues")
-        )
+        directory = None
+        parent = archive_dir
+    mkdir(parent)
 
-    os.unlink(archive_path)
-
-    content_root_items = [
-        os.path.join(content_dir, item) for item in os.listdir(content_dir)
-    ]
-    if (
-        with_index
-        and len(content_root_items) == 1
-        and os.path.isdir(content_root_items[0])
-        and os.path.exists(os.path.join(content_root_items[0], "cfbs.json"))
-    ):
-        # the archive contains a top-level folder, let's just move things one
-        # level up from inside it
-        sh("mv %s %s" % (os.path.join(content_root_items[0], "*"), content_dir))
-        shutil.rmtree(content_root_items[0])
-
-    if with_index:
-        if os.path.exists(index_path):
-            return (index_path, archive_checksum)
-        else:
+    # In the same directory as the destination, so it can be renamed there:
+    temporary = tempfile.mkdtemp(prefix=".cfbs-download-", dir=parent)
+    try:
+        content = os.path.join(temporary, "content")
+        member_filter = _MemberFilter(url, subdirectory)
+        sha = checksum_hash(checksum)
+        with open_url(url) as response:
+            reader = _HashingReader(response, sha)
+            if archive_filename.endswith(".zip"):
+                _extract_zip(reader, content, member_filter)
+            else:
+                _extract_tar(reader, content, member_filter)
+        archive_checksum = sha.digest().hex()
+        if checksum is not None and archive_checksum != checksum:
             raise CFBSExitError(
-                "Archive '%s' doesn't contain a valid cfbs.json index file" % url
+                "Checksum mismatch in fetched '%s': %s != %s"
+                % (url, archive_checksum, checksum)
             )
-    else:
-        if not extract_to_directory and directory is not None:
-            directory = directory.rstrip("/")
-            mkdir(os.path.dirname(directory))
-            sh("rsync -a %s/ %s/" % (content_dir, directory))
-            rm(content_dir)
+        mkdir(content)  # In case the archive (or subdirectory) was empty
+
+        if directory is not None:
+            _move_new(content, directory)
             return (directory, archive_checksum)
+
+        if with_index:
+            content = _strip_top_level_directory(content)
+            if not os.path.exists(os.path.join(content, "cfbs.json")):
+                raise CFBSExitError(
+                    "Archive '%s' doesn't contain a valid cfbs.json index file" % url
+                )
+        content_dir = os.path.join(archive_dir, archive_checksum)
+        marker = _sparse_marker(content_dir)
+        if subdirectory and not os.path.exists(content_dir):
+            touch(marker)  # Before the (incomplete) files are in place
+        _move_new(content, content_dir)
+        if not subdirectory:
+            rm(marker, missing_ok=True)
+        if with_index:
+            return (os.path.join(content_dir, "cfbs.json"), archive_checksum)
         return (content_dir, archive_checksum)
+    except CFBSNetworkError as e:
+        raise CFBSExitError(str(e))
+    except (tarfile.TarError, zipfile.BadZipFile, EOFError, OSError) as e:
+        raise CFBSExitError("Failed to fetch and extract '%s': %s" % (url, e))
+    finally:
+        rm(temporary, missing_ok=True)
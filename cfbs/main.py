@@ -6,11 +6,13 @@ __copyright__ = ["Northern.tech AS"]
 import contextlib
 import logging as log
 import os
+import sys
 import traceback
 import pathlib
 
+from cfbs.command_registry import get_command_names, import_command_module
 from cfbs.git import CFBSGitError
-from cfbs.validate import validate_index_string
+from cfbs.serve import SERVED_COMMANDS, run_on_server
 from cfbs.version import string as version
 from cfbs.utils import (
     CFBSValidationError,
@@ -22,8 +24,6 @@ from cfbs.utils import (
     migrate_config_paths,
     open_file_arg,
 )
-from cfbs.cfbs_config import CFBSConfig
-from cfbs import commands
 from cfbs.args import get_args, print_help, get_manual
 
 
@@ -62,8 +62,11 @@ def _main() -> int:
     Actual logic should be implemented elsewhere (primarily in commands.py).
 
     This function is wrapped by main() which catches exceptions.
+
+    Commands are imported when needed (see command_registry.py), so that
+    --version, --help, and errors in arguments don't have to wait for all
+    of cfbs to be imported.
     """
-    migrate_config_paths()
     args = get_args()
     init_logging(args.loglevel)
     if args.manual:
@@ -78,7 +81,7 @@ def _main() -> int:
         print("")
         raise CFBSUserError("No command given")
 
-    if args.command not in commands.get_command_names():
+    if args.command not in get_command_names():
         print_help()
         raise CFBSUserError("Command '%s' not found" % args.command)
 
@@ -87,6 +90,8 @@ def _main() -> int:
             raise CFBSUserError(
                 "'--index' option can not be used with the '%s' command" % args.command
             )
+        from cfbs.validate import validate_index_string
+
         validate_index_string(args.index)
 
     if args.masterfiles and args.command != "init":
@@ -107,11 +112,45 @@ def _main() -> int:
             % args.command
         )
 
-    if args.to_json and args.command not in ("analyze", "analyse"):
+    if args.check and args.command not in ("pretty", "update"):
+        raise CFBSUserError(
+            "The option --check is only for 'cfbs pretty' and 'cfbs update', not 'cfbs %s'"
+            % args.command
+        )
+
+    if args.to_json is not None and args.command not in (
+        "analyze",
+        "analyse",
+        "validate",
+        "update",
+    ):
+        raise CFBSUserError(
+            "The option --to-json is only for 'cfbs analyze', 'cfbs validate' and 'cfbs update --check', not 'cfbs %s'"
+            % args.command
+        )
+
+    if args.jobs is not None and args.command not in (
+        "pretty",
+        "validate",
+        "update",
+        "convert",
+    ):
         raise CFBSUserError(
-            "The option --to-json is only for 'cfbs analyze', not 'cfbs %s'"
+            "The option --jobs is only for 'cfbs pretty', 'cfbs validate', 'cfbs update --check' and 'cfbs convert', not 'cfbs %s'"
             % args.command
         )
+    if args.command == "update" and not args.check:
+        for option, used in (
+            ("--to-json", args.to_json is not None),
+            ("--jobs", args.jobs is not None),
+        ):
+            if used:
+                raise CFBSUserError(
+                    "The option %s is only for 'cfbs update --check', not 'cfbs update'"
+                    % option
+                )
+    if args.jobs is not None and args.jobs < 1:
+        raise CFBSUserError("The option --jobs must be a positive number")
 
     if args.ignored_path_components and args.command not in ("analyze", "analyse"):
         raise CFBSUserError(
@@ -125,6 +164,12 @@ def _main() -> int:
             % args.command
         )
 
+    if args.convert_rules is not None and args.command != "convert":
+        raise CFBSUserError(
+            "The option --convert-rules is only for 'cfbs convert', not 'cfbs %s'"
+            % args.command
+        )
+
     if args.diffs and args.command != "build":
         raise CFBSUserError(
             "The option --diffs is only for 'cfbs build', not 'cfbs %s'" % args.command
@@ -148,7 +193,20 @@ def _main() -> int:
         print_help()
         return 0
 
-    CFBSConfig.get_instance(index=args.index, non_interactive=args.non_interactive)
+    # Read-only commands can be answered by cfbs serve, with a warm cache:
+    if args.command in SERVED_COMMANDS:
+        exit_code = run_on_server(sys.argv[1:])
+        if exit_code is not None:
+            return exit_code
+
+    # Filesystem checks and imports only needed for actually running commands:
+    migrate_config_paths()
+    commands = import_command_module(args.command)
+    from cfbs.cfbs_config import CFBSConfig
+
+    # A convert with rules never prompts, like with --non-interactive:
+    non_interactive = args.non_interactive or args.convert_rules is not None
+    CFBSConfig.get_instance(index=args.index, non_interactive=non_interactive)
 
     if args.command == "init":
         return commands.init_command(
@@ -161,16 +219,23 @@ def _main() -> int:
     if args.command == "search":
         return commands.search_command(args.args)
     if args.command == "pretty":
-        return commands.pretty_command(args.args, args.check, args.keep_order)
+        return commands.pretty_command(
+            args.args, args.check, args.keep_order, args.jobs
+        )
     if args.command == "validate":
-        return commands.validate_command(args.args, args.index)
+        return commands.validate_command(
+            args.args,
+            args.index,
+            None if args.to_json is None else (args.to_json or "validation"),
+            args.jobs,
+        )
     if args.command in ("info", "show"):
         return commands.info_command(args.args)
 
     if args.command in ("analyze", "analyse"):
         return commands.analyze_command(
             args.args,
-            args.to_json,
+            None if args.to_json is None else (args.to_json or "analysis"),
             args.reference_version,
             args.masterfiles_dir,
             args.ignored_path_components,
@@ -178,7 +243,11 @@ def _main() -> int:
             does_log_info(args.loglevel),
         )
     if args.command == "convert":
-        return commands.convert_command(args.non_interactive, args.offline)
+        return commands.convert_command(
+            non_interactive, args.offline, args.convert_rules, args.jobs
+        )
+    if args.command == "serve":
+        return commands.serve_command()
 
     # Commands you cannot run outside a cfbs repo:
     if not is_cfbs_repo():
@@ -204,7 +273,12 @@ def _main() -> int:
     if args.command == "install":
         return commands.install_command(args.args)
     if args.command == "update":
-        return commands.update_command(args.args)
+        return commands.update_command(
+            args.args,
+            check=args.check,
+            json_filename=None if args.to_json is None else (args.to_json or "updates"),
+            jobs=args.jobs,
+        )
     if args.command == "input":
         return commands.input_command(args.args)
     if args.command in ("set-input", "get-input"):
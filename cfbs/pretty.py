@@ -1,7 +1,7 @@
 import json
 import re
-from copy import copy
 from collections import OrderedDict
+from typing import IO, Callable, List, Optional  # noqa: F401 (used in type comments)
 
 MAX_LEN = 80
 INDENT_SIZE = 2
@@ -58,6 +58,85 @@ CFBS_DEFAULT_SORTING_RULES = {
 }
 
 
+class _SortingRule:
+    """One compiled (child_name_key_fn, sorting_rules_inside_child) tuple"""
+
+    __slots__ = ("key_fn", "children")
+
+    def __init__(self, key_fn, children):
+        self.key_fn = key_fn
+        self.children = children
+
+
+class SortingRules:
+    """Sorting rules (see _children_sort()) compiled into a tree which is
+    fast to apply to big JSON objects, like an index with thousands of
+    modules.
+
+    Regular expressions are compiled once, and orders given as a tuple or
+    list of names become dictionaries of name -> rank, so sorting n child
+    objects is O(n log n), independent of the length of the tuple.
+    """
+
+    __slots__ = ("exact", "patterns")
+
+    def __init__(self, sorting_rules: dict):
+        self.exact = {}
+        self.patterns = []
+        for name, (key_fn, children) in sorting_rules.items():
+            rule = _SortingRule(
+                _compile_key_fn(key_fn),
+                None if children is None else SortingRules(children),
+            )
+            self.exact[name] = rule
+            if name is not None:
+                self.patterns.append((re.compile(name), rule))
+
+    def find(self, name) -> Optional[_SortingRule]:
+        """Rule for the child object with the given name, an exact match is
+        preferred, otherwise the first pattern matching the start of name."""
+        rule = self.exact.get(name)
+        if rule is not None or name is None:
+            return rule
+        for pattern, rule in self.patterns:
+            if pattern.match(name):
+                return rule
+        return None
+
+
+def _compile_key_fn(key_fn):
+    # To make the rules a bit easier to use / read, allow 2 alternatives to
+    # providing key functions:
+    # "alphabetic" to sort alphabetically
+    # a tuple of strings to sort by this order
+    if key_fn == "alphabetic":
+        return lambda item: item[0]
+    if type(key_fn) in (tuple, list):
+        # Names not in the tuple go at the end, same as item_index() in
+        # utils.py (ranks of the first occurrence, like list.index()):
+        ranks = {}
+        for rank, name in enumerate(key_fn):
+            ranks.setdefault(name, rank)
+        extra = len(key_fn)
+        return lambda item: ranks.get(item[0], extra)
+    return key_fn
+
+
+_COMPILED_DEFAULT_SORTING_RULES = SortingRules(CFBS_DEFAULT_SORTING_RULES)
+
+
+def compile_sorting_rules(sorting_rules) -> Optional[SortingRules]:
+    """Compile sorting rules, so they can be reused for many JSON objects.
+
+    Already compiled rules are returned as is, and the default rules are
+    only compiled once."""
+    if sorting_rules is None or isinstance(sorting_rules, SortingRules):
+        return sorting_rules
+    if sorting_rules is CFBS_DEFAULT_SORTING_RULES:
+        return _COMPILED_DEFAULT_SORTING_RULES
+    return SortingRules(sorting_rules)
+
+
 def _children_sort(child: OrderedDict, name, sorting_rules):
     """Recursively sort child objects in a JSON object.
 
@@ -132,64 +211,40 @@ def _children_sort(child: OrderedDict, name, sorting_rules):
        Only JSON objects (dictionaries) are sorted by this function, arrays are ignored.
 
     """
-    assert type(child) is OrderedDict
+    compiled = compile_sorting_rules(sorting_rules)
+    if compiled is not None:
+        _sort_compiled(child, name, compiled)
 
-    for key in child:
-        if type(child[key]) not in (list, tuple):
-            continue
-        if name not in sorting_rules:
-            continue
-        if key not in sorting_rules[name][1]:
-            continue
-        rules = sorting_rules[name][1][key][1]
-        for element in child[key]:
-            if type(element) is OrderedDict:
-                _children_sort(element, key, rules)
-
-    rules = None
-    if name in sorting_rules.keys():
-        rules = sorting_rules[name]
-    else:
-        for child_key_re in sorting_rules.keys():
-            if re.match(child_key_re, name):
-                rules = sorting_rules[child_key_re]
-                break
 
-    if rules is None:
-        return
+def _sort_compiled(child: OrderedDict, name, sorting_rules: SortingRules):
+    assert type(child) is OrderedDict
 
-    child_key_fn = rules[0]
+    # Arrays are only sorted inside for exact names (not patterns):
+    named_rule = sorting_rules.exact.get(name)
+    if named_rule is not None and named_rule.children is not None:
+        array_rules = named_rule.children.exact
+        for key, value in child.items():
+            if type(value) not in (list, tuple) or key not in array_rules:
+                continue
+            rules = array_rules[key].children
+            if rules is None:
+                continue
+            for element in value:
+                if type(element) is OrderedDict:
+                    _sort_compiled(element, key, rules)
+
+    rule = sorting_rules.find(name)
+    if rule is None:
+        return
 
-    # This is the same as item_index in utils.py
-    # Copy-pasted here to avoid circular import.
-    def _item_index(iterable, item, extra_at_end=True):
-        try:
-            return iterable.index(item)
-        except ValueError:
-            if extra_at_end:
-                return len(iterable)
-            else:
-                return -1
-
-    # To make this function a bit easier to use / read, allow 2 alternatives to
-    # providing key functions:
-    # "alphabetic" to sort alphabetically
-    # a tuple of strings to sort by this order
-    if child_key_fn == "alphabetic":
-        child_key_fn = lambda x: x[0]
-    if type(child_key_fn) in (tuple, list):
-        values = copy(child_key_fn)
-        child_key_fn = lambda x: _item_index(values, x[0])
-
-    if child_key_fn is not None:
-        for key, value in sorted(child.items(), key=child_key_fn):
+    if rule.key_fn is not None:
+        for key, value in sorted(child.items(), key=rule.key_fn):
             child.move_to_end(key)
 
-    child_sorting_rules = rules[1]
-    if child_sorting_rules is not None:
+    if rule.children is not None:
         for child_key, child_value in child.items():
             if type(child_value) is OrderedDict:
-                _children_sort(child_value, child_key, child_sorting_rules)
+                _sort_compiled(child_value, child_key, rule.children)
 
 
 def pretty_check_file(filename, sorting_rules=None):
@@ -233,90 +288,75 @@ def _should_wrap(parent, indent):
         if isinstance(child, (tuple, list, dict)):
             if len(child) >= 2:
                 count += 1
-    return count >= 2
+                if count >= 2:
+                    return True
+    return False
 
 
-def _encode_list_single_line(lst, indent, cursor):
-    buf = "["
-    last_index = len(lst) - 1
-    for index, child in enumerate(lst):
-        if index > 0:
-            buf += ", "
-        will_append_comma = index != last_index
-        buf += _encode(child, indent, cursor + len(buf), will_append_comma)
-    buf += "]"
-    return buf
+# Lists and dicts are put on a single line if they fit within MAX_LEN,
+# otherwise they are spread over multiple lines. Encoding the whole subtree
+# on one line first, and only then checking the length, means re-encoding
+# the subtree for every ancestor, and throwing most of the work away (in
+# the worst case exponential in the depth of the nesting). Instead,
+# single line attempts are given a limit, and stop (returning None) as soon
+# as the encoding is longer than that. Thus they do work proportional to
+# MAX_LEN, not to the size of the subtree. The multiline output is written
+# in parts to a _Writer, and joined once at the end.
 
 
-def _encode_list_multiline(lst, indent):
-    indent += INDENT_SIZE
-    buf = "[\n" + " " * indent
-    last_index = len(lst) - 1
-    for index, child in enumerate(lst):
-        if index > 0:
-            buf += ",\n" + " " * indent
-        will_append_comma = index != last_index
-        buf += _encode(child, indent, 0, will_append_comma)
-    indent -= INDENT_SIZE
-    buf += "\n" + " " * indent + "]"
-    return buf
+class _TooLong(Exception):
+    def __init__(self, writer):
+        super().__init__()
+        self.writer = writer
 
 
-def _encode_list(lst, indent, cursor, will_append_comma):
-    if not lst:
-        return "[]"
-    if not _should_wrap(lst, indent):
-        buf = _encode_list_single_line(lst, indent, cursor)
-        adjust_for_comma = 1 if will_append_comma else 0
-        if (indent + cursor + len(buf)) <= (MAX_LEN - adjust_for_comma):
-            return buf
-    return _encode_list_multiline(lst, indent)
+class _Writer:
+    """Collects output in a list of parts, joined once at the end.
 
+    If limit is set, writing more than limit characters in total raises
+    _TooLong, which should be caught where the writer was created.
 
-def _encode_dict_single_line(dct, indent, cursor):
-    buf = "{ "
-    last_index = len(dct) - 1
-    for index, (key, value) in enumerate(dct.items()):
-        if index > 0:
-            buf += ", "
-        if not isinstance(key, str):
-            raise ValueError("Illegal key type '" + type(key).__name__ + "'")
-        buf += '"' + key + '": '
-        will_append_comma = index != last_index
-        buf += _encode(value, indent, cursor + len(buf), will_append_comma)
-    buf += " }"
-    return buf
+    If stream is set, output is written to it as it's produced, instead of
+    being collected (only for the top level writer, without limit)."""
 
+    def __init__(self, limit: Optional[int] = None, stream: Optional[IO] = None):
+        assert limit is None or stream is None
+        self.parts = []  # type: List[str]
+        self.length = 0
+        self.limit = limit
+        if stream is not None:
+            self.write = stream.write  # type: Callable[[str], object]
+        elif limit is None:
+            # No need to keep track of the length, write directly:
+            self.write = self.parts.append
+        else:
+            self.write = self._write_limited
 
-def _encode_dict_multiline(dct, indent):
-    indent += INDENT_SIZE
-    buf = "{\n" + " " * indent
-    last_index = len(dct) - 1
-    for index, (key, value) in enumerate(dct.items()):
-        if index > 0:
-            buf += ",\n" + " " * indent
-        if not isinstance(key, str):
-            raise ValueError("Illegal key type '" + type(key).__name__ + "'")
-        entry = '"' + key + '": '
-        will_append_comma = index != last_index
-        buf += entry + _encode(value, indent, len(entry), will_append_comma)
-    indent -= INDENT_SIZE
-    buf += "\n" + " " * indent + "}"
-    return buf
+    def check(self, length):
+        """Raise _TooLong right away if there's no room for length more characters"""
+        if self.limit is not None and self.length + length > self.limit:
+            raise _TooLong(self)
+
+    def _write_limited(self, s):
+        assert self.limit is not None
+        self.length += len(s)
+        if self.length > self.limit:
+            raise _TooLong(self)
+        self.parts.append(s)
 
+    def getvalue(self):
+        return "".join(self.parts)
 
-def _encode_dict(dct, indent, cursor, will_append_comma):
-    if not dct:
-        return "{}"
-    if not _should_wrap(dct, indent):
-        buf = _encode_dict_single_line(dct, indent, cursor)
-        adjust_for_comma = 1 if will_append_comma else 0
-        if (indent + cursor + len(buf)) <= (MAX_LEN - adjust_for_comma):
-            return buf
-    return _encode_dict_multiline(dct, indent)
 
+def _minimum_length(collection):
+    # Every list element takes at least 1 character, and every key-value
+    # pair at least 5 ("": 0), in addition to the ", " separators:
+    if isinstance(collection, dict):
+        return 7 * len(collection) + 2
+    return 3 * len(collection)
 
-def _encode(data, indent, cursor, will_append_comma):
+
+def _encode_scalar(data):
     if data is None:
         return "null"
     elif data is True:
@@ -328,16 +368,144 @@ def _encode(data, indent, cursor, will_append_comma):
     elif isinstance(data, str):
         # Use the json module to escape the string with backslashes:
         return json.dumps(data)
-    elif isinstance(data, (list, tuple)):
-        return _encode_list(data, indent, cursor, will_append_comma)
-    elif isinstance(data, dict):
-        return _encode_dict(data, indent, cursor, will_append_comma)
     else:
         raise ValueError("Illegal value type '" + type(data).__name__ + "'")
 
 
+def _encode_limited(data, indent, cursor, will_append_comma, limit):
+    """Encode data, or return None if the encoding is longer than limit"""
+    if isinstance(data, (list, tuple, dict)):
+        if not data:
+            return ("{}" if isinstance(data, dict) else "[]") if limit >= 2 else None
+        if _minimum_length(data) > limit:
+            return None
+        if not _should_wrap(data, indent):
+            buf = _encode_single_line(data, indent, cursor, will_append_comma)
+            if buf is not None:
+                return buf if len(buf) <= limit else None
+        writer = _Writer(limit)
+        try:
+            _write_multiline(data, indent, writer)
+        except _TooLong as e:
+            if e.writer is not writer:
+                raise
+            return None
+        return writer.getvalue()
+    # Escaping can only make a string longer, check before doing it:
+    if isinstance(data, str) and len(data) + 2 > limit:
+        return None
+    buf = _encode_scalar(data)
+    return buf if len(buf) <= limit else None
+
+
+def _encode_single_line(data, indent, cursor, will_append_comma):
+    """Encode a non-empty list / dict on one line, or return None if
+    that doesn't fit within MAX_LEN"""
+    adjust_for_comma = 1 if will_append_comma else 0
+    limit = MAX_LEN - adjust_for_comma - indent - cursor
+    is_dict = isinstance(data, dict)
+    if is_dict:
+        items = data.items()
+        parts = ["{ "]
+        end = " }"
+    else:
+        items = enumerate(data)
+        parts = ["["]
+        end = "]"
+    length = len(parts[0])
+    last_index = len(data) - 1
+    for index, (key, value) in enumerate(items):
+        if index > 0:
+            parts.append(", ")
+            length += 2
+        if is_dict:
+            if not isinstance(key, str):
+                raise ValueError("Illegal key type '" + type(key).__name__ + "'")
+            entry = '"' + key + '": '
+            parts.append(entry)
+            length += len(entry)
+        if type(value) is str:
+            # Fast path for the most common case, same as _encode_limited():
+            if length + len(value) + 2 + len(end) > limit:
+                return None
+            buf = json.dumps(value)
+            if length + len(buf) + len(end) > limit:
+                return None
+        else:
+            will_append_comma = index != last_index
+            buf = _encode_limited(
+                value,
+                indent,
+                cursor + length,
+                will_append_comma,
+                limit - length - len(end),
+            )
+            if buf is None:
+                return None
+        parts.append(buf)
+        length += len(buf)
+    parts.append(end)
+    return "".join(parts)
+
+
+def _write_multiline(data, indent, writer):
+    is_dict = isinstance(data, dict)
+    indent += INDENT_SIZE
+    writer.write(("{\n" if is_dict else "[\n") + " " * indent)
+    last_index = len(data) - 1
+    items = data.items() if is_dict else enumerate(data)
+    for index, (key, value) in enumerate(items):
+        if index > 0:
+            writer.write(",\n" + " " * indent)
+        cursor = 0
+        if is_dict:
+            if not isinstance(key, str):
+                raise ValueError("Illegal key type '" + type(key).__name__ + "'")
+            entry = '"' + key + '": '
+            writer.write(entry)
+            cursor = len(entry)
+        will_append_comma = index != last_index
+        _write(value, indent, cursor, will_append_comma, writer)
+    indent -= INDENT_SIZE
+    writer.write("\n" + " " * indent + ("}" if is_dict else "]"))
+
+
+def _write(data, indent, cursor, will_append_comma, writer):
+    if isinstance(data, (list, tuple, dict)):
+        if not data:
+            writer.write("{}" if isinstance(data, dict) else "[]")
+            return
+        if writer.limit is not None:
+            writer.check(_minimum_length(data))
+        if not _should_wrap(data, indent):
+            buf = _encode_single_line(data, indent, cursor, will_append_comma)
+            if buf is not None:
+                writer.write(buf)
+                return
+        _write_multiline(data, indent, writer)
+        return
+    if writer.limit is not None and isinstance(data, str):
+        writer.check(len(data) + 2)
+    writer.write(_encode_scalar(data))
+
+
 def pretty(o, sorting_rules=None):
     if sorting_rules is not None:
         _children_sort(o, None, sorting_rules)
 
-    return _encode(o, 0, 0, False)
+    writer = _Writer()
+    _write(o, 0, 0, False, writer)
+    return writer.getvalue()
+
+
+def pretty_write(o, stream: IO, sorting_rules=None):
+    """Same as pretty(), but writes the output to a (text) file object as it
+    is produced, instead of building the whole string in memory first.
+
+    Note that if encoding fails (e.g. a value of an illegal type), some of
+    the output has already been written. Write to a temporary file and
+    rename it (see utils.atomic_open()) to avoid leaving a partial file."""
+    if sorting_rules is not None:
+        _children_sort(o, None, sorting_rules)
+
+    _write(o, 0, 0, False, _Writer(stream=stream))
@@ -0,0 +1,236 @@
+"""Functions for running 'cfbs pretty' on many files at once
+
+Arguments can be files, directories (searched recursively for .json files)
+and glob patterns. Files are processed in a pool of worker processes when
+there are many of them, and results are reported in the order of the
+arguments, regardless of which worker finished first.
+
+A cache of files known to already be formatted, keyed on the absolute path
+and storing (mtime, size, sha256), lets repeated runs (pre-commit hooks, CI)
+skip reading and parsing files which haven't changed. Like git, a file with
+the same mtime and size as in the cache is assumed to be unchanged, if only
+the mtime changed, the hash is used to check the content. Files modified
+in the last couple of seconds are not cached, since they could still change
+without their mtime changing. Cache entries are only valid for the cfbs
+version (and formatting code) which wrote them.
+"""
+
+import glob
+import hashlib
+import io
+import json
+import os
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional, Tuple
+
+import cfbs.pretty
+from cfbs.pretty import pretty, CFBS_DEFAULT_SORTING_RULES
+from cfbs.utils import (
+    CFBSExitError,
+    atomic_open,
+    cfbs_dir,
+    changed_recently,
+    file_sha256,
+)
+from cfbs.version import string as version_string
+
+# Starting worker processes has a cost, only worth it for many files:
+MIN_FILES_FOR_PROCESS_POOL = 20
+
+# Results of pretty_one():
+FORMATTED = "formatted"  # Already formatted, nothing to do
+REFORMATTED = "reformatted"  # Was not formatted, and has been rewritten
+WOULD_REFORMAT = "would reformat"  # Not formatted (--check)
+ERROR = "error"
+
+
+def _is_glob(arg: str):
+    return any(c in arg for c in "*?[")
+
+
+def expand_json_paths(args: List[str]) -> List[str]:
+    """Turn command line arguments into a list of .json files.
+
+    Directories are searched recursively (skipping hidden directories, like
+    .git), glob patterns are expanded (** matches any number of directories).
+    Expansions are sorted, and files are listed once, in the order they were
+    first found, so the result is deterministic.
+    """
+    paths = []
+    for arg in args:
+        if _is_glob(arg):
+            matches = sorted(
+                path
+                for path in glob.glob(arg, recursive=True)
+                if path.endswith(".json") and os.path.isfile(path)
+            )
+            if not matches:
+                raise CFBSExitError("No .json files match '%s'" % arg)
+            paths.extend(matches)
+        elif os.path.isdir(arg):
+            found = []
+            for root, dirs, files in os.walk(arg):
+                dirs[:] = [d for d in dirs if not d.startswith(".")]
+                found.extend(
+                    os.path.join(root, name) for name in files if name.endswith(".json")
+                )
+            paths.extend(sorted(found))
+        elif not arg.endswith(".json"):
+            raise CFBSExitError(
+                "cfbs pretty command can only be used with .json files, not '%s'"
+                % os.path.basename(arg)
+            )
+        else:
+            paths.append(arg)
+
+    seen = set()
+    unique = []
+    for path in paths:
+        key = os.path.normpath(path)
+        if key not in seen:
+            seen.add(key)
+            unique.append(path)
+    return unique
+
+
+def _formatter_id() -> str:
+    """Identifies the formatting (cfbs version, and the code and sorting
+    rules in cfbs/pretty.py), so an upgrade invalidates the cache"""
+    return "%s-%s" % (version_string(), file_sha256(cfbs.pretty.__file__)[0:16])
+
+
+class PrettyCache:
+    """Persistent cache of files known to be formatted, stored as JSON in the
+    cfbs directory. Entries depend on the formatter and whether sorting is
+    used or not, entries of other formatters are dropped when loading."""
+
+    def __init__(self, sorting: bool, path: Optional[str] = None):
+        self.path = path or cfbs_dir("pretty-cache.json")
+        formatter = _formatter_id() + ":"
+        self.prefix = formatter + ("sorted:" if sorting else "unsorted:")
+        self.entries = OrderedDict()
+        self.changed = False
+        try:
+            with open(self.path) as f:
+                data = json.load(f, object_pairs_hook=OrderedDict)
+        except (OSError, ValueError):
+            data = None  # Missing or broken cache, start over
+        if isinstance(data, dict):
+            self.entries = OrderedDict(
+                (key, entry) for key, entry in data.items() if key.startswith(formatter)
+            )
+            self.changed = len(self.entries) != len(data)
+
+    def _key(self, path):
+        return self.prefix + os.path.realpath(path)
+
+    def get(self, path) -> Optional[list]:
+        """Cached [mtime, size, sha256] for path, if any"""
+        entry = self.entries.get(self._key(path))
+        if type(entry) is not list or len(entry) != 3:
+            return None
+        return entry
+
+    def set(self, path, entry: Optional[list]):
+        key = self._key(path)
+        if entry is None:
+            if key in self.entries:
+                del self.entries[key]
+                self.changed = True
+        elif self.entries.get(key) != entry:
+            self.entries[key] = entry
+            self.changed = True
+
+    def save(self):
+        if not self.changed:
+            return
+        # Not pretty, this file is not for humans, and can be big:
+        with atomic_open(self.path) as f:
+            json.dump(self.entries, f)
+        self.changed = False
+
+
+def _stat_matches(path, entry) -> bool:
+    if not entry:
+        return False
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return False
+    return [stat.st_mtime_ns, stat.st_size] == entry[0:2]
+
+
+def _cache_entry(path, digest) -> Optional[list]:
+    stat = os.stat(path)
+    if changed_recently(stat.st_mtime):
+        return None  # Could change again, without changing the mtime
+    return [stat.st_mtime_ns, stat.st_size, digest]
+
+
+def pretty_one(
+    path: str, check: bool, sorting: bool, cached: Optional[list] = None
+) -> Tuple[str, Optional[str], Optional[list]]:
+    """Check or reformat one file.
+
+    Runs in worker processes, so it takes and returns plain data, and
+    reports errors in the return value instead of raising them.
+
+    :param cached: the cache entry for this file, if any
+    :return: (result, error message, new cache entry or None)
+    """
+    sorting_rules = CFBS_DEFAULT_SORTING_RULES if sorting else None
+    try:
+        if _stat_matches(path, cached):
+            return FORMATTED, None, cached
+        with open(path, "rb") as f:
+            raw = f.read()
+        digest = hashlib.sha256(raw).hexdigest()
+        if cached and cached[1] == len(raw) and cached[2] == digest:
+            return FORMATTED, None, _cache_entry(path, digest)
+
+        # Text mode, like pretty_file(), so CRLF line endings are accepted:
+        old_data = io.TextIOWrapper(io.BytesIO(raw), encoding="utf-8").read()
+        data = json.loads(old_data, object_pairs_hook=OrderedDict)
+        new_data = pretty(data, sorting_rules) + "\n"
+        if old_data == new_data:
+            return FORMATTED, None, _cache_entry(path, digest)
+        if check:
+            return WOULD_REFORMAT, None, None
+        with atomic_open(path) as f:
+            f.write(new_data)
+        digest = hashlib.sha256(new_data.encode("utf-8")).hexdigest()
+        return REFORMATTED, None, _cache_entry(path, digest)
+    except FileNotFoundError:
+        return ERROR, "File '%s' not found" % path, None
+    except (json.decoder.JSONDecodeError, UnicodeDecodeError) as ex:
+        return ERROR, "Error parsing JSON in '%s': %s" % (path, ex), None
+
+
+def pretty_files(
+    paths: List[str],
+    check: bool,
+    sorting: bool,
+    jobs: Optional[int] = None,
+    cache: Optional[PrettyCache] = None,
+) -> List[Tuple[str, str, Optional[str]]]:
+    """Check or reformat many files, returns (path, result, error) in the
+    same order as paths. The cache is updated, but not saved."""
+    cached = [cache.get(path) if cache else None for path in paths]
+    arguments = (paths, [check] * len(paths), [sorting] * len(paths), cached)
+
+    if len(paths) >= MIN_FILES_FOR_PROCESS_POOL and jobs != 1:
+        workers = jobs or os.cpu_count() or 1
+        # Send files to workers in chunks, but small enough to balance the load:
+        chunksize = max(1, len(paths) // (workers * 4))
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(pretty_one, *arguments, chunksize=chunksize))
+    else:
+        results = list(map(pretty_one, *arguments))
+
+    report = []
+    for path, (result, error, entry) in zip(paths, results):
+        if cache:
+            cache.set(path, entry)
+        report.append((path, result, error))
+    return report
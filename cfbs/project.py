@@ -0,0 +1,109 @@
+"""Python API for working with cfbs projects, without the command line
+
+The cfbs commands (commands.py) work on the project in the current working
+directory, using the CFBSConfig singleton and the command line arguments.
+Project instead takes the project directory (and output directory)
+explicitly, and doesn't rely on any global state, so many projects can be
+built in the same process, one after another, or at the same time in a pool
+of worker processes or threads:
+
+    from cfbs.project import Project
+
+    Project("path/to/project").build(out_dir="/tmp/project-out", jobs=4)
+
+Downloaded modules are shared between projects (cached in the cfbs directory,
+see CFBS_GLOBAL_DIR), like when running cfbs build.
+"""
+
+import logging as log
+import os
+from typing import Optional
+
+from cfbs.build import download_dependencies, init_out_folder, perform_build
+from cfbs.cfbs_config import CFBSConfig
+from cfbs.utils import CFBSExitError
+from cfbs.validate import format_validation_issues, validate_config_collect_errors
+
+
+class Project:
+    """A cfbs project, a directory with a cfbs.json file"""
+
+    def __init__(self, path=".", index=None):
+        """
+        :param path: project directory, relative paths are relative to the
+                     current working directory at the time of creation
+        :param index: index URL / path / dict to use instead of the one
+                      specified in cfbs.json (like the --index option)
+        """
+        self.path = os.path.abspath(path)
+        self.index = index
+        if not os.path.isfile(self.cfbs_json):
+            raise CFBSExitError(
+                "This is not a cfbs project, '%s' does not exist" % self.cfbs_json
+            )
+
+    @property
+    def cfbs_json(self) -> str:
+        return os.path.join(self.path, "cfbs.json")
+
+    def config(self) -> CFBSConfig:
+        """A new CFBSConfig for this project (reading cfbs.json again),
+        not the CFBSConfig.get_instance() singleton."""
+        return CFBSConfig(
+            filename=self.cfbs_json, index=self.index, non_interactive=True
+        )
+
+    def validate(self, config: Optional[CFBSConfig] = None) -> list:
+        """Validate cfbs.json, returns the errors found (ValidationIssue
+        tuples), an empty list if it is valid."""
+        return validate_config_collect_errors(config or self.config())
+
+    def download(self, out_dir=None, jobs: Optional[int] = 1, ignore_versions=False):
+        """Download the modules in the build list, and copy them into
+        out_dir/steps (same as cfbs download).
+
+        :param jobs: number of modules to download concurrently, None for
+                     based on the number of CPUs
+        """
+        config = self.config()
+        download_dependencies(
+            config,
+            ignore_versions=ignore_versions,
+            out_dir=out_dir or os.path.join(self.path, "out"),
+            jobs=jobs,
+        )
+
+    def build(
+        self,
+        out_dir=None,
+        jobs: Optional[int] = 1,
+        ignore_versions=False,
+        diffs_filename=None,
+    ) -> str:
+        """Build the project (same as cfbs build), returns the path of the
+        built masterfiles directory (the tarball is next to it).
+
+        Like cfbs build, validation errors are logged as warnings, and the
+        build continues. Errors during the build raise exceptions.
+
+        :param out_dir: output directory, which is deleted and recreated,
+                        default is the out directory in the project
+        :param jobs: number of modules to download concurrently, None for
+                     based on the number of CPUs (build steps always run
+                     one at a time, in order)
+        """
+        out_dir = os.path.abspath(out_dir or os.path.join(self.path, "out"))
+        config = self.config()
+        issues = self.validate(config)
+        if issues:
+            for line in format_validation_issues(issues):
+                log.warning(line)
+            log.warning(
+                "Errors found while validating '%s', building anyway" % self.cfbs_json
+            )
+        init_out_folder(out_dir)
+        download_dependencies(
+            config, ignore_versions=ignore_versions, out_dir=out_dir, jobs=jobs
+        )
+        perform_build(config, diffs_filename, out_dir)
+        return os.path.join(out_dir, "masterfiles")
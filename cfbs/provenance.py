@@ -0,0 +1,128 @@
+"""Build-wide index of where each built file came from
+
+While 'cfbs build' runs the build steps, Provenance keeps track of which
+module and build step wrote each file in the output masterfiles
+directory, with the SHA-256 of the content written, and in which order.
+This answers "which module did this file come from?", and since the index
+knows the hash of each file already written, overwrites can be detected
+without reading (hashing) the files already there again.
+
+The index is saved as out/provenance.json:
+
+    {
+      "files": {
+        "promises.cf": [
+          {"module": "masterfiles", "step": "copy ./ ./", "sha256": "..."},
+          {"module": "./my-promises/", "step": "copy promises.cf promises.cf", "sha256": "..."}
+        ]
+      }
+    }
+
+Paths are relative to the masterfiles directory, the last entry is the
+module and step which wrote the file in the built policy set. The hash is
+null when the step deleted the file (patch steps can do that). The files
+cfbs build writes itself after the build steps (cfbs.json, and def.json
+when prettifying it) are recorded with BUILD_PSEUDO_MODULE as the module.
+"""
+
+import os
+from collections import OrderedDict
+from typing import Dict, List, Optional  # noqa: F401
+
+from cfbs.utils import cached_file_sha256, cp_overwrites, write_json
+
+# Module name for the writes done by cfbs build itself, not by a module:
+BUILD_PSEUDO_MODULE = "cfbs build"
+
+
+class Provenance:
+    """Index of the files written into destination (the masterfiles
+    directory being built). record() and record_file() take paths of files
+    in destination, like the build steps use, the lookups take paths
+    relative to destination, like in provenance.json."""
+
+    def __init__(self, destination: str):
+        self.destination = destination
+        self._files = {}  # type: Dict[str, List[OrderedDict]]
+        self.module = None  # type: Optional[str]
+        self.step = None  # type: Optional[str]
+
+    def begin_step(self, module: str, step: str):
+        """Set the module and build step the following writes come from"""
+        self.module = module
+        self.step = step
+
+    def relpath(self, path: str) -> str:
+        return os.path.relpath(path, self.destination).replace(os.sep, "/")
+
+    def record(self, path: str, sha256: Optional[str]):
+        """Record that the current step wrote path (None: deleted it)"""
+        entry = OrderedDict(
+            [("module", self.module), ("step", self.step), ("sha256", sha256)]
+        )
+        self._files.setdefault(self.relpath(path), []).append(entry)
+
+    def record_file(self, path: str):
+        """Record that the current step changed path, hashing its content"""
+        if os.path.isfile(path):
+            self.record(path, cached_file_sha256(path))
+        elif self.relpath(path) in self:
+            self.record(path, None)
+
+    def __contains__(self, path: str) -> bool:
+        return path in self._files
+
+    def __len__(self) -> int:
+        return len(self._files)
+
+    def history(self, path: str) -> List[OrderedDict]:
+        """All the writes of path, in build order"""
+        return self._files.get(path, [])
+
+    def last(self, path: str) -> Optional[OrderedDict]:
+        """The write which produced path in the built policy set"""
+        history = self.history(path)
+        return history[-1] if history else None
+
+    def sha256(self, path: str) -> Optional[str]:
+        last = self.last(path)
+        return last["sha256"] if last else None
+
+    def copy(self, src: str, dst: str, before_overwrite=None):
+        """cp_overwrites(src, dst), recording the copied files. Returns the
+        identical and non-identical overwrites, relative to destination.
+
+        Files already written by a build step are compared to the hash
+        recorded for them instead of hashing them again."""
+        src_hashes = {}
+
+        def src_sha256(src_file):
+            if src_file not in src_hashes:
+                src_hashes[src_file] = cached_file_sha256(src_file)
+            return src_hashes[src_file]
+
+        def same_content(src_file, dst_file):
+            if os.path.getsize(src_file) != os.path.getsize(dst_file):
+                return False
+            known = self.sha256(self.relpath(dst_file))
+            if known is None:
+                known = cached_file_sha256(dst_file)
+            return src_sha256(src_file) == known
+
+        copied = {}
+
+        def after_copy(src_file, dst_file, rel_path):
+            self.record(dst_file, src_sha256(src_file))
+            copied[rel_path] = self.relpath(dst_file)
+
+        noop, modifying = cp_overwrites(
+            src, dst, before_overwrite, same_content, after_copy
+        )
+        return [copied[p] for p in noop], [copied[p] for p in modifying]
+
+    def to_json(self) -> OrderedDict:
+        files = OrderedDict((path, self._files[path]) for path in sorted(self._files))
+        return OrderedDict([("files", files)])
+
+    def save(self, path: str):
+        write_json(path, self.to_json())
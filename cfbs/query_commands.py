@@ -0,0 +1,411 @@
+"""
+query_commands.py - Entry points for the cfbs commands which only read the
+project: status, search, validate and info / show.
+
+They are separate from commands.py (see its docstring for how commands are
+written) so running them doesn't import the code for building, converting,
+analyzing and updating, see command_registry.py.
+"""
+
+import io
+import logging as log
+import os
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, redirect_stdout
+from typing import List, Optional, Tuple  # noqa: F401
+
+from cfbs.cfbs_config import CFBSConfig
+from cfbs.cfbs_json import CFBSJson
+from cfbs.command_registry import cfbs_command
+from cfbs.index import Index, get_default_index
+from cfbs.internal_file_management import get_download_path
+from cfbs.utils import (
+    CFBSExitError,
+    CFBSUserError,
+    cfbs_filename,
+    is_cfbs_repo,
+    pad_right,
+    write_json,
+)
+from cfbs.validate import (
+    format_validation_issues,
+    print_validation_issues,
+    validate_config_collect_errors,
+    validate_config_raise_exceptions,
+    validation_report,
+)
+
+
+@cfbs_command("status")
+def status_command():
+    config = CFBSConfig.get_instance()
+    validate_config_raise_exceptions(config, empty_build_list_ok=True)
+    print("Name:        %s" % config["name"])
+    print("Description: %s" % config["description"])
+    print("File:        %s" % cfbs_filename())
+    if "index" in config:
+        assert config.raw_data is not None
+        index = config.raw_data["index"]
+
+        if type(index) is str:
+            print("Index:       %s" % index)
+        else:
+            print("Index:       %s" % "inline index in cfbs.json")
+
+    modules = config.get("build")
+    if not modules:
+        return 0
+    print("\nModules:")
+    max_name_length = config.longest_module_key_length("name")
+    max_version_length = config.longest_module_key_length("version")
+    counter = 1
+    for m in modules:
+        if m["name"].startswith("./"):
+            status = "Copied"
+            version = "local"
+            commit = pad_right("", 40)
+        else:
+            path = get_download_path(m)
+            status = "Downloaded" if os.path.exists(path) else "Not downloaded"
+            version = m.get("version", "")
+            commit = m["commit"]
+        name = pad_right(m["name"], max_name_length)
+        version = pad_right(version, max_version_length)
+        version_with_commit = version + " "
+        if m["name"].startswith("./"):
+            version_with_commit += " "
+        else:
+            version_with_commit += "/"
+        version_with_commit += " " + commit
+        print("%03d %s @ %s (%s)" % (counter, name, version_with_commit, status))
+        counter += 1
+
+    return 0
+
+
+@cfbs_command("search")
+def search_command(terms: List[str]):
+    index = CFBSConfig.get_instance().index
+    results = {}
+
+    # in order to gather all aliases, we must iterate over everything first
+    for name, data in index.items():
+        if "alias" in data:
+            realname = data["alias"]
+            if realname not in results:
+                results[realname] = {}
+            if "aliases" in results[realname]:
+                results[realname]["aliases"].append(name)
+            else:
+                results[realname]["aliases"] = [name]
+            continue
+        if name in results:
+            results[name]["description"] = data["description"]
+        else:
+            results[name] = {"description": data["description"], "aliases": []}
+
+    filtered = {}
+    if terms:
+        for name in (
+            name
+            for name, data in results.items()
+            if any((t for t in terms if t in name))
+            or any((t for t in terms if any((s for s in data["aliases"] if t in s))))
+        ):
+            filtered[name] = results[name]
+    else:
+        filtered = results
+
+    results = filtered
+    for k, v in results.items():
+        print("{}".format(k), end="")
+        if any(v["aliases"]):
+            print(" ({})".format(", ".join(v["aliases"])), end="")
+        print(" - {}".format(v["description"]))
+
+    return 0 if any(results) else 1
+
+
+def _validate_project_path(path):
+    """Check that path is a cfbs project (file or folder), returns the path to its cfbs.json"""
+    if not os.path.exists(path):
+        raise CFBSUserError("Specified path '{}' does not exist".format(path))
+    if path.endswith(".json") and not os.path.isfile(path):
+        raise CFBSUserError(
+            "'{}' is not a file - Please specify a path to a cfbs project file, ending in .json, or a folder containing a cfbs.json".format(
+                path
+            )
+        )
+    if not path.endswith(".json") and not os.path.isfile(
+        os.path.join(path, "cfbs.json")
+    ):
+        raise CFBSUserError(
+            "No CFBS project file found at '{}'".format(os.path.join(path, "cfbs.json"))
+        )
+
+    # Convert folder to folder/cfbs.json if appropriate:
+    if not path.endswith(".json"):
+        assert os.path.isdir(path)
+        path = os.path.join(path, "cfbs.json")
+    assert os.path.isfile(path)
+    return path
+
+
+def _validation_report(path, issues, seconds):
+    report = OrderedDict()
+    report["path"] = path
+    report.update(validation_report(issues))
+    report["seconds"] = round(seconds, 3)
+    return report
+
+
+class _CollectingHandler(log.Handler):
+    """Collects log records, and what was printed to stdout before each of
+    them, as (log level or None for printed lines, message), in order."""
+
+    def __init__(self, stdout: io.StringIO):
+        super().__init__()
+        self.stdout = stdout
+        self.output = []  # type: List[Tuple[Optional[int], str]]
+
+    def flush_stdout(self):
+        lines = self.stdout.getvalue().splitlines()
+        self.stdout.seek(0)
+        self.stdout.truncate()
+        self.output.extend((None, line) for line in lines)
+
+    def emit(self, record):
+        self.flush_stdout()
+        self.output.append((record.levelno, record.getMessage()))
+
+
+@contextmanager
+def _collect_output():
+    """Collect the log messages and the output printed inside the with block,
+    instead of printing them, yields the list of them (see
+    _CollectingHandler), complete when the block finishes."""
+    root = log.getLogger()
+    handlers = root.handlers
+    collector = _CollectingHandler(io.StringIO())
+    root.handlers = [collector]
+    try:
+        with redirect_stdout(collector.stdout):
+            yield collector.output
+    finally:
+        root.handlers = handlers
+        collector.flush_stdout()
+
+
+@cfbs_command("validate")
+def validate_command(paths=None, index_arg=None, json_filename=None, jobs=None):
+    """Validate one or more projects, reporting all errors found in each.
+
+    When multiple paths are given, they share one index (so the default index
+    is downloaded / read at most once), and their cfbs.json files are read
+    concurrently by up to jobs threads. Validation is mostly Python code, so
+    the projects are validated one at a time, (only checking absolute
+    modules uses jobs threads), and a summary with the time spent validating
+    each project is printed. Warnings and other output from validating a
+    project are printed with that project's errors, prefixed by its path.
+
+    If json_filename is specified, a JSON report of the errors is written to
+    that file (with .json appended), in addition to printing them."""
+    reports = []
+
+    def write_report():
+        if json_filename is None:
+            return
+        json_dict = OrderedDict()
+        json_dict["valid"] = all(report["valid"] for report in reports)
+        json_dict["seconds"] = round(sum(report["seconds"] for report in reports), 3)
+        json_dict["projects"] = reports
+        write_json(json_filename + ".json", json_dict)
+
+    if paths:
+        # Exit out early if we find anything wrong like missing files:
+        paths = [_validate_project_path(path) for path in paths]
+
+        # Index from the --index option, or the default index, for projects
+        # which don't specify their own. Downloaded lazily, only if needed:
+        shared_index = Index(index_arg) if index_arg else get_default_index()
+
+        def load(path):
+            return CFBSJson(
+                path=path,
+                index_argument=shared_index if index_arg else None,
+                default_index=shared_index,
+            )
+
+        if len(paths) > 1 and jobs != 1:
+            with ThreadPoolExecutor(max_workers=jobs) as executor:
+                configs = list(executor.map(load, paths))
+        else:
+            configs = [load(path) for path in paths]
+
+        ret_value = 0
+        for path, config in zip(paths, configs):
+            if len(paths) > 1:
+                with _collect_output() as output:
+                    start = time.perf_counter()
+                    issues = validate_config_collect_errors(config, jobs=jobs)
+                    seconds = time.perf_counter() - start
+                for level, message in output:
+                    if level is None:
+                        print("%s: %s" % (path, message))
+                    else:
+                        log.log(level, "%s: %s" % (path, message))
+            else:
+                start = time.perf_counter()
+                issues = validate_config_collect_errors(config, jobs=jobs)
+                seconds = time.perf_counter() - start
+            for line in format_validation_issues(issues):
+                print(line)
+            if issues:
+                log.warning("Validation of project at path %s failed" % path)
+                ret_value = 1
+            else:
+                print("Successfully validated the project at path", path)
+            reports.append(_validation_report(path, issues, seconds))
+
+        if len(paths) > 1:
+            failed = sum(1 for report in reports if not report["valid"])
+            print("\nValidated %d projects, %d failed:" % (len(reports), failed))
+            for report in reports:
+                print(
+                    "%8.3fs  %-6s %s"
+                    % (
+                        report["seconds"],
+                        "OK" if report["valid"] else "FAILED",
+                        report["path"],
+                    )
+                )
+
+        write_report()
+        return ret_value
+
+    if not is_cfbs_repo():
+        # TODO change CFBSExitError to CFBSUserError here
+        raise CFBSExitError(
+            "Cannot validate: this is not a CFBS project. "
+            + "Use `cfbs init` to start a new project in this directory, or provide a path to a CFBS project to validate."
+        )
+
+    config = CFBSConfig.get_instance()
+    start = time.perf_counter()
+    issues = validate_config_collect_errors(config)
+    print_validation_issues(issues)
+    reports.append(_validation_report(config.path, issues, time.perf_counter() - start))
+    write_report()
+    return 1 if issues else 0
+
+
+def _print_module_info(data):
+    def human_readable(key: str):
+        if key == "repo":
+            return "Repository"
+        if key == "url":
+            return "URL"
+        return key.title().replace("_", " ")
+
+    ordered_keys = [
+        "module",
+        "description",
+        "tags",
+        "dependencies",
+        "index",
+        "subdirectory",
+        "url",
+        "repo",
+        "version",
+        "branch",
+        "commit",
+        "by",
+        "status",
+    ]
+    for key in ordered_keys:
+        if key in data:
+            if key in ["tags", "dependencies"]:
+                value = ", ".join(data[key])
+            else:
+                value = data[key]
+            print("{}: {}".format(human_readable(key), value))
+
+
+@cfbs_command("show")
+@cfbs_command("info")
+def info_command(modules: List[str]):
+    if not modules:
+        raise CFBSExitError(
+            "info/show command requires one or more module names as arguments"
+        )
+    config = CFBSConfig.get_instance()
+    config.warn_about_unknown_keys()
+    index = config.index
+
+    build = config.get("build", [])
+    assert isinstance(build, list)
+
+    alias = None
+
+    for module in modules:
+        print()  # whitespace for readability
+        in_build = any(m for m in build if m["name"] == module)
+        if not index.exists(module) and not in_build:
+            print("Module '{}' does not exist".format(module))
+            continue
+        if in_build:
+            # prefer information from the local source
+            data = next(m for m in build if m["name"] == module)
+            status_text = "Added"
+        elif module in index:
+            data = index[module]
+            if "alias" in data:
+                alias = module
+                module = data["alias"]
+                data = index[module]
+            status_text = "Added" if in_build else "Not added"
+        else:
+            if not module.startswith("./"):
+                module = "./" + module
+            data = next((m for m in build if m["name"] == module), None)
+            if data is None:
+                print("Path {} exists but is not yet added as a module.".format(module))
+                continue
+            status_text = "Added"
+
+        if status_text == "Added":
+            if "added_by" in data:
+                if data["added_by"] == "cfbs convert":
+                    status_text = "Added during 'cfbs convert'"
+                elif data["added_by"] == "cfbs init":
+                    if "url" in data:
+                        status_text = "Added from URL (not from default index)"
+                    else:
+                        status_text = "Added from name"
+                    status_text += " during 'cfbs init'"
+                elif data["added_by"].startswith("cfbs "):
+                    # normally "cfbs add" - written more generally as a safer fallback
+                    if "url" in data:
+                        status_text = (
+                            "Added by 'cfbs add <url>', not from default index"
+                        )
+                    else:
+                        status_text = "Added by 'cfbs add <module-name>'"
+                else:
+                    status_text = "Added by %s as a dependency" % data["added_by"]
+
+            if "input" in data:
+                input_path = os.path.join(data["name"], "input.json")
+                if not input_path.startswith("./"):
+                    input_path = "./" + input_path
+                if os.path.isfile(input_path):
+                    status_text += ", has input in %s" % input_path
+                else:
+                    status_text += ", supports input (but has no input yet)"
+        data["status"] = status_text
+        data["module"] = (module + "({})".format(alias)) if alias else module
+        _print_module_info(data)
+    print()  # extra line for ease of reading
+    return 0
@@ -0,0 +1,351 @@
+"""cfbs serve - answer cfbs commands from a long running process
+
+CI jobs and editor integrations run commands like `cfbs status` and
+`cfbs validate` many times per minute. Each run imports cfbs, reads
+cfbs.json and downloads the index again. `cfbs serve` keeps all of that in
+memory (warm), and answers command requests on a Unix socket, using JSON-RPC
+2.0 (one JSON object per line, in both directions).
+
+The client side is run_on_server(), called from main.py for the read-only
+commands in SERVED_COMMANDS. When no server is running for the current
+directory (or it doesn't answer properly), the command runs in-process as
+usual, so the server is only ever an optimization.
+
+Methods:
+- "run", params {"argv": [...]}: Run a cfbs command (argv without "cfbs"),
+  result {"exit_code": int, "stdout": str, "stderr": str}
+- "ping": result {"pid": int, "directory": str}
+- "reload": Forget cfbs.json and the downloaded indexes, result null
+- "shutdown": Stop the server, after answering, result null
+
+Requests are handled one at a time, commands use global state (the
+CFBSConfig singleton, sys.argv, sys.stdout). Connections which stay idle
+for IDLE_TIMEOUT seconds are closed, so one client can't block the server,
+and clients give up on a server which doesn't answer within CLIENT_TIMEOUT
+seconds, running the command in-process instead.
+
+Only this module's client side (and what main.py already needs) is imported
+at startup, the server side imports the rest when the server is started.
+"""
+
+import hashlib
+import json
+import logging as log
+import os
+import socket
+import sys
+from typing import Optional
+
+from cfbs.utils import CFBSExitError, cfbs_dir
+
+# Commands which only read the project, answered by the server:
+SERVED_COMMANDS = ("status", "validate", "info", "show", "search")
+
+# JSON-RPC 2.0 error codes:
+PARSE_ERROR = -32700
+INVALID_REQUEST = -32600
+METHOD_NOT_FOUND = -32601
+INVALID_PARAMS = -32602
+INTERNAL_ERROR = -32603
+
+# Seconds the server waits for the next request on a connection:
+IDLE_TIMEOUT = 2.0
+# Seconds run_on_server() waits for the server (busy with another client,
+# or stuck), before running the command in-process:
+CLIENT_TIMEOUT = 30.0
+
+# Set in the server process, so commands run by it don't ask the server:
+_in_server = False
+
+
+def socket_path(directory=None) -> str:
+    """Path of the socket for the server of a directory (default: current).
+
+    The socket is in the cfbs directory (not in the project) and named after
+    a hash of the directory, since paths of Unix sockets have to be short.
+    """
+    directory = os.path.realpath(directory or os.getcwd())
+    digest = hashlib.sha256(directory.encode("utf-8")).hexdigest()[0:16]
+    return cfbs_dir(os.path.join("serve", digest + ".sock"))
+
+
+class CFBSServeError(Exception):
+    """JSON-RPC error response from the server, or an invalid response"""
+
+    def __init__(self, code, message):
+        super().__init__("%s (%s)" % (message, code))
+        self.code = code
+        self.message = message
+
+
+def call(method: str, params=None, path=None, timeout=None):
+    """Send one JSON-RPC request to a server, and return the result.
+
+    Raises OSError if there is no server (or it stopped, or didn't answer
+    within timeout seconds: socket.timeout), CFBSServeError for error
+    responses."""
+    request = {"jsonrpc": "2.0", "id": 1, "method": method}
+    if params is not None:
+        request["params"] = params
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(path or socket_path())
+        sock.sendall((json.dumps(request) + "\n").encode("utf-8"))
+        with sock.makefile("r", encoding="utf-8") as f:
+            line = f.readline()
+    try:
+        response = json.loads(line)
+    except ValueError:
+        raise CFBSServeError(PARSE_ERROR, "Invalid response from server")
+    if not isinstance(response, dict):
+        raise CFBSServeError(INVALID_REQUEST, "Invalid response from server")
+    error = response.get("error")
+    if error is not None:
+        raise CFBSServeError(error.get("code"), error.get("message"))
+    return response.get("result")
+
+
+def run_on_server(argv) -> Optional[int]:
+    """Run a command on the server for the current directory, if there is one.
+
+    Prints the output of the command, and returns its exit code, or None if
+    the command should run in-process instead."""
+    if _in_server:
+        return None
+    path = socket_path()
+    if not os.path.exists(path):
+        return None
+    try:
+        result = call("run", {"argv": list(argv)}, path, timeout=CLIENT_TIMEOUT)
+    except (socket.timeout, OSError, CFBSServeError) as e:
+        log.debug("Not using cfbs server at '%s': %s" % (path, e))
+        return None
+    if not isinstance(result, dict) or type(result.get("exit_code")) is not int:
+        log.debug("Not using cfbs server at '%s': Invalid result" % path)
+        return None
+    sys.stdout.write(result.get("stdout", ""))
+    sys.stdout.flush()
+    sys.stderr.write(result.get("stderr", ""))
+    return result["exit_code"]
+
+
+class _CurrentStderrHandler(log.StreamHandler):
+    """Logs to whatever sys.stderr currently is (captured per request),
+    instead of the sys.stderr at the time the handler was created."""
+
+    @property
+    def stream(self):
+        return sys.stderr
+
+    @stream.setter
+    def stream(self, value):
+        pass
+
+
+def _stat(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+class _Server:
+    def __init__(self, directory):
+        self.directory = directory
+        self.stopping = False
+        # The warm CFBSConfig is reused as long as cfbs.json is unchanged
+        # (same mtime and size) and the options used to create it are the same:
+        self.config_key = None
+
+    def _prepare_config(self, args):
+        from cfbs.cfbs_config import CFBSConfig
+
+        key = (_stat("cfbs.json"), args.index, args.non_interactive)
+        if key != self.config_key:
+            CFBSConfig.instance = None
+            self.config_key = key
+
+    def reload(self):
+        from cfbs.cfbs_config import CFBSConfig
+        from cfbs.index import reset_default_index
+
+        CFBSConfig.instance = None
+        self.config_key = None
+        reset_default_index()
+
+    def run(self, argv):
+        import contextlib
+        import io
+
+        from cfbs.args import get_arg_parser
+        from cfbs.main import main
+
+        try:
+            with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(
+                io.StringIO()
+            ):
+                args = get_arg_parser().parse_args(argv)
+        except SystemExit:
+            args = None  # Let the client run it, and print the usage / help
+        if args is None or args.command not in SERVED_COMMANDS:
+            raise CFBSServeError(
+                INVALID_PARAMS, "Only %s are served" % ", ".join(SERVED_COMMANDS)
+            )
+
+        self._prepare_config(args)
+        # Undo log level changes from the previous request (init_logging()
+        # doesn't change the level when logging is already configured):
+        log.disable(log.NOTSET)
+        level = getattr(log, args.loglevel.strip().upper(), None)
+        log.getLogger().setLevel(level if type(level) is int else log.WARNING)
+
+        stdout = io.StringIO()
+        stderr = io.StringIO()
+        old_argv = sys.argv
+        sys.argv = ["cfbs"] + argv
+        try:
+            with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+                try:
+                    exit_code = main()
+                except SystemExit as e:
+                    # Same as the Python interpreter does with sys.exit():
+                    if e.code is None or type(e.code) is int:
+                        exit_code = e.code or 0
+                    else:
+                        print(e.code, file=sys.stderr)
+                        exit_code = 1
+        finally:
+            sys.argv = old_argv
+            os.chdir(self.directory)
+        return {
+            "exit_code": exit_code,
+            "stdout": stdout.getvalue(),
+            "stderr": stderr.getvalue(),
+        }
+
+    def handle(self, line):
+        """Handle one JSON-RPC request (line), returns the response, or None
+        for notifications (requests without id)."""
+        try:
+            request = json.loads(line)
+        except ValueError:
+            return _error_response(None, PARSE_ERROR, "Parse error")
+        if not isinstance(request, dict) or not isinstance(request.get("method"), str):
+            return _error_response(None, INVALID_REQUEST, "Invalid request")
+
+        request_id = request.get("id")
+        method = request["method"]
+        params = request.get("params", {})
+        try:
+            if method == "run":
+                argv = params.get("argv") if isinstance(params, dict) else None
+                if not isinstance(argv, list) or not all(
+                    isinstance(arg, str) for arg in argv
+                ):
+                    raise CFBSServeError(
+                        INVALID_PARAMS, "argv must be a list of strings"
+                    )
+                result = self.run(argv)
+            elif method == "ping":
+                result = {"pid": os.getpid(), "directory": self.directory}
+            elif method == "reload":
+                self.reload()
+                result = None
+            elif method == "shutdown":
+                self.stopping = True
+                result = None
+            else:
+                raise CFBSServeError(METHOD_NOT_FOUND, "Method not found")
+        except CFBSServeError as e:
+            return _error_response(request_id, e.code, e.message)
+        except Exception as e:
+            # Keep serving, the client will run the command in-process:
+            log.exception("Unexpected error in cfbs server")
+            return _error_response(request_id, INTERNAL_ERROR, "Internal error: %s" % e)
+        if "id" not in request:
+            return None
+        return {"jsonrpc": "2.0", "id": request_id, "result": result}
+
+
+def _error_response(request_id, code, message):
+    return {
+        "jsonrpc": "2.0",
+        "id": request_id,
+        "error": {"code": code, "message": message},
+    }
+
+
+def _remove_stale_socket(path):
+    if not os.path.exists(path):
+        return
+    try:
+        call("ping", path=path, timeout=5)
+    except OSError:
+        os.unlink(path)  # Left behind by a server which didn't stop cleanly
+        return
+    except CFBSServeError:
+        pass
+    raise CFBSExitError("A cfbs server is already running for this directory")
+
+
+def serve(path=None) -> int:
+    """Run a server for the current directory until interrupted (Ctrl-C,
+    SIGTERM) or asked to shut down."""
+    global _in_server
+    import signal
+    import socketserver
+
+    directory = os.getcwd()
+    path = path or socket_path(directory)
+    os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+    _remove_stale_socket(path)
+
+    server_state = _Server(directory)
+
+    class Handler(socketserver.StreamRequestHandler):
+        timeout = IDLE_TIMEOUT
+
+        def handle(self):
+            try:
+                for line in self.rfile:
+                    response = server_state.handle(line.decode("utf-8", "replace"))
+                    if response is not None:
+                        data = json.dumps(response) + "\n"
+                        self.wfile.write(data.encode("utf-8"))
+                        self.wfile.flush()
+                    if server_state.stopping:
+                        break
+            except socket.timeout:
+                log.debug("Closing idle connection")
+            except OSError as e:
+                log.debug("Connection closed: %s" % e)
+
+    def stop(signum, frame):
+        raise KeyboardInterrupt()
+
+    root = log.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    handler = _CurrentStderrHandler()
+    handler.setFormatter(log.Formatter("%(levelname)s: %(message)s"))
+    root.addHandler(handler)
+
+    _in_server = True
+    server = socketserver.UnixStreamServer(path, Handler)
+    try:
+        os.chmod(path, 0o600)
+        signal.signal(signal.SIGTERM, stop)
+        print("Serving cfbs commands for '%s' on '%s'" % (directory, path))
+        sys.stdout.flush()
+        while not server_state.stopping:
+            server.handle_request()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        _in_server = False
+        if os.path.exists(path):
+            os.unlink(path)
+    print("Stopped cfbs server for '%s'" % directory)
+    return 0
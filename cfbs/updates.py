@@ -1,7 +1,19 @@
 import copy
 import os
+import re
 import logging as log
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from subprocess import CalledProcessError
+from typing import Optional
 
+from cfbs.git import head_commit_hash
+from cfbs.index import Index
+from cfbs.internal_file_management import (
+    forget_remote_refs,
+    resolve_remote_reference,
+)
+from cfbs.module import Module, is_module_absolute
 from cfbs.prompts import prompt_user_yesno
 from cfbs.utils import read_json, CFBSExitError, write_json
 
@@ -225,3 +237,108 @@ def update_module(old_module, new_module, module_updates, update):
         print("Module '%s' already up to date" % old_module["name"])
 
     module_updates.changes_made |= local_changes_made
+
+
+def version_numbers(version: str) -> list:
+    """Version string as a list of numbers, for comparing versions"""
+    return [int(number) for number in re.split(r"[-\.]", version)]
+
+
+def _check_module_update(module, index) -> OrderedDict:
+    name = module["name"]
+    result = OrderedDict()
+    result["name"] = name
+    if "url" in module:
+        result["source"] = "url"
+        result["current"] = module.get("commit")
+        result["available"] = resolve_remote_reference(
+            module["url"], module.get("branch") or "HEAD"
+        )
+        if result["available"] is None:
+            result["error"] = "Failed to find branch %s at %s" % (
+                module.get("branch") or "HEAD",
+                module["url"],
+            )
+    elif is_module_absolute(name):
+        result["source"] = "absolute"
+        result["current"] = module.get("commit")
+        try:
+            result["available"] = head_commit_hash(name)
+        except (CalledProcessError, OSError):
+            result["available"] = None
+            result["error"] = "'%s' is not a git repository" % name
+    else:
+        result["source"] = "index"
+        result["current"] = module["version"]
+        index_info = index.get(name)
+        result["available"] = index_info.get("version") if index_info else None
+        if result["available"] is None:
+            result["error"] = "Module '%s' not present in the index" % name
+    if result["available"] is None:
+        result["update_available"] = False
+    elif result["source"] == "index":
+        result["update_available"] = version_numbers(
+            result["current"]
+        ) != version_numbers(result["available"])
+    else:
+        result["update_available"] = result["current"] != result["available"]
+    return result
+
+
+def check_updates(config, to_update=None, jobs: Optional[int] = None) -> list:
+    """Find out which modules in the build list have updates available,
+    without changing anything (no cfbs.json changes, no downloads of module
+    files), for cfbs update --check.
+
+    Versions of modules from an index are looked up in the index (downloaded
+    once, and shared by all modules using it), the latest commits of modules
+    added by URL are found by listing the refs of each remote once (git
+    ls-remote), and the modules are checked at the same time, in up to jobs
+    threads.
+
+    Returns a list with an OrderedDict for each module (name, source,
+    current, available, update_available, and error, if the available
+    version could not be found). Modules which can't be updated (local
+    modules, modules without a version) are left out.
+    """
+    forget_remote_refs()
+    build = config.get("build", [])
+    if to_update:
+        modules = []
+        for name in to_update:
+            update = Module(name)
+            module = config.get_module_from_build(update.name)
+            if module is None:
+                config.index.translate_alias(update)
+                module = config.get_module_from_build(update.name)
+            if module is None:
+                log.warning("Module '%s' not in build. Skipping it." % update.name)
+                continue
+            modules.append(module)
+    else:
+        modules = build
+
+    indexes = {}  # Index of each module, the same Index for the same index
+    other_indexes = {}  # Indexes specified in modules, by URL / path
+    checked = []
+    for module in modules:
+        if "url" not in module and not is_module_absolute(module["name"]):
+            if "version" not in module:
+                log.debug("Module '%s' is not updatable." % module["name"])
+                continue
+            if "index" not in module:
+                indexes[module["name"]] = config.index
+            else:
+                key = str(module["index"])
+                if key not in other_indexes:
+                    other_indexes[key] = Index(module["index"])
+                indexes[module["name"]] = other_indexes[key]
+        checked.append(module)
+
+    def check(module):
+        return _check_module_update(module, indexes.get(module["name"]))
+
+    if jobs == 1 or len(checked) <= 1:
+        return [check(module) for module in checked]
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        return list(executor.map(check, checked))
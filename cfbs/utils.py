@@ -1,5 +1,5 @@
-import difflib
 import shutil
+import shlex
 import os
 import re
 import sys
@@ -7,17 +7,15 @@ import json
 import copy
 import subprocess
 import hashlib
-import urllib
-import urllib.request  # needed on some platforms
-import urllib.error
+import threading
+import time
 from collections import OrderedDict
 from contextlib import contextmanager
 from pathlib import Path
 from shutil import rmtree
 from typing import IO, Iterable, Iterator, List, Optional, Tuple, Union
-import filecmp
 
-from cfbs.pretty import pretty
+from cfbs.pretty import pretty_write
 
 SHA1_RE = re.compile(r"^[0-9a-f]{40}$")
 SHA256_RE = re.compile(r"^[0-9a-f]{64}$")
@@ -86,10 +84,38 @@ class CFBSValidationError(Exception):
             super().__init__("Error in cfbs.json for module '%s': " % name + message)
 
 
+# Number of subprocesses started by cfbs in this process (shells, git,
+# patch, etc.), see subprocess_count():
+_subprocess_count = 0
+_subprocess_count_lock = threading.Lock()
+
+
+def subprocess_count() -> int:
+    """Number of subprocesses started so far (in any thread), compare the
+    values before and after an operation to see how many it started."""
+    return _subprocess_count
+
+
+def counted_subprocess(function):
+    """Wrap a function from the subprocess module (run, check_call, etc.),
+    so calls are counted in subprocess_count()."""
+
+    def wrapper(*args, **kwargs):
+        global _subprocess_count
+        with _subprocess_count_lock:
+            _subprocess_count += 1
+        return function(*args, **kwargs)
+
+    return wrapper
+
+
+_run = counted_subprocess(subprocess.run)
+
+
 def _sh(cmd: str):
     # print(cmd)
     try:
-        return subprocess.run(
+        return _run(
             cmd,
             shell=True,
             check=True,
@@ -102,53 +128,24 @@ def _sh(cmd: str):
 
 def sh(cmd: str, directory=None):
     if directory:
-        return _sh("cd %s && %s" % (directory, cmd))
+        return _sh("cd %s && %s" % (shlex.quote(directory), cmd))
     return _sh(cmd)
 
 
 def cli_tool_present(name: str):
     """Returns whether the CLI tool `name` exists on the system."""
-    try:
-        subprocess.check_call(
-            ["command -v " + name], stdout=subprocess.DEVNULL, shell=True
-        )
-        return True
-    except subprocess.CalledProcessError:
-        return False
+    return shutil.which(name) is not None
 
 
 def display_diff(path_A, path_B):
     """Also displays `stderr`."""
     cmd = "diff -u " + path_A + " " + path_B
     # `diff`'s exit code is 1 for success when there's a difference, so don't use `check=True`
-    cp = subprocess.run(cmd, shell=True)
+    cp = _run(cmd, shell=True)
     if cp.returncode not in (0, 1):
         raise
 
 
-def file_diff(filepath_A, filepath_B, target_A=None, target_B=None):
-    with open(filepath_A) as f:
-        lines_A = f.readlines()
-    with open(filepath_B) as f:
-        lines_B = f.readlines()
-
-    if target_A is None:
-        target_A = filepath_A
-    if target_B is None:
-        target_B = filepath_B
-
-    u_diff = difflib.unified_diff(lines_A, lines_B, target_A, target_B)
-
-    return u_diff
-
-
-def file_diff_text(filepath_A, filepath_B, target_A=None, target_B=None):
-    u_diff = file_diff(filepath_A, filepath_B, target_A, target_B)
-    diff_text = "".join(u_diff)
-
-    return diff_text
-
-
 def mkdir(path: str, exist_ok=True):
     os.makedirs(path, exist_ok=exist_ok)
 
@@ -158,7 +155,13 @@ def touch(path: str):
         above = os.path.dirname(path)
         if not os.path.exists(above):
             mkdir(above)
-    sh("touch %s" % path)
+    Path(path).touch()
+
+
+def append_file(src: str, dst: str):
+    """Append the contents of the file src to the file dst (like cat src >> dst)."""
+    with open(src, "rb") as src_file, open(dst, "ab") as dst_file:
+        shutil.copyfileobj(src_file, dst_file)
 
 
 def rm(path: str, missing_ok=False):
@@ -186,32 +189,73 @@ def cp_dry_overwrites(src: str, dst: str) -> Tuple[List[str], List[str]]:
     noop_overwrites_relpaths = []
     modifying_overwrites_relpaths = []
 
+    for src_file, dst_file, rel_path in _copied_files(src, dst):
+        if not os.path.isfile(dst_file):
+            continue  # new file, not an overwrite
+        if same_file_content(src_file, dst_file):
+            noop_overwrites_relpaths.append(rel_path)
+        else:
+            modifying_overwrites_relpaths.append(rel_path)
+
+    return noop_overwrites_relpaths, modifying_overwrites_relpaths
+
+
+def _copied_files(src: str, dst: str, make_dirs=False):
+    """(source file, destination file, path relative to dst) of each file
+    copied by cp(src, dst), optionally creating the destination directories"""
     if os.path.isfile(src):
+        if make_dirs:
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
         dst_file = (
             os.path.join(dst, os.path.basename(src)) if os.path.isdir(dst) else dst
         )
-        if os.path.isfile(dst_file):
-            target = os.path.basename(dst_file)
-            if filecmp.cmp(src, dst_file, shallow=False):
-                noop_overwrites_relpaths.append(target)
-            else:
-                modifying_overwrites_relpaths.append(target)
-        return noop_overwrites_relpaths, modifying_overwrites_relpaths
+        yield src, dst_file, os.path.basename(dst_file)
+        return
 
-    for dirpath, _, filenames in os.walk(src):
+    for dirpath, _, filenames in os.walk(src, followlinks=True):
         rel_dir = os.path.relpath(dirpath, src)  # "." at top level
+        if make_dirs:
+            os.makedirs(os.path.normpath(os.path.join(dst, rel_dir)), exist_ok=True)
         for filename in filenames:
-            src_file = os.path.join(dirpath, filename)
             rel_path = filename if rel_dir == "." else os.path.join(rel_dir, filename)
-            dst_file = os.path.join(dst, rel_path)
-
-            if not os.path.isfile(dst_file):
-                continue  # new file, not an overwrite
+            yield os.path.join(dirpath, filename), os.path.join(dst, rel_path), rel_path
+
+
+def cp_overwrites(
+    src: str,
+    dst: str,
+    before_overwrite=None,
+    same_content=None,
+    after_copy=None,
+) -> Tuple[List[str], List[str]]:
+    """Copy like cp(src, dst), walking src once, and return the paths of
+    the files which were already there, like cp_dry_overwrites(): identical
+    and non-identical overwrites.
+
+    Files identical to the files already there (according to
+    same_content(src_file, dst_file), same_file_content() by default) are
+    not copied again, only their permissions are. before_overwrite(src_file, dst_file, rel_path) is
+    called before overwriting a file with different content (for example,
+    to diff them), after_copy(src_file, dst_file, rel_path) for each file
+    once it is in place.
+    """
+    noop_overwrites_relpaths = []
+    modifying_overwrites_relpaths = []
+    if same_content is None:
+        same_content = same_file_content
 
-            if filecmp.cmp(src_file, dst_file, shallow=False):
-                noop_overwrites_relpaths.append(rel_path)
-            else:
+    for src_file, dst_file, rel_path in _copied_files(src, dst, make_dirs=True):
+        if os.path.isfile(dst_file) and same_content(src_file, dst_file):
+            noop_overwrites_relpaths.append(rel_path)
+            shutil.copymode(src_file, dst_file)
+        else:
+            if os.path.isfile(dst_file):
                 modifying_overwrites_relpaths.append(rel_path)
+                if before_overwrite is not None:
+                    before_overwrite(src_file, dst_file, rel_path)
+            shutil.copy2(src_file, dst_file)
+        if after_copy is not None:
+            after_copy(src_file, dst_file, rel_path)
 
     return noop_overwrites_relpaths, modifying_overwrites_relpaths
 
@@ -226,10 +270,9 @@ def pad_right(s, n):
 
 def get_json(url: str) -> OrderedDict:
     try:
-        with urllib.request.urlopen(url) as r:
-            assert r.status >= 200 and r.status < 300
+        with open_url(url) as r:
             return json.loads(r.read().decode(), object_pairs_hook=OrderedDict)
-    except urllib.error.URLError as e:
+    except (CFBSNetworkError, OSError) as e:
         raise CFBSNetworkError("Failed to get JSON from '%s'" % url) from e
 
 
@@ -327,9 +370,50 @@ def read_json(path) -> Union[OrderedDict, None]:
         sys.exit(1)
 
 
+@contextmanager
+def atomic_open(path) -> Iterator[IO]:
+    """Open a file for writing (text), replacing it atomically on success.
+
+    Output goes to a temporary file in the same directory, which is renamed
+    to path when the with block finishes. If an exception is raised, the
+    temporary file is removed and the original file is left untouched, so
+    readers never see a partially written file. The permissions of an
+    existing file are kept, and symlinks are followed (the target file is
+    replaced, not the link).
+    """
+    path = os.path.realpath(path)
+    directory = os.path.dirname(path)
+    if not os.path.exists(directory):
+        mkdir(directory)
+    try:
+        mode = os.stat(path).st_mode & 0o7777  # type: Optional[int]
+    except FileNotFoundError:
+        mode = None  # New files get the same mode as with open(), after umask
+
+    while True:
+        tmp_path = "%s.%s.tmp" % (path, os.urandom(4).hex())
+        try:
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+            break
+        except FileExistsError:
+            continue
+    try:
+        with os.fdopen(fd, "w") as f:
+            if mode is not None:
+                # The mode given to os.open() is restricted by the umask:
+                os.chmod(tmp_path, mode)
+            yield f
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
 def write_json(path, data):
-    data = pretty(data) + "\n"
-    return save_file(path, data)
+    """Write data as pretty JSON to path, atomically"""
+    with atomic_open(path) as f:
+        pretty_write(data, f)
+        f.write("\n")
 
 
 def merge_json(a, b, overwrite_callback=None, stack=None):
@@ -480,34 +564,87 @@ def file_sha256(file):
     h = hashlib.sha256()
 
     with open(file, "rb") as f:
-        h.update(f.read())
+        for chunk in iter(lambda: f.read(512 * 1024), b""):
+            h.update(chunk)
 
     return h.hexdigest()
 
 
-def fetch_url(url, target, checksum=None):
-    if checksum is not None:
-        if SHA1_RE.match(checksum):
-            sha = hashlib.sha1()
-        elif SHA256_RE.match(checksum):
-            sha = hashlib.sha256()
-        else:
-            raise CFBSNetworkError(
-                "Invalid checksum or unsupported checksum algorithm: '%s'" % checksum
-            )
-    else:
-        sha = hashlib.sha1()
+# SHA-256 of files, keyed on (path, size, mtime, ctime, inode), to compare
+# the same files again without reading them, see cached_file_sha256():
+_file_hashes = {}  # type: dict
+_file_hashes_lock = threading.Lock()
+
+# Like git, hashes of files changed this recently (in seconds) are not kept,
+# another change in the same timestamp granularity would go unnoticed:
+_RACY_SECONDS = 2
 
-    headers = dict()
-    user_agent = os.environ.get("CFBS_USER_AGENT")
-    if user_agent is not None:
-        headers["User-Agent"] = user_agent
-    request = urllib.request.Request(url, headers=headers)
+
+def changed_recently(timestamp: float) -> bool:
+    """Whether a file changed at timestamp (seconds) is too recent to
+    remember anything about it based on its timestamps"""
+    return time.time() - timestamp <= _RACY_SECONDS
+
+
+def cached_file_sha256(path: str) -> str:
+    """file_sha256(), remembered for as long as the file doesn't change"""
+    stat = os.stat(path)
+    key = (path, stat.st_size, stat.st_mtime_ns, stat.st_ctime_ns, stat.st_ino)
+    with _file_hashes_lock:
+        digest = _file_hashes.get(key)
+    if digest is not None:
+        return digest
+    digest = file_sha256(path)
+    if not changed_recently(max(stat.st_mtime, stat.st_ctime)):
+        with _file_hashes_lock:
+            _file_hashes[key] = digest
+    return digest
+
+
+def same_file_content(path_a: str, path_b: str) -> bool:
+    """Whether two files have the same content, comparing the sizes first,
+    then SHA-256 hashes (cached_file_sha256())."""
+    if os.path.getsize(path_a) != os.path.getsize(path_b):
+        return False
+    return cached_file_sha256(path_a) == cached_file_sha256(path_b)
+
+
+def checksum_hash(checksum: Optional[str] = None):
+    """New hashlib object for computing (and then comparing to) checksum,
+    SHA-1 or SHA-256 depending on its length, SHA-1 when there is none."""
+    if checksum is None or SHA1_RE.match(checksum):
+        return hashlib.sha1()
+    if SHA256_RE.match(checksum):
+        return hashlib.sha256()
+    raise CFBSNetworkError(
+        "Invalid checksum or unsupported checksum algorithm: '%s'" % checksum
+    )
+
+
+def open_url(url: str):
+    """Send a GET request for url, returns the response to read the body from
+    (use it as a context manager). Raises CFBSNetworkError on errors.
+
+    Uses the HTTP client shared by all of cfbs (see http_client.py), reusing
+    connections, and retrying failed requests."""
+    # Imported here, http.client (and ssl) are not needed to start cfbs:
+    from cfbs.http_client import get_http_client
+
+    response = get_http_client().get(url)
+    if not (200 <= (response.status or 0) <= 300):
+        response.read()
+        response.close()
+        raise CFBSNetworkError(
+            "Failed to fetch '%s': HTTP %s %s" % (url, response.status, response.reason)
+        )
+    return response
+
+
+def fetch_url(url, target, checksum=None):
+    sha = checksum_hash(checksum)
     try:
         with open(target, "wb") as f:
-            with urllib.request.urlopen(request) as u:
-                if not (200 <= u.status <= 300):
-                    raise CFBSNetworkError("Failed to fetch '%s': %s" % (url, u.reason))
+            with open_url(url) as u:
                 done = False
                 while not done:
                     chunk = u.read(512 * 1024)  # 512 KiB
@@ -529,10 +666,10 @@ def fetch_url(url, target, checksum=None):
                 )
         else:
             return digest
-    except urllib.error.URLError as e:
+    except CFBSNetworkError:
         if os.path.exists(target):
             os.unlink(target)
-        raise CFBSNetworkError("Failed to fetch '%s': %s" % (url, e)) from e
+        raise
     except OSError as e:
         if os.path.exists(target):
             os.unlink(target)
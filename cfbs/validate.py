@@ -30,12 +30,16 @@ TODOs:
    code in one place.
 """
 
+import json
 import logging as log
 import os
 import re
 from collections import OrderedDict
-from typing import List, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import List, NamedTuple, Optional, Tuple, Union
 
+from cfbs.dependency_graph import DependencyGraph
 from cfbs.git import is_git_repo, treeish_exists
 from cfbs.module import is_module_absolute, is_module_local
 from cfbs.utils import (
@@ -63,11 +67,37 @@ AVAILABLE_BUILD_STEPS = {
     "patch": 1,
 }
 
+# One validation error, with the JSON path of the offending part of cfbs.json
+# (for example $.index["autorun"] or $.build[2]), and the name (or position)
+# of the module it is about, if any:
+ValidationIssue = NamedTuple(
+    "ValidationIssue",
+    [
+        ("path", str),
+        ("module", Optional[Union[str, int]]),
+        ("error", CFBSValidationError),
+    ],
+)
+
 # Constants / regexes / limits for validating build steps:
 MAX_REPLACEMENTS = 1000
 FILENAME_RE = r"[-_/a-zA-Z0-9\.]+"
 MAX_FILENAME_LENGTH = 128
 MAX_BUILD_STEP_LENGTH = 256
+MAX_MODULE_NAME_LENGTH = 64
+VERSION_RE = r"(0|[1-9][0-9]*)\.(0|[1-9][0-9]*)\.(0|[1-9][0-9]*)(-([0-9]+))?"
+# lowercase ASCII alphanumericals, starting with a letter, and possible singular dashes in the middle
+MODULE_NAME_RE = r"[a-z][a-z0-9]*(-[a-z0-9]+)*"
+
+# Validation runs for every module in an index with thousands of modules,
+# so the regexes are compiled once, here, instead of in each function call:
+_FILENAME_REGEX = re.compile(FILENAME_RE)
+_VERSION_REGEX = re.compile(VERSION_RE)
+_MODULE_NAME_REGEX = re.compile(MODULE_NAME_RE)
+_NOT_MODULE_NAME_CHARS_REGEX = re.compile(r"[^a-z0-9]+")
+_INPUT_VARIABLE_REGEX = re.compile(r"[a-z_]+")
+_INPUT_NAMESPACE_REGEX = re.compile(r"[a-z_][a-z0-9_]+")
+_INPUT_BUNDLE_REGEX = re.compile(r"[a-z_]+")
 
 
 def validate_index_string(index):
@@ -95,28 +125,32 @@ def split_build_step(command) -> Tuple[str, List[str]]:
     return operation, args
 
 
-def step_has_valid_arg_count(args, expected):
-    actual = len(args)
-
+def _parse_arg_count(expected) -> Tuple[int, bool]:
+    """Convert an argument count from AVAILABLE_BUILD_STEPS to (count, or_more)"""
     if type(expected) is int:
-        if actual != expected:
-            return False
+        return expected, False
+    # Only other option is a string of 1+, 2+ or similar:
+    assert type(expected) is str and expected.endswith("+")
+    return int(expected[0:-1]), True
 
-    else:
-        # Only other option is a string of 1+, 2+ or similar:
-        assert type(expected) is str and expected.endswith("+")
-        expected = int(expected[0:-1])
-        if actual < expected:
-            return False
 
-    return True
+_ARG_COUNTS = {
+    operation: _parse_arg_count(expected)
+    for operation, expected in AVAILABLE_BUILD_STEPS.items()
+}
+
+
+def step_has_valid_arg_count(args, expected):
+    count, or_more = _parse_arg_count(expected)
+    if or_more:
+        return len(args) >= count
+    return len(args) == count
 
 
 def _validate_top_level_keys(config):
-    # Convert the CFBSJson object to a simple dictionary with exactly
-    # what was in the file. We don't want CFBSJson / CFBSConfig to do any
-    # translations here:
-    config = config.raw_data
+    # config is the raw data of the CFBSJson object, a simple dictionary
+    # with exactly what was in the file. We don't want CFBSJson / CFBSConfig
+    # to do any translations here.
 
     # Check that required fields are there:
 
@@ -203,8 +237,6 @@ def validate_absolute_module(name_path, module):
 
 
 def validate_module_name_content(name):
-    MAX_MODULE_NAME_LENGTH = 64
-
     if is_module_absolute(name):
         for component in name.split("/"):
             if len(component) > MAX_MODULE_NAME_LENGTH:
@@ -223,8 +255,6 @@ def validate_module_name_content(name):
                 + " characters)",
             )
 
-    # lowercase ASCII alphanumericals, starting with a letter, and possible singular dashes in the middle
-    r = "[a-z][a-z0-9]*(-[a-z0-9]+)*"
     proper_name = name
 
     if is_module_local(name) or is_module_absolute(name):
@@ -275,8 +305,10 @@ def validate_module_name_content(name):
         )
 
     # build a suggested fix for the module name:
-    suggested_proper_name = re.sub(r"[^a-z0-9]+", "-", proper_name.lower()).strip("-")
-    if suggested_proper_name and re.fullmatch(r, suggested_proper_name):
+    suggested_proper_name = _NOT_MODULE_NAME_CHARS_REGEX.sub(
+        "-", proper_name.lower()
+    ).strip("-")
+    if suggested_proper_name and _MODULE_NAME_REGEX.fullmatch(suggested_proper_name):
         suggestion = " Consider renaming it to '{}'.".format(suggested_proper_name)
     else:
         suggestion = ""
@@ -289,7 +321,7 @@ def validate_module_name_content(name):
             ),
         )
 
-    if not re.fullmatch(r, proper_name):
+    if not _MODULE_NAME_REGEX.fullmatch(proper_name):
         raise CFBSValidationError(
             name,
             "Module name contains illegal characters (only lowercase ASCII alphanumeric characters and single dash separators are allowed)"
@@ -299,37 +331,150 @@ def validate_module_name_content(name):
     log.debug("Successfully validated name of module %s" % name)
 
 
-def validate_config_raise_exceptions(config, empty_build_list_ok=False):
-    # First validate the config i.e. the user's cfbs.json
-    # Here we can raise exceptions, that's what the rest of
-    # the function does, and they are caught by validate_config()
-    config.warn_about_unknown_keys(raise_exceptions=True)
-    _validate_top_level_keys(config)
+def _module_json_path(context, key):
+    """JSON path of a module object, a list position in "build", a key otherwise"""
+    if type(key) is int:
+        return "$.%s[%d]" % (context, key)
+    return "$.%s[%s]" % (context, json.dumps(key))
+
+
+def _validate_modules(context, modules, config, jobs=None) -> List[ValidationIssue]:
+    """Validate module objects independently of each other, collecting errors.
+
+    modules is a list of (key, name, module) tuples, where key is the
+    position / key in the JSON, used for the JSON path. Absolute modules
+    require looking at the file system and running git commands, so when
+    there are any, the modules are validated in a thread pool of jobs
+    workers. The errors are returned in the same order as the modules.
+    """
+
+    validator = _compile_module_validator(context, config)
+
+    def validate(item):
+        key, name, module = item
+        try:
+            validate_single_module(context, name, module, config, validator=validator)
+        except CFBSValidationError as e:
+            return ValidationIssue(_module_json_path(context, key), name, e)
+        return None
+
+    needs_io = any(
+        type(name) is str and is_module_absolute(name) for _, name, _ in modules
+    )
+    if needs_io and len(modules) > 1 and jobs != 1:
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            results = list(executor.map(validate, modules))
+    else:
+        results = [validate(item) for item in modules]
+    return [issue for issue in results if issue is not None]
+
+
+def validate_config_collect_errors(
+    config, empty_build_list_ok=False, jobs=None
+) -> List[ValidationIssue]:
+    """Validate the config, returning all errors instead of stopping at the first.
+
+    Every module in "build", "index" and "provides" is checked, so one run
+    reports everything which needs fixing. The errors are in the same order
+    as validate_config_raise_exceptions() would find them. Errors in the top
+    level keys stop validation, since the rest relies on them.
+
+    :param jobs: maximum number of threads for checking absolute modules
+                 (None for the default of ThreadPoolExecutor)
+    """
+    issues = []  # type: List[ValidationIssue]
+    try:
+        config.warn_about_unknown_keys(raise_exceptions=True)
+    except CFBSValidationError as e:
+        issues.append(ValidationIssue("$", None, e))
+    # raw_data is a deep copy, so get it once and reuse it:
     raw_data = config.raw_data
+    try:
+        _validate_top_level_keys(raw_data)
+    except CFBSValidationError as e:
+        issues.append(ValidationIssue("$", None, e))
+        return issues
 
     if config["type"] == "policy-set" or "build" in config:
-        _validate_config_for_build_field(config, empty_build_list_ok)
+        issues.extend(
+            _validate_config_for_build_field(config, empty_build_list_ok, jobs)
+        )
 
     if "index" in raw_data and type(raw_data["index"]) in (dict, OrderedDict):
-        for name, module in raw_data["index"].items():
-            validate_single_module("index", name, module, config)
+        modules = [(name, name, module) for name, module in raw_data["index"].items()]
+        issues.extend(_validate_modules("index", modules, config, jobs))
+        _warn_about_dependency_cycles(raw_data["index"], "index")
 
     if "provides" in raw_data:
-        for name, module in raw_data["provides"].items():
-            validate_single_module("provides", name, module, config)
+        modules = [
+            (name, name, module) for name, module in raw_data["provides"].items()
+        ]
+        issues.extend(_validate_modules("provides", modules, config, jobs))
+        _warn_about_dependency_cycles(raw_data["provides"], "provides")
 
     if config["type"] == "module":
-        validate_module_name_content(config["name"])
+        try:
+            validate_module_name_content(config["name"])
+        except CFBSValidationError as e:
+            issues.append(ValidationIssue("$.name", None, e))
+
+    return issues
+
+
+def validate_config_raise_exceptions(config, empty_build_list_ok=False):
+    # First validate the config i.e. the user's cfbs.json
+    # Here we can raise exceptions, the first error found
+    # is raised, and they are caught by validate_config()
+    issues = validate_config_collect_errors(config, empty_build_list_ok)
+    if issues:
+        raise issues[0].error
+
+
+def _warn_about_dependency_cycles(modules, context):
+    """Circular dependencies are allowed, but usually not intentional."""
+    for cycle in DependencyGraph(modules).find_cycles():
+        log.warning(
+            'Circular dependency between modules in "%s": %s'
+            % (context, " -> ".join(cycle + cycle[:1]))
+        )
+
+
+def validation_report(issues: List[ValidationIssue]):
+    """JSON serializable report of validation errors, for --to-json"""
+    report = OrderedDict()
+    report["valid"] = not issues
+    report["errors"] = []
+    for issue in issues:
+        entry = OrderedDict()
+        entry["path"] = issue.path
+        entry["module"] = issue.module
+        entry["message"] = str(issue.error)
+        report["errors"].append(entry)
+    return report
+
+
+def format_validation_issues(issues: List[ValidationIssue]) -> List[str]:
+    lines = []
+    for issue in issues:
+        if issue.path == "$":
+            lines.append(str(issue.error))
+        else:
+            lines.append("%s (at %s)" % (issue.error, issue.path))
+    return lines
+
+
+def print_validation_issues(issues: List[ValidationIssue]):
+    for line in format_validation_issues(issues):
+        print(line)
 
 
 def validate_config(config, empty_build_list_ok=False):
-    """Returns `0` if there are no validation errors, and `1` otherwise."""
-    try:
-        validate_config_raise_exceptions(config, empty_build_list_ok)
-        return 0
-    except CFBSValidationError as e:
-        print(e)
-        return 1
+    """Returns `0` if there are no validation errors, and `1` otherwise.
+
+    All errors are printed, not just the first one."""
+    issues = validate_config_collect_errors(config, empty_build_list_ok)
+    print_validation_issues(issues)
+    return 1 if issues else 0
 
 
 def validate_build_step(name, module, i, operation, args, strict=False):
@@ -338,8 +483,9 @@ def validate_build_step(name, module, i, operation, args, strict=False):
     assert type(i) is int
 
     if strict:
-        step = operation + " " + " ".join(args)
-        if len(step) > MAX_FILENAME_LENGTH:
+        # Length of the step as written, without joining the split step again:
+        step_length = len(operation) + max(len(args), 1) + sum(map(len, args))
+        if step_length > MAX_FILENAME_LENGTH:
             raise CFBSValidationError(
                 "%s build step in '%s' is too long" % (operation, name)
             )
@@ -350,17 +496,16 @@ def validate_build_step(name, module, i, operation, args, strict=False):
             'Unknown operation "%s" in "steps", must be one of: %s (build step %s in module "%s")'
             % (operation, ", ".join(AVAILABLE_BUILD_STEPS), i, name),
         )
-    expected = AVAILABLE_BUILD_STEPS[operation]
+    expected, or_more = _ARG_COUNTS[operation]
     actual = len(args)
-    if not step_has_valid_arg_count(args, expected):
-        if type(expected) is int:
+    if actual < expected or (actual > expected and not or_more):
+        if not or_more:
             raise CFBSValidationError(
                 name,
                 "The %s build step expects %d arguments, %d were given (build step "
                 % (operation, expected, actual),
             )
         else:
-            expected = int(expected[0:-1])
             raise CFBSValidationError(
                 name,
                 "The %s build step expects %d or more arguments, %d were given"
@@ -417,7 +562,7 @@ def validate_build_step(name, module, i, operation, args, strict=False):
             raise CFBSValidationError(
                 "/./ not allowed in replace file path ('%s')" % (filename,)
             )
-        if not re.fullmatch(FILENAME_RE, filename):
+        if not _FILENAME_REGEX.fullmatch(filename):
             raise CFBSValidationError(
                 "filename in replace build step contains illegal characters ('%s')"
                 % (filename,)
@@ -582,9 +727,8 @@ def _validate_module_version(name, module):
     assert "version" in module
     if type(module["version"]) is not str:
         raise CFBSValidationError(name, '"version" must be of type string')
-    regex = r"(0|[1-9][0-9]*)\.(0|[1-9][0-9]*)\.(0|[1-9][0-9]*)(-([0-9]+))?"
-    if re.fullmatch(regex, module["version"]) is None:
-        raise CFBSValidationError(name, '"version" must match regex %s' % regex)
+    if _VERSION_REGEX.fullmatch(module["version"]) is None:
+        raise CFBSValidationError(name, '"version" must match regex %s' % VERSION_RE)
 
 
 def _validate_module_commit(name, module):
@@ -693,19 +837,19 @@ def _validate_module_input(name, module):
                 'The input "type" must be "string", "string-multiline", "file" or "list", not "%s"'
                 % input_element["type"],
             )
-        if not re.fullmatch(r"[a-z_]+", input_element["variable"]):
+        if not _INPUT_VARIABLE_REGEX.fullmatch(input_element["variable"]):
             raise CFBSValidationError(
                 name,
                 '"%s" is not an acceptable variable name, must match regex "[a-z_]+"'
                 % input_element["variable"],
             )
-        if not re.fullmatch(r"[a-z_][a-z0-9_]+", input_element["namespace"]):
+        if not _INPUT_NAMESPACE_REGEX.fullmatch(input_element["namespace"]):
             raise CFBSValidationError(
                 name,
                 '"%s" is not an acceptable namespace, must match regex "[a-z_][a-z0-9_]+"'
                 % input_element["namespace"],
             )
-        if not re.fullmatch(r"[a-z_]+", input_element["bundle"]):
+        if not _INPUT_BUNDLE_REGEX.fullmatch(input_element["bundle"]):
             raise CFBSValidationError(
                 name,
                 '"%s" is not an acceptable bundle name, must match regex "[a-z_]+"'
@@ -863,7 +1007,88 @@ def input_data_matches_spec(spec, data):
     return True
 
 
-def validate_single_module(context, name, module, config, local_check=False):
+_REQUIRED_FIELDS = {
+    "build": ("steps", "name"),
+    "provides": ("steps", "description"),
+    "index": ("steps", "description", "tags", "repo", "by", "version", "commit"),
+}
+assert all(
+    field in MODULE_KEYS for fields in _REQUIRED_FIELDS.values() for field in fields
+)
+
+
+# Module field -> validator, in the order the fields are checked. The
+# validators take (name, module), "dependencies" also needs the context and
+# config, so its validator is bound to them by _compile_module_validator():
+_FIELD_VALIDATORS = (
+    ("name", _validate_module_name),
+    ("description", _validate_module_description),
+    ("tags", _validate_module_tags),
+    ("repo", _validate_module_repo),
+    ("by", _validate_module_by),
+    ("dependencies", None),
+    ("index", _validate_module_index),
+    ("version", _validate_module_version),
+    ("commit", _validate_module_commit),
+    ("branch", _validate_module_branch),
+    ("subdirectory", _validate_module_subdirectory),
+    ("steps", _validate_module_steps),
+    ("website", partial(_validate_module_url_field, field="website")),
+    ("documentation", partial(_validate_module_url_field, field="documentation")),
+    ("input", _validate_module_input),
+)
+
+
+def _compile_module_validator(context, config, local_check=False):
+    """Turn the validation rules for modules in context into a function
+    validating one module object, validate(name, module), which raises
+    CFBSValidationError for the first error found.
+
+    The required fields and the validators of the fields are looked up and
+    bound to the context once, here, so validating an index with thousands
+    of modules doesn't do that for each module. Aliases are handled by
+    validate_single_module(), before this.
+    """
+    required_fields = _REQUIRED_FIELDS[context]
+    validate_dependencies = partial(
+        _validate_module_dependencies,
+        config=config,
+        context=context,
+        local_check=local_check,
+    )
+    field_validators = tuple(
+        (field, validator or validate_dependencies)
+        for field, validator in _FIELD_VALIDATORS
+    )
+
+    def validate(name, module):
+        # Step 2 - Check for required fields:
+        for required_field in required_fields:
+            if required_field not in module:
+                raise CFBSValidationError(
+                    name, '"%s" field is required, but missing' % required_field
+                )
+
+        if is_module_absolute(name):
+            validate_absolute_module(name, module)
+
+        # Step 3 - Validate fields:
+        for field, validator in field_validators:
+            if field in module:
+                validator(name, module)
+
+        # Step 4 - Additional validation checks:
+
+        # Validate module name content also when there's no explicit "name" field (for "index" and "provides" project types)
+        if "name" not in module:
+            validate_module_name_content(name)
+
+    return validate
+
+
+def validate_single_module(
+    context, name, module, config, local_check=False, validator=None
+):
     """Function to validate one module object.
 
     Called repeatedly for each module in index, provides, and build.
@@ -875,6 +1100,10 @@ def validate_single_module(context, name, module, config, local_check=False):
     references to other parts of the cfbs.json i.e. to disable
     checks for dependencies and aliases. In that case, the function must be
     called with config = None.
+
+    validator is the result of _compile_module_validator() with the same
+    context, config and local_check, when validating many modules, so it is
+    only compiled once.
     """
     assert context in ("index", "provides", "build")
     if local_check:
@@ -894,79 +1123,20 @@ def validate_single_module(context, name, module, config, local_check=False):
         _validate_module_alias(name, module, context, config)
         return  # alias entries would fail the other validation below
 
-    # Step 2 - Check for required fields:
+    # Steps 2-4 - Required fields, and validating each field:
 
-    required_fields = ["steps"]
+    if validator is None:
+        validator = _compile_module_validator(context, config, local_check)
+    validator(name, module)
 
-    if context == "build":
-        required_fields.append("name")
-    elif context == "provides":
-        required_fields.append("description")
-    else:
-        assert context == "index"
-        required_fields.extend(
-            [
-                "description",
-                "tags",
-                "repo",
-                "by",
-                "version",
-                "commit",
-            ]
-        )
 
-    for required_field in required_fields:
-        assert required_field in MODULE_KEYS
-        if required_field not in module:
-            raise CFBSValidationError(
-                name, '"%s" field is required, but missing' % required_field
-            )
+def _validate_config_for_build_field(
+    config, empty_build_list_ok=False, jobs=None
+) -> List[ValidationIssue]:
+    """Validate that neccessary fields are in the config for the build/download commands to work
 
-    if is_module_absolute(name):
-        validate_absolute_module(name, module)
-
-    # Step 3 - Validate fields:
-
-    if "name" in module:
-        _validate_module_name(name, module)
-    if "description" in module:
-        _validate_module_description(name, module)
-    if "tags" in module:
-        _validate_module_tags(name, module)
-    if "repo" in module:
-        _validate_module_repo(name, module)
-    if "by" in module:
-        _validate_module_by(name, module)
-    if "dependencies" in module:
-        _validate_module_dependencies(name, module, config, context, local_check)
-    if "index" in module:
-        _validate_module_index(name, module)
-    if "version" in module:
-        _validate_module_version(name, module)
-    if "commit" in module:
-        _validate_module_commit(name, module)
-    if "branch" in module:
-        _validate_module_branch(name, module)
-    if "subdirectory" in module:
-        _validate_module_subdirectory(name, module)
-    if "steps" in module:
-        _validate_module_steps(name, module)
-    if "website" in module:
-        _validate_module_url_field(name, module, "website")
-    if "documentation" in module:
-        _validate_module_url_field(name, module, "documentation")
-    if "input" in module:
-        _validate_module_input(name, module)
-
-    # Step 4 - Additional validation checks:
-
-    # Validate module name content also when there's no explicit "name" field (for "index" and "provides" project types)
-    if "name" not in module:
-        validate_module_name_content(name)
-
-
-def _validate_config_for_build_field(config, empty_build_list_ok=False):
-    """Validate that neccessary fields are in the config for the build/download commands to work"""
+    Structural problems with the "build" list raise, errors in the modules
+    are collected and returned."""
     if "build" not in config:
         raise CFBSExitError(
             'A "build" field is missing in ./cfbs.json'
@@ -978,10 +1148,15 @@ def _validate_config_for_build_field(config, empty_build_list_ok=False):
         )
     if len(config["build"]) > 0:
         # If there are modules in "build" validate them:
-        for index, module in enumerate(config["build"]):
-            name = module["name"] if "name" in module else index
-            validate_single_module("build", name, module, config)
+        modules = [
+            (index, module["name"] if "name" in module else index, module)
+            for index, module in enumerate(config["build"])
+        ]
+        issues = _validate_modules("build", modules, config, jobs)
+        _warn_about_dependency_cycles(config["build"], "build")
+        return issues
     elif not empty_build_list_ok:
         raise CFBSExitError(
             "The \"build\" field in ./cfbs.json is empty - add modules with 'cfbs add'"
         )
+    return []
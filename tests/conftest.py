@@ -1,4 +1,9 @@
+import http.server
 import os
+import subprocess
+import threading
+import time
+
 import pytest
 
 
@@ -7,3 +12,120 @@ def chdir(request):
     os.chdir(os.path.join(os.path.dirname(__file__), request.param))
     yield
     os.chdir(str(request.config.invocation_dir))
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # Keep-alive
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.requests.append(self.path)
+            responses = self.server.routes.get(self.path, [(404, {}, b"", 0)])
+            # A list of responses is answered in order, the last one repeated:
+            response = responses.pop(0) if len(responses) > 1 else responses[0]
+        status, headers, body, delay = response
+        time.sleep(delay)
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def http_server():
+    """Local HTTP server, add responses with server.route(path, body, ...),
+    get URLs with server.url(path). Counts connections and requests."""
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.connections = 0
+    server.requests = []
+    server.routes = {}
+
+    def route(path, body=b"", status=200, headers=None, delay=0):
+        response = (status, headers or {}, body, delay)
+        server.routes.setdefault(path, []).append(response)
+
+    server.route = route
+    server.url = lambda path: "http://127.0.0.1:%d%s" % (server.server_port, path)
+    thread = threading.Thread(
+        target=server.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True
+    )
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def _git(*args, cwd):
+    env = dict(
+        os.environ,
+        GIT_AUTHOR_NAME="cfbs",
+        GIT_AUTHOR_EMAIL="cfbs@example.com",
+        GIT_COMMITTER_NAME="cfbs",
+        GIT_COMMITTER_EMAIL="cfbs@example.com",
+    )
+    result = subprocess.run(
+        ("git",) + args, cwd=cwd, env=env, check=True, stdout=subprocess.PIPE
+    )
+    return result.stdout.decode("utf-8").strip()
+
+
+@pytest.fixture
+def git_remote(tmp_path):
+    """Local bare git repository, to fetch from instead of a real remote.
+
+    Has two commits on the main branch, the files of each are in
+    git_remote.files[commit], and git_remote.commits lists them (oldest
+    first). git_remote.url is the file:// URL of the remote, which allows
+    shallow and partial fetches, like GitHub, git_remote.path its path."""
+    work = str(tmp_path / "remote-work")
+    remote = str(tmp_path / "remote.git")
+    os.makedirs(work)
+    _git("init", "--quiet", "-b", "main", cwd=work)
+
+    versions = [
+        {
+            "cfbs.json": "{}\n",
+            "policy/main.cf": "bundle agent main {}\n",
+            "other/README.md": "Another module\n",
+        },
+        {
+            "cfbs.json": "{}\n",
+            "policy/main.cf": "bundle agent main { }\n",
+            "other/README.md": "Another module\n",
+        },
+    ]
+
+    class Remote:
+        path = remote
+        url = "file://" + remote
+        commits = []
+        files = {}
+
+    # Non-bare repository the remote is cloned from (git_remote.work):
+    Remote.work = work
+    for files in versions:
+        for name, content in files.items():
+            os.makedirs(os.path.join(work, os.path.dirname(name)), exist_ok=True)
+            with open(os.path.join(work, name), "w") as f:
+                f.write(content)
+        _git("add", "--all", cwd=work)
+        _git("commit", "--quiet", "-m", "Version %d" % len(Remote.commits), cwd=work)
+        commit = _git("rev-parse", "HEAD", cwd=work)
+        Remote.commits.append(commit)
+        Remote.files[commit] = files
+
+    _git("clone", "--quiet", "--bare", work, remote, cwd=str(tmp_path))
+    _git("config", "uploadpack.allowFilter", "true", cwd=remote)
+    return Remote
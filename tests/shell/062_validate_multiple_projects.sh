@@ -0,0 +1,73 @@
+set -e
+set -x
+cd tests/
+mkdir -p ./tmp/
+cd ./tmp/
+rm -rf ./projects/ validation.json
+mkdir -p ./projects/good ./projects/bad ./projects/cycle
+
+# Projects with their own (inline) index, so nothing is downloaded:
+
+echo '{
+  "name": "good",
+  "description": "Example description",
+  "type": "index",
+  "index": {
+    "autorun": {
+      "description": "Enables autorun functionality.",
+      "tags": ["supported", "management"],
+      "repo": "https://github.com/cfengine/modules",
+      "by": "https://github.com/olehermanse",
+      "version": "1.0.1",
+      "commit": "c3b7329b240cf7ad062a0a64ee8b607af2cb912a",
+      "subdirectory": "management/autorun",
+      "steps": ["json def.json def.json"]
+    }
+  }
+}' > ./projects/good/cfbs.json
+
+echo '{
+  "name": "bad",
+  "description": "Example description",
+  "type": "index",
+  "index": {
+    "first-bad": {
+      "description": "Missing steps",
+      "tags": [],
+      "repo": "https://github.com/cfengine/modules",
+      "by": "https://github.com/olehermanse",
+      "version": "1.0.1",
+      "commit": "c3b7329b240cf7ad062a0a64ee8b607af2cb912a"
+    },
+    "second-bad": {
+      "description": "Bad version",
+      "tags": [],
+      "repo": "https://github.com/cfengine/modules",
+      "by": "https://github.com/olehermanse",
+      "version": "one",
+      "commit": "c3b7329b240cf7ad062a0a64ee8b607af2cb912a",
+      "steps": ["json def.json def.json"]
+    }
+  }
+}' > ./projects/bad/cfbs.json
+
+cfbs validate ./projects/good ./projects/good/cfbs.json --jobs 2
+
+# All errors are reported, for all projects, along with a summary:
+! cfbs validate ./projects/good ./projects/bad --to-json > output.txt 2>&1
+cat output.txt
+grep 'first-bad.*(at $.index\["first-bad"\])' output.txt
+grep 'second-bad.*(at $.index\["second-bad"\])' output.txt
+grep 'Validated 2 projects, 1 failed' output.txt
+grep 'OK .*projects/good/cfbs.json' output.txt
+grep 'FAILED .*projects/bad/cfbs.json' output.txt
+
+grep '"valid": false' validation.json
+grep '"path": "$.index\[\\"second-bad\\"\]"' validation.json
+
+# Warnings are printed with the output of the project they are about:
+sed -e 's/"subdirectory"/"dependencies": ["autorun"],\n      "subdirectory"/' ./projects/good/cfbs.json > ./projects/cycle/cfbs.json
+cfbs validate ./projects/good ./projects/cycle --jobs 2 > output.txt 2>&1
+cat output.txt
+grep 'projects/cycle/cfbs.json: Circular dependency' output.txt
+! grep 'projects/good/cfbs.json: Circular dependency' output.txt
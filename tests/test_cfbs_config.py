@@ -0,0 +1,44 @@
+import json
+
+import pytest
+
+from cfbs.cfbs_config import CFBSConfig
+
+
+def _names(path):
+    with open(path) as f:
+        return [module["name"] for module in json.load(f)["build"]]
+
+
+def test_transaction(tmp_path):
+    path = str(tmp_path / "cfbs.json")
+    with open(path, "w") as f:
+        json.dump({"name": "Example", "type": "policy-set", "build": []}, f)
+    config = CFBSConfig(filename=path, index={}, non_interactive=True)
+
+    def add(name):
+        config["build"].append({"name": name, "steps": []})
+        config.save()
+
+    with config.transaction():
+        add("./a/")
+        with config.transaction():
+            add("./b/")
+        # Only the outermost transaction writes:
+        assert _names(path) == []
+        config.checkpoint()
+        assert _names(path) == ["./a/", "./b/"]
+        add("./c/")
+        assert _names(path) == ["./a/", "./b/"]
+    assert _names(path) == ["./a/", "./b/", "./c/"]
+
+    # Saved changes are written when an exception ends the transaction:
+    with pytest.raises(KeyError):
+        with config.transaction():
+            add("./d/")
+            raise KeyError()
+    assert _names(path)[-1] == "./d/"
+
+    # Without a transaction, save() writes right away:
+    add("./e/")
+    assert _names(path)[-1] == "./e/"
@@ -0,0 +1,76 @@
+from collections import OrderedDict
+
+from cfbs.cfbs_json import CFBSJson
+
+
+def _module(name, dependencies=None):
+    module = OrderedDict()
+    module["name"] = name
+    if dependencies:
+        module["dependencies"] = dependencies
+    module["steps"] = ["copy ./foo.cf services/cfbs/foo.cf"]
+    return module
+
+
+def _config(build, index=None):
+    data = OrderedDict()
+    data["name"] = "test"
+    data["type"] = "policy-set"
+    data["description"] = "test"
+    data["build"] = build
+    return CFBSJson(
+        path="./cfbs.json", data=data, index_argument=index or {"from-index": {}}
+    )
+
+
+def test_find_module():
+    a, b = _module("a"), _module("b")
+    config = _config([a, b])
+
+    assert config.find_module("a") is a
+    assert config.find_module("b", ("build",)) is b
+    assert config.find_module("missing") is None
+    assert config.find_module("from-index") == {}
+    assert config.find_module("from-index", ("build",)) is None
+
+
+def test_can_reach_dependency():
+    config = _config([_module("a")])
+
+    assert config.can_reach_dependency("a")
+    assert config.can_reach_dependency("a", ("build",))
+    assert not config.can_reach_dependency("a", ("index",))
+    assert config.can_reach_dependency("from-index")
+    assert not config.can_reach_dependency("from-index", ("build",))
+    assert not config.can_reach_dependency("missing")
+
+
+def test_module_lookup_follows_build_changes():
+    a, b = _module("a"), _module("b")
+    config = _config([a])
+    assert config.get_module_from_build("a") is a
+    assert config.get_module_from_build("b") is None
+
+    # Adding keeps the lookup table up to date, the first module wins:
+    config.add_to_build(b)
+    assert config.get_module_from_build("b") is b
+    config.add_to_build(_module("b"))
+    assert config.get_module_from_build("b") is b
+    assert len(config["build"]) == 3
+
+    # Replacing the build list:
+    c = _module("c")
+    config["build"] = [c]
+    assert config.get_module_from_build("c") is c
+    assert config.get_module_from_build("a") is None
+
+    # Other changes need invalidate_module_indexes():
+    config["build"].append(a)
+    c["name"] = "z"
+    config.invalidate_module_indexes()
+    assert config.get_module_from_build("a") is a
+    assert config.get_module_from_build("z") is c
+    assert config.get_module_from_build("c") is None
+    config["build"].remove(a)
+    config.invalidate_module_indexes()
+    assert config.get_module_from_build("a") is None
@@ -0,0 +1,52 @@
+import subprocess
+import sys
+
+from cfbs import command_registry
+
+
+def test_registry_matches_commands():
+    for name in command_registry.get_command_names():
+        module = command_registry.import_command_module(name)
+        # The command is implemented (registered) in the module listed for it:
+        function = command_registry._commands[name]
+        assert any(value is function for value in vars(module).values())
+    # And there are no commands missing in the list:
+    assert set(command_registry._commands) == set(command_registry.get_command_names())
+
+
+def _imported_modules(code):
+    # python -X importtime prints one line per imported module to stderr:
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+    return set(
+        line.split("|")[-1].strip()
+        for line in result.stderr.splitlines()
+        if line.startswith("import time:")
+    )
+
+
+def test_startup_imports():
+    # Starting cfbs (for example for --version or --help) should not import
+    # the commands, nor the heavy standard library modules they need:
+    modules = _imported_modules("import cfbs.main, cfbs.args")
+    assert "cfbs.main" in modules
+    for heavy in (
+        "cfbs.commands",
+        "cfbs.validate",
+        "cfbs.cfbs_config",
+        "urllib.request",
+    ):
+        assert heavy not in modules
+
+
+def test_query_command_imports():
+    # The read-only commands don't need the code for building, converting etc.:
+    modules = _imported_modules("import cfbs.query_commands")
+    assert "cfbs.validate" in modules
+    for heavy in ("cfbs.commands", "cfbs.build", "cfbs.analyze", "cfbs.updates"):
+        assert heavy not in modules
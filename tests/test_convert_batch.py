@@ -0,0 +1,95 @@
+import json
+
+import pytest
+
+from cfbs.convert_batch import (
+    DROP,
+    KEEP,
+    MIN_FILES_FOR_PROCESS_POOL,
+    PATCH,
+    ConvertRules,
+    diff_files,
+)
+from cfbs.diff import file_diff_text
+from cfbs.utils import CFBSExitError
+
+
+def _write_json(path, data):
+    with open(path, "w") as f:
+        json.dump(data, f)
+    return path
+
+
+def test_convert_rules(tmp_path):
+    path = _write_json(
+        str(tmp_path / "rules.json"),
+        {
+            "rules": [
+                {"files": "services/main.cf", "action": "patch"},
+                {"files": "services/*", "action": "keep"},
+                {"files": "*.md", "action": "drop"},
+            ],
+            "default": "patch",
+        },
+    )
+    rules = ConvertRules.load(path)
+    assert rules.action("services/main.cf") == PATCH
+    assert rules.action("./services/autorun/x.cf") == KEEP
+    assert rules.action("docs/README.md") == DROP
+    assert rules.action("promises.cf") == PATCH
+
+    # Files not matching any rule are kept by default:
+    path = _write_json(str(tmp_path / "keep.json"), {"rules": []})
+    assert ConvertRules.load(path).action("promises.cf") == KEEP
+
+    with pytest.raises(CFBSExitError):
+        ConvertRules.load(str(tmp_path / "missing.json"))
+    for invalid in (
+        [],
+        {"default": "delete"},
+        {"rules": {"files": "*"}},
+        {"rules": [{"action": "drop"}]},
+        {"rules": [{"files": "*", "action": "delete"}]},
+    ):
+        path = _write_json(str(tmp_path / "invalid.json"), invalid)
+        with pytest.raises(CFBSExitError):
+            ConvertRules.load(path)
+
+
+def test_diff_files(tmp_path):
+    files = []
+    for i in range(MIN_FILES_FOR_PROCESS_POOL):
+        original = tmp_path / ("%d.orig" % i)
+        modified = tmp_path / ("%d.cf" % i)
+        original.write_text("line\n" * i)
+        modified.write_text("line\n" * i + "custom %d\n" % i)
+        files.append((str(original), str(modified), "%d.cf" % i))
+    files.append((str(tmp_path / "missing"), str(tmp_path / "0.cf"), "missing"))
+
+    expected = [(file_diff_text(*f, f[2]), None) for f in files[:-1]]
+    for jobs in (1, 2):
+        results = diff_files(files, jobs)
+        assert results[:-1] == expected
+        diff, error = results[-1]
+        assert diff is None and error is not None
+    assert diff_files([]) == []
+
+
+def test_convert_to_patch_save_failure(tmp_path, monkeypatch):
+    import cfbs.commands
+
+    def failing_save_file(path, data):
+        raise OSError("disk full")
+
+    monkeypatch.chdir(str(tmp_path))
+    monkeypatch.setattr(cfbs.commands, "save_file", failing_save_file)
+    state = cfbs.commands._ConvertState(
+        "masterfiles-x", "./masterfiles-x/", non_interactive=True, offline=True
+    )
+    converted, first_patch_conversion = cfbs.commands._cfbs_convert_convert_to_patch(
+        state, "orig.cf", "promises.cf", "masterfiles-x/promises.cf", True, "diff"
+    )
+    # Not converted, so the file is kept (and counted as kept):
+    assert not converted
+    assert first_patch_conversion
+    assert state.uncommitted == []
@@ -0,0 +1,103 @@
+import pytest
+
+from cfbs.dependency_graph import DependencyGraph, resolve_dependencies
+
+
+def _module(name, dependencies=None, added_by="cfbs add"):
+    module = {"name": name, "added_by": added_by}
+    if dependencies is not None:
+        module["dependencies"] = dependencies
+    return module
+
+
+def test_dependency_graph_queries():
+    graph = DependencyGraph(
+        [
+            _module("masterfiles"),
+            _module("library", ["masterfiles"], added_by="inventory"),
+            _module("inventory", ["library"]),
+            _module("other", ["library", "not-in-graph"]),
+        ]
+    )
+    assert len(graph) == 4
+    assert "library" in graph
+    assert "not-in-graph" not in graph
+    assert graph.dependencies("other") == ["library", "not-in-graph"]
+    assert graph.dependents("library") == ["inventory", "other"]
+    assert graph.all_dependents("masterfiles") == {"library", "inventory", "other"}
+    assert graph.all_dependents("inventory") == set()
+    assert graph.reachable(["inventory"]) == {"inventory", "library", "masterfiles"}
+    assert graph.find_cycles() == []
+    assert graph.topological_order() == ["masterfiles", "library", "inventory", "other"]
+
+
+def test_dependency_graph_from_dict():
+    graph = DependencyGraph({"a": {"dependencies": ["b"]}, "b": {}})
+    assert graph.names() == ["a", "b"]
+    assert graph.topological_order() == ["b", "a"]
+
+
+def test_dependency_graph_cycles():
+    graph = DependencyGraph(
+        [
+            _module("a", ["b"]),
+            _module("b", ["c"]),
+            _module("c", ["a"]),
+            _module("d", ["d"]),
+            _module("e", ["a"]),
+        ]
+    )
+    assert graph.find_cycles() == [["a", "b", "c"], ["d"]]
+    assert graph.all_dependents("a") == {"b", "c", "e"}
+    assert graph.reachable(["e"]) == {"a", "b", "c", "e"}
+    assert graph.topological_order(["e"]) == ["c", "b", "a", "e"]
+
+
+def test_dependency_graph_unused():
+    modules = [
+        _module("masterfiles"),
+        _module("needed", added_by="inventory"),
+        _module("inventory", ["needed"]),
+        _module("orphan", added_by="removed-module"),
+        _module("orphan-dependency", added_by="orphan"),
+        _module("loop-a", ["loop-b"], added_by="loop-b"),
+        _module("loop-b", ["loop-a"], added_by="loop-a"),
+    ]
+    modules[3]["dependencies"] = ["orphan-dependency"]
+    graph = DependencyGraph(modules)
+    unused = graph.unused(lambda m: m["added_by"] == "cfbs add")
+    assert [m["name"] for m in unused] == [
+        "orphan",
+        "orphan-dependency",
+        "loop-a",
+        "loop-b",
+    ]
+
+
+def test_resolve_dependencies():
+    available = {
+        "a": _module("a", ["b", "c"]),
+        "b": _module("b", ["d"]),
+        "c": _module("c", ["a"]),
+        "d": _module("d"),
+    }
+    asked = []
+
+    def get_module(name, dependent):
+        asked.append((name, dependent))
+        return available[name]
+
+    found = resolve_dependencies([available["a"]], ["c"], get_module)
+    assert [m["name"] for m in found] == ["d", "b"]
+    assert asked == [("b", "a"), ("d", "b")]
+
+    # Circular dependencies terminate:
+    found = resolve_dependencies([available["c"]], [], get_module)
+    assert [m["name"] for m in found] == ["d", "b", "a"]
+
+    def not_found(name, dependent):
+        raise KeyError(name)
+
+    with pytest.raises(KeyError):
+        resolve_dependencies([_module("x", ["missing"])], [], not_found)
+    assert resolve_dependencies([_module("x")], [], not_found) == []
@@ -0,0 +1,118 @@
+import difflib
+import random
+import shutil
+
+import pytest
+
+from cfbs.diff import (
+    DIFF_BACKENDS,
+    GIT,
+    HISTOGRAM,
+    MYERS,
+    file_diff_text,
+    matching_blocks,
+    unified_diff,
+)
+from cfbs.utils import CFBSExitError
+
+
+def _lcs_length(a, b):
+    lengths = [[0] * (len(b) + 1) for _ in range(len(a) + 1)]
+    for i in range(len(a) - 1, -1, -1):
+        for j in range(len(b) - 1, -1, -1):
+            if a[i] == b[j]:
+                lengths[i][j] = lengths[i + 1][j + 1] + 1
+            else:
+                lengths[i][j] = max(lengths[i + 1][j], lengths[i][j + 1])
+    return lengths[0][0]
+
+
+def _apply(a, diff):
+    """Apply a unified diff to the lines a, returns the resulting text"""
+    lines = diff.splitlines(True)[2:]
+    result = []
+    i = 0
+    previous = None
+    for line in lines:
+        if line.startswith("@@"):
+            old_range = line.split()[1][1:]
+            start, _, length = old_range.partition(",")
+            start = int(start) - (1 if length != "0" else 0)
+            result.extend(a[i:start])
+            i = start
+        elif line.startswith("\\"):
+            if previous in (" ", "+"):
+                result[-1] = result[-1][:-1]
+        else:
+            previous = line[0]
+            if line[0] in (" ", "-"):
+                i += 1
+            if line[0] in (" ", "+"):
+                result.append(line[1:])
+    result.extend(a[i:])
+    return "".join(result)
+
+
+@pytest.mark.parametrize("algorithm", [HISTOGRAM, MYERS])
+def test_unified_diff_random(algorithm):
+    rng = random.Random(1)
+    for _ in range(1000):
+        alphabet = "abcde"[0 : rng.randint(1, 5)]
+        a = [rng.choice(alphabet) + "\n" for _ in range(rng.randint(0, 20))]
+        b = [rng.choice(alphabet) + "\n" for _ in range(rng.randint(0, 20))]
+        if b and rng.random() < 0.3:
+            b[-1] = b[-1].rstrip("\n")
+
+        blocks = matching_blocks(a, b, algorithm)
+        assert blocks[-1] == (len(a), len(b), 0)
+        for i, j, n in blocks:
+            assert a[i : i + n] == b[j : j + n]
+        if algorithm == MYERS:
+            # The shortest edit script:
+            assert sum(n for _, _, n in blocks) == _lcs_length(a, b)
+
+        diff = "".join(unified_diff(a, b, "a", "b", algorithm))
+        assert (diff == "") == (a == b)
+        assert _apply(a, diff) == "".join(b)
+
+
+@pytest.mark.parametrize("algorithm", [HISTOGRAM, MYERS])
+def test_unified_diff_like_difflib(algorithm):
+    a = ["line %d\n" % i for i in range(100)]
+    b = list(a)
+    b[10] = "changed\n"
+    del b[50:53]
+    b.insert(90, "added\n")
+    assert list(unified_diff(a, b, "a.cf", "b.cf", algorithm)) == list(
+        difflib.unified_diff(a, b, "a.cf", "b.cf")
+    )
+
+
+def test_histogram_aligns_unique_lines():
+    # Myers matches the common "}" lines, histogram the unique bundle names:
+    a = ["bundle agent a\n", "{\n", "}\n", "bundle agent b\n", "{\n", "}\n"]
+    b = ["bundle agent b\n", "{\n", "}\n"]
+    assert matching_blocks(a, b, HISTOGRAM) == [(3, 0, 3), (6, 3, 0)]
+
+
+def test_file_diff_text(tmp_path, monkeypatch):
+    a = tmp_path / "a.cf"
+    b = tmp_path / "b.cf"
+    a.write_text("one\ntwo\nthree\n")
+    b.write_text("one\n2\nthree")
+    expected = (
+        "--- x.cf\n+++ x.cf\n@@ -1,3 +1,3 @@\n one\n-two\n-three\n+2\n+three\n"
+        + "\\ No newline at end of file\n"
+    )
+    algorithms = list(DIFF_BACKENDS)
+    if shutil.which("git") is None:
+        algorithms.remove(GIT)
+    for algorithm in algorithms:
+        assert file_diff_text(str(a), str(b), "x.cf", "x.cf", algorithm) == expected
+        assert file_diff_text(str(a), str(a), algorithm=algorithm) == ""
+
+    monkeypatch.setenv("CFBS_DIFF_ALGORITHM", MYERS)
+    assert file_diff_text(str(a), str(b), "x.cf", "x.cf") == expected
+    monkeypatch.setenv("CFBS_DIFF_ALGORITHM", "patience")
+    with pytest.raises(CFBSExitError):
+        file_diff_text(str(a), str(b))
@@ -1,5 +1,8 @@
-from cfbs.git import ls_remote
-from cfbs.utils import is_a_commit_hash
+from collections import OrderedDict
+
+from cfbs.git import ls_remote, ls_remote_refs, match_ref
+from cfbs.internal_file_management import resolve_remote_reference
+from cfbs.utils import is_a_commit_hash, subprocess_count
 
 
 def test_ls_remote():
@@ -7,3 +10,41 @@ def test_ls_remote():
     print(commit)
     assert commit is not None
     assert is_a_commit_hash(commit)
+
+
+def test_ls_remote_refs(git_remote):
+    refs = ls_remote_refs(git_remote.url)
+    assert refs is not None
+    latest = git_remote.commits[-1]
+    assert refs["HEAD"] == latest
+    assert refs["refs/heads/main"] == latest
+    assert match_ref(refs, "main") == ls_remote(git_remote.url, "main") == latest
+    assert match_ref(refs, "HEAD") == latest
+    assert match_ref(refs, "nonexistent") is None
+
+    assert ls_remote_refs(git_remote.url + "-nonexistent") is None
+
+
+def test_match_ref():
+    refs = OrderedDict(
+        [
+            ("HEAD", "a" * 40),
+            ("refs/heads/feature/main", "b" * 40),
+            ("refs/heads/main", "c" * 40),
+            ("refs/heads/notmain", "d" * 40),
+        ]
+    )
+    # Like git ls-remote, patterns match the end of refs, first match wins:
+    assert match_ref(refs, "main") == "b" * 40
+    assert match_ref(refs, "heads/main") == "c" * 40
+    assert match_ref(refs, "refs/heads/notmain") == "d" * 40
+    assert match_ref(refs, "ain") is None
+
+
+def test_resolve_remote_reference(git_remote):
+    before = subprocess_count()
+    assert resolve_remote_reference(git_remote.url, "main") == git_remote.commits[-1]
+    assert resolve_remote_reference(git_remote.url, "HEAD") == git_remote.commits[-1]
+    assert resolve_remote_reference(git_remote.url, "nonexistent") is None
+    # The refs of each remote are only listed once:
+    assert subprocess_count() - before == 1
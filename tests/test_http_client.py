@@ -0,0 +1,113 @@
+import hashlib
+import threading
+
+import pytest
+
+import cfbs.http_client
+from cfbs.http_client import HTTPClient
+from cfbs.utils import CFBSNetworkError, fetch_url, get_json
+
+
+def test_connections_are_reused(http_server):
+    http_server.route("/a", b"first")
+    http_server.route("/b", b"second")
+    client = HTTPClient()
+
+    for _ in range(3):
+        for path, body in (("/a", b"first"), ("/b", b"second")):
+            with client.get(http_server.url(path)) as response:
+                assert response.status == 200
+                assert response.read() == body
+
+    assert len(http_server.requests) == 6
+    assert http_server.connections == 1
+
+
+def test_unread_responses_are_not_reused(http_server):
+    http_server.route("/a", b"x" * 100000)
+    client = HTTPClient()
+
+    for _ in range(2):
+        with client.get(http_server.url("/a")) as response:
+            assert response.read(10) == b"x" * 10
+
+    assert http_server.connections == 2
+
+
+def test_retries_with_backoff(http_server):
+    http_server.route("/flaky", status=503)
+    http_server.route("/flaky", status=500)
+    http_server.route("/flaky", b"ok")
+    client = HTTPClient(retries=2, backoff=0)
+
+    with client.get(http_server.url("/flaky")) as response:
+        assert (response.status, response.read()) == (200, b"ok")
+    assert http_server.requests == ["/flaky"] * 3
+
+    # After the last retry, the response is returned, whatever the status:
+    http_server.route("/down", status=503)
+    with client.get(http_server.url("/down")) as response:
+        assert response.status == 503
+    assert http_server.requests.count("/down") == 3
+
+
+def test_errors_are_not_retried(http_server):
+    client = HTTPClient(retries=2, backoff=0)
+    with client.get(http_server.url("/missing")) as response:
+        assert response.status == 404
+    assert http_server.requests == ["/missing"]
+
+
+def test_redirects(http_server):
+    http_server.route("/old", status=302, headers={"Location": "/new"})
+    http_server.route("/new", b"moved")
+    client = HTTPClient()
+
+    with client.get(http_server.url("/old")) as response:
+        assert (response.status, response.read()) == (200, b"moved")
+    assert http_server.connections == 1
+
+
+def test_timeout(http_server):
+    http_server.route("/slow", b"late", delay=0.5)
+    client = HTTPClient(timeout=0.1, retries=1, backoff=0)
+
+    with pytest.raises(CFBSNetworkError, match="Failed to fetch"):
+        client.get(http_server.url("/slow"))
+    assert http_server.requests == ["/slow"] * 2
+
+
+def test_max_connections(http_server):
+    http_server.route("/a", b"a", delay=0.05)
+    client = HTTPClient(max_connections=2)
+
+    def get():
+        with client.get(http_server.url("/a")) as response:
+            assert response.read() == b"a"
+
+    threads = [threading.Thread(target=get) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(http_server.requests) == 8
+    assert http_server.connections <= 2
+
+
+def test_fetch_url_and_get_json(http_server, tmp_path, monkeypatch):
+    monkeypatch.setattr(cfbs.http_client, "_default_client", HTTPClient())
+    http_server.route("/index.json", b'{"b": 1, "a": 2}')
+    http_server.route("/file.txt", b"content\n")
+
+    data = get_json(http_server.url("/index.json"))
+    assert list(data.items()) == [("b", 1), ("a", 2)]
+
+    target = str(tmp_path / "file.txt")
+    checksum = hashlib.sha1(b"content\n").hexdigest()
+    assert fetch_url(http_server.url("/file.txt"), target) == checksum
+    with pytest.raises(CFBSNetworkError, match="Checksum mismatch"):
+        fetch_url(http_server.url("/file.txt"), target, "0" * 40)
+    with pytest.raises(CFBSNetworkError, match="HTTP 404"):
+        fetch_url(http_server.url("/missing"), target)
+    assert http_server.connections == 1
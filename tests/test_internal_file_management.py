@@ -0,0 +1,295 @@
+import hashlib
+import io
+import os
+import stat
+import subprocess
+import tarfile
+import zipfile
+
+import pytest
+
+import cfbs.git
+import cfbs.internal_file_management
+from cfbs.build import _download_module
+from cfbs.internal_file_management import (
+    _mirror_path,
+    absolute_module_copy,
+    export_git_commit,
+    fetch_archive,
+    is_partial_export,
+)
+from cfbs.utils import CFBSExitError, read_file, subprocess_count
+
+URL = "https://example.com/archives/module.tar.gz"
+
+
+@pytest.fixture
+def serve_archive(tmp_path, monkeypatch):
+    """Make fetch_archive() download archives from memory, returns a function
+    which sets the archive to download, and returns its SHA-256 checksum."""
+    monkeypatch.setenv("CFBS_GLOBAL_DIR", str(tmp_path / "cfbs"))
+    archive = {}
+
+    def open_url(url):
+        return io.BytesIO(archive["data"])
+
+    def serve(data):
+        archive["data"] = data
+        return hashlib.sha256(data).hexdigest()
+
+    monkeypatch.setattr(cfbs.internal_file_management, "open_url", open_url)
+    return serve
+
+
+def _tarball(files, links=()):
+    f = io.BytesIO()
+    with tarfile.open(fileobj=f, mode="w:gz") as tar:
+        for name, content, mode in files:
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            info.mode = mode
+            tar.addfile(info, io.BytesIO(content))
+        for name, target in links:
+            info = tarfile.TarInfo(name)
+            info.type = tarfile.SYMTYPE
+            info.linkname = target
+            tar.addfile(info)
+    return f.getvalue()
+
+
+MODULE = [
+    ("module-1.0/cfbs.json", b"{}\n", 0o644),
+    ("module-1.0/lib/run.sh", b"#!/bin/sh\n", 0o755),
+    ("module-1.0/other/file.txt", b"other\n", 0o644),
+]
+
+
+def _downloads(tmp_path):
+    return str(tmp_path / "cfbs" / "downloads" / "example.com" / "archives")
+
+
+def test_fetch_archive_tar(tmp_path, serve_archive):
+    checksum = serve_archive(_tarball(MODULE))
+
+    index_path, archive_checksum = fetch_archive(URL, checksum)
+    content_dir = os.path.join(_downloads(tmp_path), checksum)
+    assert (index_path, archive_checksum) == (
+        os.path.join(content_dir, "cfbs.json"),
+        checksum,
+    )
+    # The top-level directory is left out, permissions are kept:
+    assert sorted(os.listdir(content_dir)) == ["cfbs.json", "lib", "other"]
+    assert os.stat(os.path.join(content_dir, "lib", "run.sh")).st_mode & stat.S_IXUSR
+    # Only the content is left, no archive or temporary directories:
+    assert os.listdir(_downloads(tmp_path)) == [checksum]
+
+    # Already extracted, not downloaded again:
+    serve_archive(b"")
+    assert fetch_archive(URL, checksum) == (index_path, checksum)
+
+
+def test_fetch_archive_checksum_mismatch(tmp_path, serve_archive):
+    serve_archive(_tarball(MODULE))
+    with pytest.raises(CFBSExitError, match="Checksum mismatch"):
+        fetch_archive(URL, "0" * 64)
+    assert os.listdir(_downloads(tmp_path)) == []
+
+
+def test_fetch_archive_subdirectory(tmp_path, serve_archive):
+    checksum = serve_archive(_tarball(MODULE))
+
+    fetch_archive(URL, checksum, subdirectory="lib")
+    content_dir = os.path.join(_downloads(tmp_path), checksum)
+    assert sorted(os.listdir(content_dir)) == ["cfbs.json", "lib"]
+
+    # Another module in the same archive is added next to it:
+    fetch_archive(URL, checksum, subdirectory="other")
+    assert sorted(os.listdir(content_dir)) == ["cfbs.json", "lib", "other"]
+    assert read_file(os.path.join(content_dir, "other", "file.txt")) == "other\n"
+
+
+def test_fetch_archive_subdirectory_then_everything(tmp_path, serve_archive):
+    checksum = serve_archive(_tarball(MODULE))
+
+    fetch_archive(URL, checksum, subdirectory="lib")
+    content_dir = os.path.join(_downloads(tmp_path), checksum)
+    assert is_partial_export(content_dir)
+    # The subdirectory is there already, not downloaded again:
+    assert fetch_archive(URL, checksum, subdirectory="lib")[1] == checksum
+
+    # Everything is needed (like a module without subdirectory, or cfbs add),
+    # so the partial content is not good enough:
+    fetch_archive(URL, checksum)
+    assert sorted(os.listdir(content_dir)) == ["cfbs.json", "lib", "other"]
+    assert not is_partial_export(content_dir)
+    assert os.listdir(_downloads(tmp_path)) == [checksum]
+
+    # Now complete, so no subdirectory is downloaded again:
+    serve_archive(b"")
+    fetch_archive(URL, checksum)
+    fetch_archive(URL, checksum, subdirectory="other")
+    assert not is_partial_export(content_dir)
+
+
+def test_download_modules_from_same_archive(tmp_path, serve_archive):
+    checksum = serve_archive(_tarball(MODULE))
+    out_dir = str(tmp_path / "out")
+    lib = {"name": "lib", "url": URL, "commit": checksum, "subdirectory": "lib"}
+    everything = {"name": "everything", "url": URL, "commit": checksum}
+
+    _download_module(lib, 1, 10, False, False, out_dir)
+    _download_module(everything, 2, 10, False, False, out_dir)
+    assert sorted(os.listdir(lib["_directory"])) == ["run.sh"]
+    assert sorted(os.listdir(everything["_directory"])) == [
+        "cfbs.json",
+        "lib",
+        "other",
+    ]
+
+
+@pytest.mark.parametrize(
+    "files,links",
+    [
+        ([("../evil.txt", b"evil\n", 0o644)], []),
+        ([("/tmp/evil.txt", b"evil\n", 0o644)], []),
+        ([("module/cfbs.json", b"{}\n", 0o644)], [("module/passwd", "../../etc")]),
+        ([("module/cfbs.json", b"{}\n", 0o644)], [("module/passwd", "/etc/passwd")]),
+    ],
+)
+def test_fetch_archive_path_traversal(tmp_path, serve_archive, files, links):
+    checksum = serve_archive(_tarball(files, links))
+    with pytest.raises(CFBSExitError, match="Refusing to extract"):
+        fetch_archive(URL, checksum)
+    assert os.listdir(_downloads(tmp_path)) == []
+    assert not os.path.exists(str(tmp_path / "evil.txt"))
+
+
+def test_fetch_archive_zip_to_directory(tmp_path, serve_archive):
+    f = io.BytesIO()
+    with zipfile.ZipFile(f, "w") as z:
+        for name, content, mode in MODULE:
+            info = zipfile.ZipInfo(name)
+            info.external_attr = mode << 16
+            z.writestr(info, content)
+    checksum = serve_archive(f.getvalue())
+
+    directory = str(tmp_path / "module")
+    url = URL.replace(".tar.gz", ".zip")
+    assert fetch_archive(url, checksum, directory, with_index=False) == (
+        directory,
+        checksum,
+    )
+    run_sh = os.path.join(directory, "module-1.0", "lib", "run.sh")
+    assert os.stat(run_sh).st_mode & 0o777 == 0o755
+
+
+def _tree(directory):
+    files = {}
+    for root, dirs, names in os.walk(directory):
+        for name in names:
+            path = os.path.join(root, name)
+            files[os.path.relpath(path, directory)] = read_file(path)
+    return files
+
+
+def test_export_git_commit(tmp_path, monkeypatch, git_remote):
+    monkeypatch.setenv("CFBS_GLOBAL_DIR", str(tmp_path / "cfbs"))
+    first, second = git_remote.commits
+
+    for commit in (first, second):
+        path = str(tmp_path / "downloads" / commit)
+        export_git_commit(git_remote.url, commit, path)
+        # Only the files, no .git directory:
+        assert _tree(path) == git_remote.files[commit]
+
+    # Both commits are in the same bare repository, with refs to keep them:
+    mirror = _mirror_path(git_remote.url)
+    assert mirror.startswith(str(tmp_path / "cfbs" / "mirrors"))
+    refs = os.listdir(os.path.join(mirror, "refs", "cfbs"))
+    assert sorted(refs) == sorted([first, second])
+
+    # Exporting again doesn't even start git:
+    before = subprocess_count()
+    export_git_commit(git_remote.url, first, str(tmp_path / "downloads" / first))
+    assert subprocess_count() == before
+
+    # Commits in the mirror are exported without the remote:
+    os.rename(git_remote.path, git_remote.path + ".moved")
+    path = str(tmp_path / "again" / first)
+    export_git_commit(git_remote.url, first, path)
+    assert _tree(path) == git_remote.files[first]
+    with pytest.raises(CFBSExitError, match="not found"):
+        export_git_commit(git_remote.url, "0" * 40, str(tmp_path / "missing"))
+    assert not os.path.exists(str(tmp_path / "missing"))
+
+
+def _missing_objects(mirror, commit):
+    """Objects of commit not in the (partial) mirror"""
+    result = subprocess.run(
+        ["git", "rev-list", "--objects", "--missing=print", commit],
+        cwd=mirror,
+        stdout=subprocess.PIPE,
+        check=True,
+    )
+    lines = result.stdout.decode("utf-8").splitlines()
+    return [line for line in lines if line.startswith("?")]
+
+
+def test_export_git_commit_sparse(tmp_path, monkeypatch, git_remote):
+    monkeypatch.setenv("CFBS_GLOBAL_DIR", str(tmp_path / "cfbs"))
+    commit = git_remote.commits[-1]
+    files = git_remote.files[commit]
+    path = str(tmp_path / "downloads" / commit)
+    mirror = _mirror_path(git_remote.url)
+
+    # Like cfbs add, only cfbs.json:
+    export_git_commit(git_remote.url, commit, path, paths=[])
+    assert _tree(path) == {"cfbs.json": files["cfbs.json"]}
+    assert is_partial_export(path)
+    # Shallow and partial, only the commit, its trees and cfbs.json:
+    assert os.path.isfile(os.path.join(mirror, "shallow"))
+    assert len(_missing_objects(mirror, commit)) == 2
+
+    # Like building a module in a subdirectory:
+    export_git_commit(git_remote.url, commit, path, paths=["policy/"])
+    assert sorted(_tree(path)) == ["cfbs.json", "policy/main.cf"]
+    assert len(_missing_objects(mirror, commit)) == 1
+
+    # Like building a module without subdirectory, everything:
+    export_git_commit(git_remote.url, commit, path)
+    assert _tree(path) == files
+    assert not is_partial_export(path)
+    assert _missing_objects(mirror, commit) == []
+
+
+def test_export_git_commit_fallback(tmp_path, monkeypatch, git_remote):
+    monkeypatch.setenv("CFBS_GLOBAL_DIR", str(tmp_path / "cfbs"))
+    # Like a server which doesn't allow shallow fetches:
+    monkeypatch.setattr(
+        cfbs.git, "_FETCH_COMMIT_OPTIONS", (["--depth=not-allowed"], [])
+    )
+    commit = git_remote.commits[0]
+    path = str(tmp_path / "downloads" / commit)
+
+    export_git_commit(git_remote.url, commit, path)
+    assert _tree(path) == git_remote.files[commit]
+    mirror = _mirror_path(git_remote.url)
+    assert not os.path.exists(os.path.join(mirror, "shallow"))
+
+
+def test_absolute_module_copy(tmp_path, git_remote):
+    # Uncommitted changes, untracked and ignored files are not copied:
+    with open(os.path.join(git_remote.work, "policy", "main.cf"), "a") as f:
+        f.write("# Uncommitted\n")
+    with open(os.path.join(git_remote.work, "untracked.cf"), "w") as f:
+        f.write("# Untracked\n")
+
+    first = git_remote.commits[0]
+    module = {"name": git_remote.work + "/", "commit": first}
+    out_dir = str(tmp_path / "out")
+    line = absolute_module_copy(module, 1, 10, out_dir)
+
+    target = module["_directory"]
+    assert target.startswith(os.path.join(out_dir, "steps", "001_"))
+    assert _tree(target) == git_remote.files[first]
+    assert "(Copied)" in line
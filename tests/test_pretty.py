@@ -1,5 +1,15 @@
 from collections import OrderedDict
-from cfbs.pretty import pretty, pretty_check_string, pretty_string, pretty_file
+from io import StringIO
+
+from cfbs.pretty import (
+    CFBS_DEFAULT_SORTING_RULES,
+    compile_sorting_rules,
+    pretty,
+    pretty_check_string,
+    pretty_string,
+    pretty_file,
+    pretty_write,
+)
 from cfbs.utils import item_index, mkdir, read_file
 
 
@@ -208,6 +218,47 @@ def test_pretty_string():
     assert pretty_string(test) == expected
 
 
+def test_pretty_wrapped_child_on_single_line():
+    # A child which must be wrapped, inside a parent which fits on a single
+    # line, stays inside the brackets of the parent:
+    test = OrderedDict()
+    test["a"] = [[[1, 2], [3, 4]]]
+    test["b"] = 1
+    expected = """{
+  "a": [[
+    [1, 2],
+    [3, 4]
+  ]],
+  "b": 1
+}"""
+    assert pretty(test) == expected
+
+
+def test_pretty_deeply_nested():
+    # Each level tries to fit on a single line, which must not require
+    # encoding all the levels below it again (exponential time):
+    test = ["a", "b"]
+    for level in range(100):
+        test = OrderedDict([("level", level), ("children", [test, "c", "d"])])
+    result = pretty(test)
+    assert result.startswith('{\n  "level": 99,\n  "children": [\n    {\n')
+    assert result.endswith('\n    "c",\n    "d"\n  ]\n}')
+    assert pretty_string(result) == result
+
+
+def test_pretty_write():
+    test = OrderedDict()
+    test["b"] = [1, 2, OrderedDict([("c", "d")])]
+    test["a"] = ["x" * 40, "y" * 40]
+    stream = StringIO()
+    pretty_write(test, stream)
+    assert stream.getvalue() == pretty(test)
+
+    stream = StringIO()
+    pretty_write(test, stream, {None: ("alphabetic", {})})
+    assert stream.getvalue().startswith('{\n  "a": [')
+
+
 def test_pretty_file():
     mkdir("tests/tmp/", exist_ok=True)
     with open("tests/tmp/test_pretty_file.json", "w") as f:
@@ -552,3 +603,37 @@ def test_pretty_same_as_npm_prettier():
 }"""
 
     assert pretty_string(test_json) == expected
+
+
+def test_compiled_sorting_rules():
+    rules = {
+        None: (
+            ("name", "index"),
+            {
+                "ind(ex)?": ("alphabetic", {".*": (("b", "a"), None)}),
+                "build": (None, {".*": ("alphabetic", None)}),
+            },
+        )
+    }
+    compiled = compile_sorting_rules(rules)
+    assert compile_sorting_rules(compiled) is compiled
+    assert compile_sorting_rules(None) is None
+    assert compile_sorting_rules(CFBS_DEFAULT_SORTING_RULES) is compile_sorting_rules(
+        CFBS_DEFAULT_SORTING_RULES
+    )
+
+    test_json = """{
+  "other": 1,
+  "build": [{ "y": 1, "x": 2 }],
+  "index": { "z": { "c": 1, "a": 2, "b": 3 }, "y": { "a": 1 } },
+  "name": "test"
+}"""
+    expected = """{
+  "name": "test",
+  "index": { "y": { "a": 1 }, "z": { "b": 3, "a": 2, "c": 1 } },
+  "other": 1,
+  "build": [{ "x": 2, "y": 1 }]
+}"""
+    # Unknown keys are sorted last, in their original order:
+    assert pretty_string(test_json, rules) == expected
+    assert pretty_string(test_json, compiled) == expected
@@ -0,0 +1,175 @@
+import json
+import os
+import time
+
+import pytest
+
+from cfbs.pretty_files import (
+    ERROR,
+    FORMATTED,
+    REFORMATTED,
+    WOULD_REFORMAT,
+    PrettyCache,
+    expand_json_paths,
+    pretty_files,
+    pretty_one,
+)
+from cfbs.utils import CFBSExitError, read_file
+
+UGLY = '{"b":  1, "a": [1,2]}\n'
+PRETTY = '{\n  "b": 1,\n  "a": [1, 2]\n}\n'
+
+
+def write_file(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(content)
+
+
+def _files(tmp_path, names, content=PRETTY):
+    for name in names:
+        write_file(str(tmp_path / name), content)
+
+
+def _age(path, seconds=60):
+    """Make a file look like it was modified a while ago, recently modified
+    files are not cached"""
+    past = time.time() - seconds
+    os.utime(path, (past, past))
+
+
+def test_expand_json_paths(tmp_path):
+    _files(
+        tmp_path,
+        ["b.json", "a.json", "notes.txt", "sub/c.json", ".git/d.json", "sub/x/e.json"],
+    )
+    root = str(tmp_path)
+
+    assert expand_json_paths([root]) == [
+        os.path.join(root, "a.json"),
+        os.path.join(root, "b.json"),
+        os.path.join(root, "sub", "c.json"),
+        os.path.join(root, "sub", "x", "e.json"),
+    ]
+    assert expand_json_paths([os.path.join(root, "*.json")]) == [
+        os.path.join(root, "a.json"),
+        os.path.join(root, "b.json"),
+    ]
+    assert expand_json_paths([os.path.join(root, "sub", "**", "*.json")]) == [
+        os.path.join(root, "sub", "c.json"),
+        os.path.join(root, "sub", "x", "e.json"),
+    ]
+
+    # Files are listed once, in the order they were first found:
+    b = os.path.join(root, "b.json")
+    assert expand_json_paths([b, os.path.join(root, ".", "b.json"), root])[0:2] == [
+        b,
+        os.path.join(root, "a.json"),
+    ]
+
+    with pytest.raises(CFBSExitError):
+        expand_json_paths([os.path.join(root, "notes.txt")])
+    with pytest.raises(CFBSExitError):
+        expand_json_paths([os.path.join(root, "*.nothing.json")])
+
+
+def test_pretty_one(tmp_path):
+    _files(tmp_path, ["pretty.json"])
+    _files(tmp_path, ["ugly.json"], UGLY)
+    _files(tmp_path, ["broken.json"], "{")
+    pretty_path = str(tmp_path / "pretty.json")
+    ugly_path = str(tmp_path / "ugly.json")
+
+    # Just written, could still change without changing the mtime:
+    assert pretty_one(pretty_path, check=True, sorting=False) == (
+        FORMATTED,
+        None,
+        None,
+    )
+    _age(pretty_path)
+    result, error, entry = pretty_one(pretty_path, check=True, sorting=False)
+    assert (result, error) == (FORMATTED, None)
+    assert entry is not None and entry[1] == len(PRETTY)
+
+    assert pretty_one(ugly_path, check=True, sorting=False) == (
+        WOULD_REFORMAT,
+        None,
+        None,
+    )
+    assert read_file(ugly_path) == UGLY
+
+    result, error, entry = pretty_one(ugly_path, check=False, sorting=False)
+    assert (result, error) == (REFORMATTED, None)
+    assert read_file(ugly_path) == PRETTY
+
+    # CRLF line endings are accepted, like in text mode:
+    crlf_path = str(tmp_path / "crlf.json")
+    with open(crlf_path, "wb") as f:
+        f.write(PRETTY.replace("\n", "\r\n").encode("utf-8"))
+    assert pretty_one(crlf_path, check=False, sorting=False)[0] == FORMATTED
+    with open(crlf_path, "rb") as f:
+        assert b"\r\n" in f.read()
+
+    result, error, entry = pretty_one(str(tmp_path / "broken.json"), False, False)
+    assert result == ERROR
+    assert error is not None and error.startswith("Error parsing JSON in")
+
+    result, error, entry = pretty_one(str(tmp_path / "missing.json"), False, False)
+    assert result == ERROR
+    assert error == "File '%s' not found" % (tmp_path / "missing.json")
+
+
+def test_pretty_cache(tmp_path):
+    _files(tmp_path, ["a.json"])
+    path = str(tmp_path / "a.json")
+    _age(path)
+    cache_path = str(tmp_path / "cache.json")
+
+    cache = PrettyCache(sorting=False, path=cache_path)
+    assert pretty_files([path], True, False, cache=cache) == [(path, FORMATTED, None)]
+    cache.save()
+    assert os.path.isfile(cache_path)
+
+    cache = PrettyCache(sorting=False, path=cache_path)
+    entry = cache.get(path)
+    assert entry is not None
+    # Entries are separate for sorted and unsorted formatting:
+    assert PrettyCache(sorting=True, path=cache_path).get(path) is None
+
+    # A stat match skips the file, even if (unlikely) the content has changed:
+    fake = [entry[0], entry[1], "0" * 64]
+    assert pretty_one(path, True, False, fake) == (FORMATTED, None, fake)
+
+    # A changed file (different size and mtime) is checked again:
+    write_file(path, UGLY)
+    os.utime(path, ns=(entry[0] + 10**9, entry[0] + 10**9))
+    assert pretty_files([path], True, False, cache=cache) == [
+        (path, WOULD_REFORMAT, None)
+    ]
+    assert cache.get(path) is None
+
+    # Entries written by another version of cfbs are dropped:
+    write_file(path, PRETTY)
+    _age(path)
+    assert pretty_files([path], True, False, cache=cache)[0][1] == FORMATTED
+    cache.save()
+    with open(cache_path) as f:
+        entries = json.load(f)
+    write_file(
+        cache_path, json.dumps({"0.0.0-" + key: e for key, e in entries.items()})
+    )
+    assert PrettyCache(sorting=False, path=cache_path).get(path) is None
+
+    # Broken cache files are ignored:
+    write_file(cache_path, "not json")
+    assert PrettyCache(sorting=False, path=cache_path).get(path) is None
+
+
+def test_pretty_files_process_pool(tmp_path):
+    names = ["%02d.json" % number for number in range(30)]
+    _files(tmp_path, names, UGLY)
+    paths = [str(tmp_path / name) for name in names]
+
+    results = pretty_files(paths, check=False, sorting=False, jobs=2)
+    assert results == [(path, REFORMATTED, None) for path in paths]
+    assert all(read_file(path) == PRETTY for path in paths)
@@ -0,0 +1,83 @@
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from cfbs.cfbs_config import CFBSConfig
+from cfbs.project import Project
+from cfbs.utils import CFBSExitError
+
+CFBS_JSON = {
+    "name": "Example",
+    "type": "policy-set",
+    "description": "Example description",
+    "build": [
+        {
+            "name": "./policy/",
+            "description": "Local subdirectory added using cfbs command line",
+            "added_by": "cfbs add",
+            "steps": [
+                "copy main.cf services/cfbs/policy/main.cf",
+                "json def.json def.json",
+                "policy_files services/cfbs/policy/",
+                "bundles example",
+            ],
+        }
+    ],
+}
+
+
+def _create_project(path, bundle):
+    os.makedirs(os.path.join(path, "policy"))
+    with open(os.path.join(path, "cfbs.json"), "w") as f:
+        json.dump(CFBS_JSON, f)
+    with open(os.path.join(path, "policy", "main.cf"), "w") as f:
+        f.write('bundle agent example { reports: "%s"; }\n' % bundle)
+    with open(os.path.join(path, "policy", "def.json"), "w") as f:
+        json.dump({"vars": {"bundle": bundle}}, f)
+
+
+def test_project_build(tmp_path, monkeypatch):
+    projects = [str(tmp_path / name) for name in ("a", "b", "c")]
+    for path in projects:
+        _create_project(path, os.path.basename(path))
+    # The projects are not in the current working directory:
+    monkeypatch.chdir(str(tmp_path))
+
+    def build(path):
+        return Project(path).build(out_dir=path + "-out", jobs=2)
+
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        results = list(executor.map(build, projects))
+
+    for path, masterfiles in zip(projects, results):
+        assert masterfiles == path + "-out/masterfiles"
+        with open(os.path.join(masterfiles, "services/cfbs/policy/main.cf")) as f:
+            assert '"%s"' % os.path.basename(path) in f.read()
+        with open(os.path.join(masterfiles, "def.json")) as f:
+            def_json = json.load(f)
+        assert def_json["inputs"] == ["services/cfbs/policy/main.cf"]
+        assert def_json["vars"]["bundle"] == os.path.basename(path)
+        assert os.path.isfile(os.path.join(masterfiles, "cfbs.json"))
+        assert os.path.isfile(path + "-out/masterfiles.tgz")
+        with open(path + "-out/provenance.json") as f:
+            files = json.load(f)["files"]
+        assert [entry["step"] for entry in files["def.json"]] == [
+            "json def.json def.json",
+            "policy_files services/cfbs/policy/",
+            "bundles example",
+            "pretty def.json",
+        ]
+        assert files["def.json"][-1]["module"] == "cfbs build"
+        assert [entry["step"] for entry in files["cfbs.json"]] == ["copy cfbs.json"]
+        assert files["services/cfbs/policy/main.cf"][0]["module"] == "./policy/"
+        assert not os.path.exists(os.path.join(path, "out"))
+
+    assert not os.path.exists(str(tmp_path / "out"))
+    assert CFBSConfig.instance is None
+
+
+def test_project_not_found(tmp_path):
+    with pytest.raises(CFBSExitError):
+        Project(str(tmp_path))
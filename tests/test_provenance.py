@@ -0,0 +1,61 @@
+import json
+import os
+
+from cfbs.provenance import Provenance
+from cfbs.utils import file_sha256
+
+
+def _write(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(content)
+
+
+def test_provenance(tmp_path):
+    destination = str(tmp_path / "masterfiles")
+    a, b = str(tmp_path / "a"), str(tmp_path / "b")
+    _write(os.path.join(a, "promises.cf"), "stock\n")
+    _write(os.path.join(a, "lib", "files.cf"), "library\n")
+    _write(os.path.join(b, "promises.cf"), "custom\n")
+    _write(os.path.join(b, "lib", "files.cf"), "library\n")
+    provenance = Provenance(destination)
+
+    provenance.begin_step("masterfiles", "copy ./ ./")
+    assert provenance.copy(a + "/", destination + "/") == ([], [])
+    assert len(provenance) == 2
+
+    diffed = []
+    provenance.begin_step("./b/", "copy ./ ./")
+    noop, modifying = provenance.copy(
+        b + "/", destination + "/", lambda *args: diffed.append(args[2])
+    )
+    assert noop == ["lib/files.cf"]
+    assert modifying == ["promises.cf"]
+    assert diffed == ["promises.cf"]
+
+    history = provenance.history("promises.cf")
+    assert [entry["module"] for entry in history] == ["masterfiles", "./b/"]
+    assert history[0]["sha256"] == file_sha256(os.path.join(a, "promises.cf"))
+    assert provenance.sha256("promises.cf") == file_sha256(
+        os.path.join(destination, "promises.cf")
+    )
+    assert provenance.last("lib/files.cf")["module"] == "./b/"
+    assert provenance.last("missing.cf") is None
+
+    provenance.begin_step("./b/", "patch ./fix.patch")
+    os.remove(os.path.join(destination, "promises.cf"))
+    provenance.record_file(os.path.join(destination, "promises.cf"))
+    provenance.record_file(os.path.join(destination, "never-written.cf"))
+    assert provenance.sha256("promises.cf") is None
+    assert "never-written.cf" not in provenance
+
+    path = str(tmp_path / "provenance.json")
+    provenance.save(path)
+    with open(path) as f:
+        data = json.load(f)
+    assert list(data["files"]) == ["lib/files.cf", "promises.cf"]
+    assert data["files"]["promises.cf"][-1] == {
+        "module": "./b/",
+        "step": "patch ./fix.patch",
+        "sha256": None,
+    }
@@ -0,0 +1,130 @@
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import cfbs.serve
+from cfbs.serve import (
+    INVALID_PARAMS,
+    INVALID_REQUEST,
+    METHOD_NOT_FOUND,
+    PARSE_ERROR,
+    _Server,
+    call,
+    run_on_server,
+    socket_path,
+)
+
+CFBS_JSON = """{
+  "name": "Example",
+  "type": "policy-set",
+  "description": "%s",
+  "build": []
+}
+"""
+
+
+def _error_code(response):
+    return response["error"]["code"]
+
+
+def test_serve_errors(tmp_path):
+    server = _Server(str(tmp_path))
+    assert _error_code(server.handle("{")) == PARSE_ERROR
+    assert _error_code(server.handle("[]")) == INVALID_REQUEST
+    request = {"jsonrpc": "2.0", "id": 7, "method": "nope"}
+    response = server.handle(json.dumps(request))
+    assert response["id"] == 7
+    assert _error_code(response) == METHOD_NOT_FOUND
+    request["method"] = "run"
+    request["params"] = {"argv": "status"}
+    assert _error_code(server.handle(json.dumps(request))) == INVALID_PARAMS
+    # Commands which modify the project are not served:
+    request["params"] = {"argv": ["add", "autorun"]}
+    assert _error_code(server.handle(json.dumps(request))) == INVALID_PARAMS
+    request["method"] = "ping"
+    del request["params"]
+    response = server.handle(json.dumps(request))
+    assert response["result"]["directory"] == str(tmp_path)
+
+
+def test_run_on_server_without_server(tmp_path, monkeypatch):
+    monkeypatch.setenv("CFBS_GLOBAL_DIR", str(tmp_path))
+    assert not os.path.exists(socket_path())
+    assert run_on_server(["status"]) is None
+
+
+def test_run_on_server_not_answering(tmp_path, monkeypatch):
+    monkeypatch.setenv("CFBS_GLOBAL_DIR", str(tmp_path))
+    monkeypatch.setattr(cfbs.serve, "CLIENT_TIMEOUT", 0.2)
+    path = socket_path()
+    os.makedirs(os.path.dirname(path))
+    # Accepts connections (backlog), but never answers:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as stuck:
+        stuck.bind(path)
+        stuck.listen(1)
+        start = time.time()
+        assert run_on_server(["status"]) is None
+        assert time.time() - start < 5
+
+
+def test_serve(tmp_path, monkeypatch):
+    project = tmp_path / "project"
+    project.mkdir()
+    (project / "cfbs.json").write_text(CFBS_JSON % "First")
+    env = dict(os.environ)
+    env["CFBS_GLOBAL_DIR"] = str(tmp_path / "global")
+    env["PYTHONPATH"] = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    monkeypatch.setenv("CFBS_GLOBAL_DIR", env["CFBS_GLOBAL_DIR"])
+    path = socket_path(str(project))
+
+    server = subprocess.Popen(
+        [sys.executable, "-m", "cfbs", "serve"],
+        cwd=str(project),
+        env=env,
+        stdout=subprocess.DEVNULL,
+    )
+    try:
+        for _ in range(100):
+            if os.path.exists(path):
+                break
+            time.sleep(0.05)
+        assert call("ping", path=path, timeout=10)["pid"] == server.pid
+
+        # An idle connection doesn't block other clients for long:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as idle:
+            idle.connect(path)
+            assert call("ping", path=path, timeout=10)["pid"] == server.pid
+
+        result = call("run", {"argv": ["status"]}, path, timeout=10)
+        assert result["exit_code"] == 0
+        assert "Description: First" in result["stdout"]
+
+        # Changes to cfbs.json are noticed:
+        (project / "cfbs.json").write_text(CFBS_JSON % "Second, longer")
+        result = call("run", {"argv": ["status"]}, path, timeout=10)
+        assert "Description: Second, longer" in result["stdout"]
+
+        result = call("run", {"argv": ["validate"]}, path, timeout=10)
+        assert result["exit_code"] == 1
+        assert 'The "build" field' in result["stdout"]
+
+        # The client prints the output of the server:
+        client = subprocess.run(
+            [sys.executable, "-m", "cfbs", "status"],
+            cwd=str(project),
+            env=env,
+            stdout=subprocess.PIPE,
+            universal_newlines=True,
+        )
+        assert client.returncode == 0
+        assert "Description: Second, longer" in client.stdout
+
+        assert call("shutdown", path=path, timeout=10) is None
+        assert server.wait(timeout=10) == 0
+        assert not os.path.exists(path)
+    finally:
+        if server.poll() is None:
+            server.kill()
@@ -0,0 +1,101 @@
+import json
+import os
+import subprocess
+
+from cfbs.cfbs_config import CFBSConfig
+from cfbs.updates import check_updates, version_numbers
+
+INDEX = {
+    "new": {
+        "description": "Module with a newer version in the index",
+        "tags": ["supported"],
+        "repo": "https://github.com/cfengine/modules",
+        "by": "https://github.com/cfengine",
+        "version": "1.2.10",
+        "commit": "2" * 40,
+        "subdirectory": "new",
+        "steps": ["copy ./new.cf services/cfbs/new.cf"],
+    },
+    "same": {
+        "description": "Module which is up to date",
+        "tags": ["supported"],
+        "repo": "https://github.com/cfengine/modules",
+        "by": "https://github.com/cfengine",
+        "version": "0.1.0",
+        "commit": "3" * 40,
+        "subdirectory": "same",
+        "steps": ["copy ./same.cf services/cfbs/same.cf"],
+    },
+}
+
+
+def _module(name, **keys):
+    module = {"name": name, "description": "Test module", "added_by": "cfbs add"}
+    module.update(keys)
+    module["steps"] = ["copy ./main.cf services/cfbs/main.cf"]
+    return module
+
+
+def _config(tmp_path, build):
+    path = str(tmp_path / "cfbs.json")
+    data = {"name": "Example", "type": "policy-set", "description": "", "build": build}
+    with open(path, "w") as f:
+        json.dump(data, f)
+    return path, CFBSConfig(filename=path, index=INDEX, non_interactive=True)
+
+
+def test_version_numbers():
+    assert version_numbers("1.2.10") == [1, 2, 10]
+    assert version_numbers("3.21.0-1") == [3, 21, 0, 1]
+    assert version_numbers("1.2.10") > version_numbers("1.2.9")
+
+
+def test_check_updates(tmp_path, git_remote):
+    old, latest = git_remote.commits
+    build = [
+        _module("new", version="1.2.9", commit="1" * 40),
+        _module("same", version="0.1.0", commit="3" * 40),
+        _module("./local/"),
+        _module("remote", url=git_remote.url, branch="main", commit=old),
+        _module("missing", url=git_remote.url, branch="nothing", commit=old),
+    ]
+    path, config = _config(tmp_path, build)
+    with open(path) as f:
+        before = f.read()
+
+    results = check_updates(config, jobs=4)
+
+    assert [(r["name"], r["source"]) for r in results] == [
+        ("new", "index"),
+        ("same", "index"),
+        ("remote", "url"),
+        ("missing", "url"),
+    ]
+    assert results[0]["current"] == "1.2.9"
+    assert results[0]["available"] == "1.2.10"
+    assert results[0]["update_available"]
+    assert not results[1]["update_available"]
+    assert results[2]["current"] == old
+    assert results[2]["available"] == latest
+    assert results[2]["update_available"]
+    assert results[3]["available"] is None
+    assert not results[3]["update_available"]
+    assert "error" in results[3]
+
+    # Nothing was changed or downloaded:
+    with open(path) as f:
+        assert f.read() == before
+    assert not os.path.exists(str(tmp_path / "out"))
+
+    # Only the modules asked for:
+    results = check_updates(config, ["remote", "not-in-build"], jobs=1)
+    assert [r["name"] for r in results] == ["remote"]
+    assert results[0]["available"] == latest
+
+    # Refs are listed again by each check, moving the branch is noticed:
+    subprocess.run(
+        ["git", "update-ref", "refs/heads/main", old], cwd=git_remote.path, check=True
+    )
+    results = check_updates(config, ["remote"], jobs=1)
+    assert results[0]["available"] == old
+    assert not results[0]["update_available"]
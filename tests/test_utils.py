@@ -3,9 +3,16 @@ import os
 
 import pytest
 
+import cfbs.utils
 from cfbs.utils import (
+    append_file,
     are_paths_equal,
+    cached_file_sha256,
     canonify,
+    cli_tool_present,
+    counted_subprocess,
+    cp_dry_overwrites,
+    cp_overwrites,
     deduplicate_def_json,
     deduplicate_list,
     dict_diff,
@@ -26,6 +33,9 @@ from cfbs.utils import (
     strip_left_any,
     strip_right,
     strip_right_any,
+    subprocess_count,
+    touch,
+    write_json,
 )
 
 
@@ -96,6 +106,59 @@ def test_read_json():
     assert exc_info.value.code == 1
 
 
+def test_write_json(tmp_path):
+    path = str(tmp_path / "subdir" / "file.json")
+    write_json(path, OrderedDict([("a", 1), ("b", [1, 2])]))
+    assert read_file(path) == '{\n  "a": 1,\n  "b": [1, 2]\n}\n'
+
+    # The file is replaced atomically, and keeps its permissions:
+    os.chmod(path, 0o640)
+    write_json(path, OrderedDict([("a", 2)]))
+    assert read_file(path) == '{\n  "a": 2\n}\n'
+    assert os.stat(path).st_mode & 0o777 == 0o640
+    # Even permissions the umask would remove from new files:
+    os.chmod(path, 0o664)
+    umask = os.umask(0o022)
+    try:
+        write_json(path, OrderedDict([("a", 2)]))
+    finally:
+        os.umask(umask)
+    assert os.stat(path).st_mode & 0o777 == 0o664
+
+    # If encoding fails half way, the old file is left untouched:
+    with pytest.raises(ValueError):
+        write_json(path, OrderedDict([("a", 3), ("b", object())]))
+    assert read_file(path) == '{\n  "a": 2\n}\n'
+    assert os.listdir(str(tmp_path / "subdir")) == ["file.json"]
+
+
+def test_write_json_chmod_fails(tmp_path, monkeypatch):
+    path = str(tmp_path / "file.json")
+    write_json(path, OrderedDict([("a", 1)]))
+    opened = []
+    real_open = os.open
+
+    def recording_open(*args):
+        fd = real_open(*args)
+        opened.append(fd)
+        return fd
+
+    def failing_chmod(path, mode):
+        raise PermissionError(path)
+
+    monkeypatch.setattr(cfbs.utils.os, "open", recording_open)
+    monkeypatch.setattr(cfbs.utils.os, "chmod", failing_chmod)
+    with pytest.raises(PermissionError):
+        write_json(path, OrderedDict([("a", 2)]))
+    monkeypatch.undo()
+
+    # The temporary file is removed, and closed:
+    assert os.listdir(str(tmp_path)) == ["file.json"]
+    assert len(opened) == 1
+    with pytest.raises(OSError):
+        os.fstat(opened[0])
+
+
 def test_merge_json():
     original = {"classes": {"services_autorun": ["any"]}}
     extras = {
@@ -351,3 +414,92 @@ bundle agent doofus
     assert len(bundles) == 2
     assert bundles[0] == "bogus"
     assert bundles[1] == "doofus"
+
+
+def test_touch_and_append_file(tmp_path):
+    dst = str(tmp_path / "sub dir" / "dst.txt")
+    touch(dst)
+    assert read_file(dst) == ""
+
+    src = str(tmp_path / "src.txt")
+    with open(src, "w") as f:
+        f.write("line 1\n")
+    append_file(src, dst)
+    append_file(src, dst)
+    assert read_file(dst) == "line 1\nline 1\n"
+
+    # Touching an existing file doesn't change it:
+    touch(dst)
+    assert read_file(dst) == "line 1\nline 1\n"
+
+
+def test_subprocess_count():
+    assert cli_tool_present("sh")
+    assert not cli_tool_present("cfbs-no-such-tool")
+
+    calls = []
+    count = counted_subprocess(lambda *args: calls.append(args))
+    before = subprocess_count()
+    count("git", "status")
+    count("patch")
+    assert subprocess_count() - before == 2
+    assert calls == [("git", "status"), ("patch",)]
+
+
+def test_cp_overwrites(tmp_path):
+    def write(path, content, mode=0o644):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write(content)
+        os.chmod(path, mode)
+
+    src = str(tmp_path / "src")
+    dst = str(tmp_path / "dst")
+    write(os.path.join(src, "same.cf"), "same\n", 0o755)
+    write(os.path.join(src, "sub", "changed.cf"), "new\n")
+    write(os.path.join(src, "sub", "added.cf"), "added\n")
+    os.makedirs(os.path.join(src, "empty"))
+    write(os.path.join(dst, "same.cf"), "same\n")
+    write(os.path.join(dst, "sub", "changed.cf"), "old\n")
+    write(os.path.join(dst, "kept.cf"), "kept\n")
+    same_mtime = os.stat(os.path.join(dst, "same.cf")).st_mtime_ns
+
+    assert cp_dry_overwrites(src, dst) == (["same.cf"], ["sub/changed.cf"])
+    overwritten = []
+    result = cp_overwrites(
+        src, dst, lambda s, d, rel: overwritten.append((read_file(d), rel))
+    )
+    assert result == (["same.cf"], ["sub/changed.cf"])
+    # Called before overwriting:
+    assert overwritten == [("old\n", "sub/changed.cf")]
+    assert read_file(os.path.join(dst, "sub", "changed.cf")) == "new\n"
+    assert read_file(os.path.join(dst, "sub", "added.cf")) == "added\n"
+    assert read_file(os.path.join(dst, "kept.cf")) == "kept\n"
+    assert os.path.isdir(os.path.join(dst, "empty"))
+    # The identical file is not copied again, but gets the same permissions:
+    same = os.stat(os.path.join(dst, "same.cf"))
+    assert same.st_mtime_ns == same_mtime
+    assert same.st_mode & 0o777 == 0o755
+
+    # Copying a single file, into a directory or to a file path:
+    single = os.path.join(src, "sub", "added.cf")
+    assert cp_overwrites(single, os.path.join(dst, "sub")) == (["added.cf"], [])
+    assert cp_overwrites(single, os.path.join(dst, "new", "x.cf")) == ([], [])
+    assert read_file(os.path.join(dst, "new", "x.cf")) == "added\n"
+
+
+def test_cached_file_sha256(tmp_path, monkeypatch):
+    path = str(tmp_path / "a.txt")
+    with open(path, "w") as f:
+        f.write("a")
+    assert cached_file_sha256(path) == file_sha256(path)
+
+    # Hashes of recently changed files are not cached:
+    assert not any(key[0] == path for key in cfbs.utils._file_hashes)
+    monkeypatch.setattr(cfbs.utils, "_RACY_SECONDS", -10)
+    assert cached_file_sha256(path) == file_sha256(path)
+    assert any(key[0] == path for key in cfbs.utils._file_hashes)
+
+    with open(path, "w") as f:
+        f.write("ab")
+    assert cached_file_sha256(path) == file_sha256(path)
@@ -1,7 +1,13 @@
+import re
+
 import pytest
 
 from cfbs.utils import CFBSValidationError
-from cfbs.validate import input_data_matches_spec, validate_module_name_content
+from cfbs.validate import (
+    input_data_matches_spec,
+    validate_module_name_content,
+    validate_single_module,
+)
 
 
 def test_validate_module_name_content():
@@ -278,3 +284,52 @@ def test_input_data_matches_spec_not_lists():
     # And so does the input definition:
     assert not input_data_matches_spec(0, spec)
     assert not input_data_matches_spec({}, spec)
+
+
+def _index_module(**fields):
+    module = {
+        "description": "Example module",
+        "tags": ["supported"],
+        "repo": "https://github.com/cfengine/modules",
+        "by": "https://github.com/cfengine",
+        "version": "1.0.0",
+        "commit": "a" * 40,
+        "steps": ["copy ./main.cf services/cfbs/main.cf"],
+    }
+    module.update(fields)
+    return module
+
+
+def test_validate_single_module_valid():
+    validate_single_module("index", "example", _index_module(), None, True)
+
+
+@pytest.mark.parametrize(
+    "field,value,message",
+    [
+        ("description", "", '"description" must be non-empty'),
+        ("tags", "supported", '"tags" must be of type list'),
+        ("repo", 1, '"repo" must be of type string'),
+        ("by", "", '"by" must be non-empty'),
+        ("dependencies", "a", 'Value of attribute "dependencies" must be of type list'),
+        ("index", 1, '"index" in "example" must be a string'),
+        ("version", "one", '"version" must match regex'),
+        ("commit", "abc", '"commit" must be a commit reference'),
+        ("branch", 1, '"branch" must be of type string'),
+        ("subdirectory", "./sub", '"subdirectory" must not start with ./'),
+        ("steps", [], '"steps" must be non-empty'),
+        ("website", "http://cfengine.com", '"website" must be an HTTPS URL'),
+        ("documentation", "ftp://x", '"documentation" must be an HTTPS URL'),
+        ("input", [], 'The module\'s "input" must be a non-empty array'),
+    ],
+)
+def test_validate_single_module_fields(field, value, message):
+    module = _index_module(**{field: value})
+    with pytest.raises(CFBSValidationError, match=re.escape(message)):
+        validate_single_module("index", "example", module, None, True)
+
+
+def test_validate_single_module_name():
+    module = _index_module(name="Example")
+    with pytest.raises(CFBSValidationError, match="must start with a lowercase"):
+        validate_single_module("build", "Example", module, None, True)
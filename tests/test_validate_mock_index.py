@@ -1,7 +1,11 @@
 from collections import OrderedDict
 from copy import deepcopy
 
-from cfbs.validate import validate_config
+from cfbs.validate import (
+    validate_config,
+    validate_config_collect_errors,
+    validation_report,
+)
 
 
 # Only 2 interactions between validate_config and the config object:
@@ -194,3 +198,47 @@ def test_validate_mock_index():
     assert validate_config(config) == 1
     config["index"]["allow-all-hosts"]["steps"] = before
     assert validate_config(config) == 0
+
+
+def test_validate_mock_index_collects_all_errors():
+    config = MockConfig(deepcopy(INDEX))
+    assert validate_config_collect_errors(config) == []
+
+    config = MockConfig(deepcopy(INDEX))
+    config["index"]["second-module"] = deepcopy(config["index"]["allow-all-hosts"])
+    config["index"]["third-module"] = deepcopy(config["index"]["allow-all-hosts"])
+    del config["index"]["allow-all-hosts"]["steps"]
+    config["index"]["third-module"]["version"] = "one"
+    issues = validate_config_collect_errors(config)
+    assert [issue.path for issue in issues] == [
+        '$.index["allow-all-hosts"]',
+        '$.index["third-module"]',
+    ]
+    assert [issue.module for issue in issues] == ["allow-all-hosts", "third-module"]
+    assert '"steps" field is required' in str(issues[0].error)
+    assert '"version" must match regex' in str(issues[1].error)
+    assert validate_config(config) == 1
+
+    report = validation_report(issues)
+    assert report["valid"] is False
+    assert report["errors"][1]["path"] == '$.index["third-module"]'
+    assert report["errors"][1]["message"] == str(issues[1].error)
+
+    # Absolute modules are checked in parallel, errors keep their order:
+    config = MockConfig(deepcopy(INDEX))
+    module = config["index"].pop("allow-all-hosts")
+    for name in ("/nonexistent/a/", "/nonexistent/b/", "/nonexistent/c/"):
+        config["index"][name] = deepcopy(module)
+    issues = validate_config_collect_errors(config, jobs=3)
+    assert [issue.module for issue in issues] == [
+        "/nonexistent/a/",
+        "/nonexistent/b/",
+        "/nonexistent/c/",
+    ]
+
+    # Broken top level keys stop validation:
+    config = MockConfig(deepcopy(INDEX))
+    del config["name"]
+    del config["index"]["allow-all-hosts"]["steps"]
+    issues = validate_config_collect_errors(config)
+    assert [issue.path for issue in issues] == ["$"]
@@ -0,0 +1,4 @@
+if __name__ == "__main__":
+    print("bar")
+    print("bob,bob")
+    print("ipsum,ipsum,ipsum")
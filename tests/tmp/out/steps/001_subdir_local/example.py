@@ -0,0 +1,4 @@
+if __name__ == "__main__":
+    print("foo")
+    print("alice,alice")
+    print("lorem,lorem,lorem")
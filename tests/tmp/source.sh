@@ -0,0 +1 @@
+some content